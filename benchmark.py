@@ -0,0 +1,597 @@
+# Importações
+import os
+import json
+import argparse
+import functools
+import itertools
+import random
+import re
+import time
+import tracemalloc
+import psycopg2
+from psycopg2.extras import execute_values
+from psycopg2.extensions import parse_dsn
+from dotenv import load_dotenv
+
+import collect_data
+import expo_api
+from collect_data import build_activities, build_classes, split_text, split_texts, divide_text, clear_text_chunk_cache
+from metrics import stage, instrumented, MetricsCursor
+from expo_stub import synthetic_review
+
+# Os logs JSON das etapas não poluem a saída do benchmark (a não ser que METRICS_LOG_FILE seja definido)
+os.environ.setdefault("METRICS_LOG_FILE", os.devnull)
+
+# Comentário gravado no schema staging sintético: o benchmark só recria um staging que tenha essa marca (ou vazio)
+BENCH_SCHEMA_MARKER = "zeta-benchmark: staging sintético"
+
+# Variáveis de ambiente com os bancos do RPA, onde o benchmark nunca roda
+RPA_DATABASE_ENVS = ("POSTGRES_URL_1", "POSTGRES_URL_2", "DATABASE_URL")
+
+# Nomes do mesmo host local
+LOCAL_HOSTS = {"", "localhost", "127.0.0.1", "::1"}
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-= DADOS SINTÉTICOS -=-=-=-=-=-=-=-=-=-=-=-=-=
+# Gera um texto com frases separadas por ponto (para o split_text ter trabalho real)
+def synthetic_text(rnd, sentences=8):
+    words = ["produtor", "bovino", "vacina", "manejo", "pasto", "sanidade", "rebanho", "ração", "água", "curral"]
+    return " ".join(
+        " ".join(rnd.choice(words) for _ in range(rnd.randint(6, 20))).capitalize() + "."
+        for _ in range(sentences)
+    )
+
+# Gera as aulas com os seus textos, flashcards e leis
+def synthetic_classes(n_aulas, n_textos, n_flashcards, n_leis, seed=42):
+    rnd = random.Random(seed)
+    aulas = []
+    for aula_id in range(1, n_aulas + 1):
+        aulas.append({
+            "id": aula_id,
+            "nome": f"Aula {aula_id}",
+            "id_modulo": aula_id % 20 + 1,
+            "modulo": f"Módulo {aula_id % 20 + 1}",
+            "textos": [synthetic_text(rnd) for _ in range(n_textos)],
+            "flashcards": [(f"Frente {aula_id}-{i}", f"Verso {aula_id}-{i}") for i in range(n_flashcards)],
+            "leis": [f"Lei {rnd.randint(1, 500)}/{rnd.randint(1990, 2024)}" for _ in range(n_leis)]
+        })
+    return aulas
+
+# Gera as atividades com as suas perguntas e alternativas
+def synthetic_activities(n_atividades, n_perguntas, n_alternativas):
+    atividades = []
+    for atividade_id in range(1, n_atividades + 1):
+        atividades.append({
+            "id": atividade_id,
+            "pontuacao": 10,
+            "id_aula": atividade_id,
+            "perguntas": [(atividade_id * 1000 + i, f"Pergunta {i}?") for i in range(n_perguntas)],
+            "alternativas": [(f"Alternativa {i}", i == 0) for i in range(n_alternativas)]
+        })
+    return atividades
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-= FORMATO DAS LINHAS -=-=-=-=-=-=-=-=-=-=-=-=-=
+# Linhas como a query antiga de classes devolvia (LEFT JOIN de texto_corrido x flash_card x lei)
+def legacy_class_rows(aulas):
+    for a in aulas:
+        for text, flashcard, law in itertools.product(a["textos"] or [None], a["flashcards"] or [(None, None)], a["leis"] or [None]):
+            yield (a["id"], a["nome"], a["id_modulo"], a["modulo"], text, flashcard[0], flashcard[1], law)
+
+# Linhas como a query atual de classes devolve (uma por aula, relações agregadas)
+def aggregated_class_rows(aulas):
+    for a in aulas:
+        yield (a["id"], a["nome"], a["id_modulo"], a["modulo"], a["textos"], [list(f) for f in a["flashcards"]], a["leis"])
+
+# Linhas como a query antiga de activities devolvia (LEFT JOIN de pergunta x alternativa)
+def legacy_activity_rows(atividades):
+    for a in atividades:
+        for (question_id, question), (alt_id, (answer, correct)) in itertools.product(
+            a["perguntas"] or [(None, None)], enumerate(a["alternativas"]) if a["alternativas"] else [(None, (None, None))]
+        ):
+            yield (a["id"], a["pontuacao"], a["id_aula"], question_id, question, alt_id, answer, correct)
+
+# Linhas como a query atual de activities devolve (uma por atividade, perguntas e alternativas em JSON)
+def aggregated_activity_rows(atividades):
+    for a in atividades:
+        yield (
+            a["id"], a["pontuacao"], a["id_aula"],
+            [{"id": q_id, "question": q} for q_id, q in a["perguntas"]],
+            [{"answer": answer, "correct": correct} for answer, correct in a["alternativas"]]
+        )
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-= MONTAGEM ANTIGA (REFERÊNCIA) -=-=-=-=-=-=-=-=-=-=-=-=-=
+# Divisão dos textos como era feita antes (regex compilada a cada chamada, strings montadas com +=,
+# frases maiores que max_len viravam partes maiores que max_len)
+def legacy_split_text(text, max_len=250):
+    sentences = re.split(r'(?<=[.,])\s+', text)
+    parts = []
+    current = ""
+    for sentence in sentences:
+        if len(current) + len(sentence) + 1 > max_len:
+            parts.append(current.strip())
+            current = sentence
+        else:
+            current += " " + sentence
+    if current:
+        parts.append(current.strip())
+    return parts
+
+# Montagem de classes como era feita antes (agrupando as linhas repetidas com sets de controle)
+def legacy_build_classes(rows, law_descriptions):
+    classes = {}
+    for class_id, class_name, module_id, module_name, text, front, back, law_number in rows:
+        if class_id not in classes:
+            classes[class_id] = {
+                "_id": class_id, "program_id": module_id, "title": class_name, "description": module_name,
+                "content": [], "flashcards": [], "laws": [],
+                "_seen_content_parts": set(), "_seen_flashcards": set(), "_seen_laws": set()
+            }
+        doc = classes[class_id]
+        if text:
+            for part in legacy_split_text(text):
+                if part not in doc["_seen_content_parts"]:
+                    doc["_seen_content_parts"].add(part)
+                    doc["content"].append(part)
+        if front and back:
+            key = f"{front}||{back}"
+            if key not in doc["_seen_flashcards"]:
+                doc["_seen_flashcards"].add(key)
+                doc["flashcards"].append({"front": front, "back": back})
+        if law_number and law_number not in doc["_seen_laws"]:
+            doc["_seen_laws"].add(law_number)
+            doc["laws"].append({"number": law_number, "description": law_descriptions.get(law_number)})
+    for doc in classes.values():
+        doc.pop("_seen_content_parts")
+        doc.pop("_seen_flashcards")
+        doc.pop("_seen_laws")
+    return list(classes.values())
+
+# Montagem de activities como era feita antes
+def legacy_build_activities(rows):
+    activities = {}
+    for activity_id, points, class_id, question_id, question, alternative_id, alternative, correct in rows:
+        if activity_id not in activities:
+            activities[activity_id] = {
+                "_id": activity_id, "class_id": class_id,
+                "points": float(points) if points is not None else 0, "questions": {}
+            }
+        if not question_id:
+            continue
+        questions = activities[activity_id]["questions"]
+        if question_id not in questions:
+            questions[question_id] = {"question": question, "answers": []}
+        if alternative:
+            questions[question_id]["answers"].append({"answer": alternative, "correct": correct})
+    for activity in activities.values():
+        activity["questions"] = list(activity["questions"].values())
+    return list(activities.values())
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-= BENCHMARK -=-=-=-=-=-=-=-=-=-=-=-=-=
+# Mede quantas linhas o banco devolveria e quanto tempo leva para montar os documentos
+def measure(name, rows, builder):
+    rows = list(rows)
+    start = time.perf_counter()
+    docs = list(builder(rows))
+    seconds = time.perf_counter() - start
+    print(f"{name:<28} linhas: {len(rows):>10}  documentos: {len(docs):>8}  montagem: {seconds:8.3f}s")
+    return docs
+
+# Compara o formato antigo (produto cartesiano) com o agregado para classes e activities
+def bench_document_build(n_aulas, n_textos, n_flashcards, n_leis, n_perguntas, n_alternativas):
+    print(f"\nClasses ({n_aulas} aulas, {n_textos} textos, {n_flashcards} flashcards, {n_leis} leis por aula)")
+    aulas = synthetic_classes(n_aulas, n_textos, n_flashcards, n_leis)
+    before = measure("antes (JOIN cartesiano)", legacy_class_rows(aulas), lambda rows: legacy_build_classes(rows, {}))
+    after = measure("depois (agregado)", aggregated_class_rows(aulas), lambda rows: build_classes(rows, {}))
+    print(f"Mesmo resultado: {before == after}")
+
+    print(f"\nActivities ({n_aulas} atividades, {n_perguntas} perguntas, {n_alternativas} alternativas por atividade)")
+    atividades = synthetic_activities(n_aulas, n_perguntas, n_alternativas)
+    before = measure("antes (JOIN cartesiano)", legacy_activity_rows(atividades), legacy_build_activities)
+    after = measure("depois (agregado)", aggregated_activity_rows(atividades), build_activities)
+    print(f"Mesmo resultado: {before == after}")
+
+# Gera os textos do benchmark da divisão: uma fração deles com uma frase sem pontuação maior que max_len
+def synthetic_corpus(n_textos, sentences, long_fraction, max_len=250, seed=42):
+    rnd = random.Random(seed)
+    corpus = []
+    for _ in range(n_textos):
+        text = synthetic_text(rnd, sentences)
+        if rnd.random() < long_fraction:
+            text += " " + " ".join(rnd.choice(("manejo", "rebanho", "sanidade")) for _ in range(max_len // 5))
+        corpus.append(text)
+    return corpus
+
+# Mede a divisão dos textos: a função antiga x a atual sem o cache, com o cache e em lote.
+# Cada texto aparece "repeticoes" vezes seguidas, como nas linhas repetidas que a query antiga devolvia.
+def bench_split_text(n_textos, repeticoes, sentences=8, long_fraction=0.05):
+    corpus = synthetic_corpus(n_textos, sentences, long_fraction)
+    rows = [text for text in corpus for _ in range(repeticoes)]
+    size_mb = sum(len(text) for text in rows) / 1024 / 1024
+    print(f"\nDivisão dos textos ({n_textos} textos x {repeticoes} repetições, {size_mb:.1f} MB)")
+
+    def run(name, func):
+        start = time.perf_counter()
+        parts = func()
+        seconds = time.perf_counter() - start
+        oversized = sum(len(part) > collect_data.TEXT_CHUNK_MAX_LEN for text_parts in parts for part in text_parts)
+        print(f"{name:<28} partes: {sum(map(len, parts)):>10}  maiores que o limite: {oversized:>6}  tempo: {seconds:8.3f}s")
+        return parts
+
+    before = run("antes", lambda: [legacy_split_text(text) for text in rows])
+    run("depois (sem cache)", lambda: [divide_text(text) for text in rows])
+    clear_text_chunk_cache()
+    after = run("depois (com cache)", lambda: [split_text(text) for text in rows])
+    cache = collect_data.TEXT_CHUNK_CACHE_STATS
+    print(f"{'':<28} cache: {cache['hits']} acertos, {cache['misses']} divisões")
+    clear_text_chunk_cache()
+    run("depois (em lote, distintos)", lambda: list(split_texts(rows).values()))
+    same = sum(old == new for old, new in zip(before, after))
+    print(f"Mesmo resultado: {same} de {len(rows)} textos (os outros tinham frases maiores que o limite)")
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-= PROTEÇÃO DOS BANCOS DO RPA -=-=-=-=-=-=-=-=-=-=-=-=-=
+# Identifica o banco de uma URL/DSN do Postgres: (host, porta, banco), com os valores padrão do libpq
+# e os nomes do host local (e os sockets unix) normalizados
+def database_identity(url):
+    dsn = parse_dsn(url)
+    host = dsn.get("host", "").split(",")[0].lower()
+    if host in LOCAL_HOSTS or host.startswith("/"):
+        host = "localhost"
+    port = dsn.get("port", "").split(",")[0] or "5432"
+    dbname = dsn.get("dbname") or dsn.get("user") or os.getenv("PGUSER") or os.getenv("USER", "")
+    return host, port, dbname
+
+# Retorna o nome da variável de ambiente do banco do RPA para o qual a URL aponta (None se não for nenhum)
+def rpa_database(url):
+    target = database_identity(url)
+    for env in RPA_DATABASE_ENVS:
+        if os.getenv(env) and database_identity(os.getenv(env)) == target:
+            return env
+    return None
+
+# Recusa recriar um schema staging com tabelas que não foi criado pelo benchmark
+def check_staging_is_synthetic(cur):
+    cur.execute("""
+    SELECT obj_description(n.oid, 'pg_namespace'),
+           (SELECT count(*) FROM pg_class c WHERE c.relnamespace = n.oid AND c.relkind IN ('r', 'p'))
+    FROM pg_namespace n WHERE n.nspname = 'staging';
+    """)
+    row = cur.fetchone()
+    if row and row[1] and row[0] != BENCH_SCHEMA_MARKER:
+        raise RuntimeError(
+            "O banco do benchmark já tem um schema staging com tabelas que não foi gerado pelo benchmark; "
+            "use um banco descartável"
+        )
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-= STAGING SINTÉTICO -=-=-=-=-=-=-=-=-=-=-=-=-=
+# Recria o schema staging (e as tabelas de destino) no banco do benchmark com dados gerados no próprio Postgres
+# (generate_series), na escala pedida. Apaga os dados do staging, de plans/segments/workers e do cache de leis!
+# Só roda se o staging existente estiver vazio ou tiver sido gerado pelo benchmark.
+def create_synthetic_staging(conn, scale):
+    params = dict(scale, fornecedores=max(1, scale["produtores"] // 100), marker=BENCH_SCHEMA_MARKER)
+    with conn.cursor() as cur:
+        check_staging_is_synthetic(cur)
+        cur.execute("""
+        DROP SCHEMA IF EXISTS staging CASCADE;
+        CREATE SCHEMA staging;
+        COMMENT ON SCHEMA staging IS %(marker)s;
+        CREATE SCHEMA IF NOT EXISTS rpa;
+        DROP TABLE IF EXISTS rpa.law_cache;
+
+        CREATE TABLE staging.assinatura (id INT PRIMARY KEY, tp_plano TEXT, preco_fixo TEXT);
+        INSERT INTO staging.assinatura
+        SELECT g, 'Plano ' || g, '$' || to_char(g * 1234.5, 'FM999,999,990.00') FROM generate_series(1, %(planos)s) g;
+
+        CREATE TABLE staging.curso (id INT PRIMARY KEY, nome TEXT);
+        INSERT INTO staging.curso SELECT g, 'Curso ' || g FROM generate_series(1, %(cursos)s) g;
+
+        CREATE TABLE staging.fornecedor (id INT PRIMARY KEY, id_empresa INT);
+        INSERT INTO staging.fornecedor SELECT g, 1 + g %% 50 FROM generate_series(1, %(fornecedores)s) g;
+
+        CREATE TABLE staging.produtor (id INT PRIMARY KEY, email TEXT, nome_primeiro TEXT, nome_ultimo TEXT, id_fornecedor INT);
+        INSERT INTO staging.produtor
+        SELECT g, 'produtor' || g || '@zeta.com', 'Nome' || g, 'Sobrenome' || g %% 997, 1 + g %% %(fornecedores)s
+        FROM generate_series(1, %(produtores)s) g;
+
+        CREATE TABLE staging.modulo (id INT PRIMARY KEY, modulo TEXT);
+        INSERT INTO staging.modulo SELECT g, 'Módulo ' || g FROM generate_series(1, 20) g;
+
+        CREATE TABLE staging.aula (id INT PRIMARY KEY, nome TEXT, id_modulo INT);
+        INSERT INTO staging.aula SELECT g, 'Aula ' || g, 1 + g %% 20 FROM generate_series(1, %(aulas)s) g;
+
+        CREATE TABLE staging.texto_corrido (id INT PRIMARY KEY, texto_corrido TEXT, id_aula INT);
+        INSERT INTO staging.texto_corrido
+        SELECT g, repeat('Frase ' || g || ' sobre o manejo do rebanho, a sanidade e a vacinação dos bovinos. ', 8), 1 + (g - 1) / %(textos)s
+        FROM generate_series(1, %(aulas)s * %(textos)s) g;
+
+        CREATE TABLE staging.flash_card (id INT PRIMARY KEY, frente TEXT, verso TEXT, id_aula INT);
+        INSERT INTO staging.flash_card
+        SELECT g, 'Frente ' || g, 'Verso ' || g, 1 + (g - 1) / %(flashcards)s
+        FROM generate_series(1, %(aulas)s * %(flashcards)s) g;
+
+        CREATE TABLE staging.lei (id INT PRIMARY KEY, lei TEXT, id_aula INT);
+        INSERT INTO staging.lei
+        SELECT g, 'Lei ' || (1 + g %% 500) || '/' || (1990 + g %% 35), 1 + (g - 1) / %(leis)s
+        FROM generate_series(1, %(aulas)s * %(leis)s) g;
+
+        CREATE TABLE staging.atividade (id INT PRIMARY KEY, pontuacao NUMERIC, id_aula INT);
+        INSERT INTO staging.atividade SELECT g, 10, g FROM generate_series(1, %(aulas)s) g;
+
+        CREATE TABLE staging.pergunta (id INT PRIMARY KEY, pergunta TEXT, id_atividade INT);
+        INSERT INTO staging.pergunta
+        SELECT g, 'Pergunta ' || g || '?', 1 + (g - 1) / %(perguntas)s
+        FROM generate_series(1, %(aulas)s * %(perguntas)s) g;
+
+        CREATE TABLE staging.alternativa (id INT PRIMARY KEY, alternativa TEXT, correta BOOLEAN, id_atividade INT);
+        INSERT INTO staging.alternativa
+        SELECT g, 'Alternativa ' || g, g %% %(alternativas)s = 0, 1 + (g - 1) / %(alternativas)s
+        FROM generate_series(1, %(aulas)s * %(alternativas)s) g;
+
+        CREATE TABLE IF NOT EXISTS plans (id INT PRIMARY KEY, name TEXT, value NUMERIC);
+        CREATE TABLE IF NOT EXISTS segments (id INT PRIMARY KEY, name TEXT);
+        CREATE TABLE IF NOT EXISTS workers (
+            id INT PRIMARY KEY, email TEXT, name TEXT, company_id INT, created_at DATE, active BOOLEAN
+        );
+        TRUNCATE plans, segments, workers;
+        ANALYZE;
+        """, params)
+    conn.commit()
+
+# Altera uma fração das linhas do staging (produtores, textos e perguntas) para simular uma execução incremental
+def churn_staging(conn, fraction):
+    if fraction <= 0:
+        return
+    step = max(1, round(1 / fraction))
+    with conn.cursor() as cur:
+        cur.execute("""
+        UPDATE staging.produtor SET email = 'novo.' || email WHERE id %% %(step)s = 0;
+        UPDATE staging.texto_corrido SET texto_corrido = texto_corrido || ' Atualizado.' WHERE id %% %(step)s = 0;
+        UPDATE staging.pergunta SET pergunta = pergunta || ' (revisada)' WHERE id %% %(step)s = 0;
+        """, {"step": step})
+    conn.commit()
+
+# Banco MongoDB do benchmark: um MongoDB local (--mongo-url) ou o mongomock, em memória
+def bench_mongo(mongo_url=None):
+    if mongo_url:
+        from pymongo import MongoClient
+        db = MongoClient(mongo_url)["ZetaBench"]
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            print("mongomock não instalado e --mongo-url não informado: etapas do MongoDB serão puladas.")
+            return None
+        db = mongomock.MongoClient()["ZetaBench"]
+    db["activities"].drop()
+    db["classes"].drop()
+    return db
+
+# Pesquisa de lei simulada (sem navegador nem rede), com uma latência opcional por pesquisa
+def stub_law_search(latency):
+    @instrumented("search_law")
+    def fetch_law_pooled(law_number, pool, limiter, timings, session=None, form=None):
+        if latency:
+            time.sleep(latency)
+        return collect_data.LAW_FOUND, f"Descrição sintética da {law_number}"
+    return fetch_law_pooled
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-= BENCHMARK DAS ETAPAS -=-=-=-=-=-=-=-=-=-=-=-=-=
+# Executa uma etapa medindo o tempo, as linhas lidas/gravadas, as idas ao banco e o pico de memória (tracemalloc)
+def measure_stage(results, run, name, func):
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    with stage(f"bench.{name}") as stage_metrics:
+        func()
+    peak = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+    result = {"run": run, "stage": name, "seconds": stage_metrics.seconds, "peak_bytes": peak, **stage_metrics.counters}
+    results.append(result)
+    rate = result["rows_read"] / result["seconds"] if result["seconds"] else 0
+    peak_mb = f"{peak / 1024 / 1024:8.1f} MB" if peak is not None else "       -   "
+    print(
+        f"{run:<6} {name:<12} {result['seconds']:8.2f}s  lidas: {result['rows_read']:>9}  ({rate:>9.0f}/s)  "
+        f"gravadas: {result['rows_written']:>9}  idas: {result['round_trips']:>6}  pico: {peak_mb}"
+    )
+    return result
+
+# Gera o staging sintético e roda cada etapa do collect_data duas ou mais vezes: a primeira com os destinos
+# vazios ("fria") e as seguintes depois de alterar uma fração do staging ("churn")
+def bench_stages(postgres_url, scale, mongo_url=None, runs=2, churn=0.01, in_database=False, law_latency=0.0, memory=True):
+    conn = psycopg2.connect(postgres_url, cursor_factory=MetricsCursor)
+    db = bench_mongo(mongo_url)
+
+    # A pesquisa de leis é simulada: sem HTTP, sem navegador e sem intervalo entre as pesquisas
+    collect_data.LAW_HTTP_ENABLED = False
+    collect_data.fetch_law_pooled = stub_law_search(law_latency)
+    collect_data.resolve_laws = functools.partial(collect_data.resolve_laws, min_interval=0)
+
+    print(f"\nGerando o staging sintético: {scale}")
+    start = time.perf_counter()
+    create_synthetic_staging(conn, scale)
+    print(f"Staging gerado em {time.perf_counter() - start:.2f}s\n")
+
+    if memory:
+        tracemalloc.start()
+    results = []
+    law_descriptions = {}
+    try:
+        with conn.cursor() as cur:
+            for run in range(1, runs + 1):
+                run_label = "fria" if run == 1 else f"churn{run - 1}"
+                if run > 1:
+                    churn_staging(conn, churn)
+                measure_stage(results, run_label, "plans", lambda: collect_data.update_plans(cur, conn, in_database))
+                measure_stage(results, run_label, "segments", lambda: collect_data.update_segments(cur, conn, in_database))
+                measure_stage(results, run_label, "workers", lambda: collect_data.update_workers(cur, conn, in_database))
+                if db is None:
+                    continue
+                measure_stage(results, run_label, "activities", lambda: collect_data.update_activities(db["activities"], cur))
+                measure_stage(results, run_label, "laws", lambda: law_descriptions.update(collect_data.enrich_laws(cur)))
+                measure_stage(results, run_label, "classes", lambda: collect_data.update_classes(db["classes"], cur, law_descriptions=law_descriptions))
+    finally:
+        if memory:
+            tracemalloc.stop()
+        conn.close()
+    return results
+
+# Compara os resultados com uma linha de base salva antes (tempo e pico de memória de cada etapa)
+def compare_baseline(results, baseline):
+    base = {(r["run"], r["stage"]): r for r in baseline}
+    print("\nComparação com a linha de base (tempo / pico de memória):")
+    for result in results:
+        old = base.get((result["run"], result["stage"]))
+        if not old:
+            continue
+        time_delta = (result["seconds"] / old["seconds"] - 1) * 100 if old["seconds"] else 0
+        line = f"{result['run']:<6} {result['stage']:<12} {old['seconds']:8.2f}s -> {result['seconds']:8.2f}s ({time_delta:+6.1f}%)"
+        if result.get("peak_bytes") and old.get("peak_bytes"):
+            memory_delta = (result["peak_bytes"] / old["peak_bytes"] - 1) * 100
+            line += f"  memória {memory_delta:+6.1f}%"
+        print(line)
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-= NOTAS DA EXPO -=-=-=-=-=-=-=-=-=-=-=-=-=
+# Resolução dos critérios e montagem das notas como eram feitas antes (referência): upsert com RETURNING,
+# SELECT dos critérios que faltaram e, dentro do laço das notas, um SELECT (e talvez um INSERT) por critério fora do mapa
+def legacy_score_rows(cur, reviews, criteria_map):
+    unique_criteria = {}
+    for review in reviews:
+        for g in review.get("grades", []):
+            unique_criteria[g["name"]] = g.get("weight")
+    if cur is not None and unique_criteria:
+        upsert_query = """
+        INSERT INTO feedback.criteria (name, weight) VALUES %s
+        ON CONFLICT (name) DO UPDATE SET weight = EXCLUDED.weight
+        RETURNING id, name;
+        """
+        for cid, name in execute_values(cur, upsert_query, list(unique_criteria.items()), fetch=True):
+            criteria_map[name] = cid
+        missing = tuple(set(unique_criteria) - set(criteria_map))
+        if missing:
+            cur.execute("SELECT id, name FROM feedback.criteria WHERE name IN %s", (missing,))
+            for cid, name in cur.fetchall():
+                criteria_map[name] = cid
+
+    rows_to_insert = []
+    for review in reviews:
+        review_id = review.get("id")
+        for g in review.get("grades", []):
+            criteria_id = criteria_map.get(g["name"])
+            if criteria_id is None:
+                cur.execute("SELECT id FROM feedback.criteria WHERE name = %s", (g["name"],))
+                r = cur.fetchone()
+                if r:
+                    criteria_id = r[0]
+                else:
+                    cur.execute(
+                        "INSERT INTO feedback.criteria (name, weight) VALUES (%s, %s) RETURNING id",
+                        (g["name"], g.get("weight"))
+                    )
+                    criteria_id = cur.fetchone()[0]
+                criteria_map[g["name"]] = criteria_id
+            rows_to_insert.append((review_id, criteria_id, g.get("score")))
+    return rows_to_insert
+
+# Resolução dos critérios e montagem das notas atuais (uma página, como no write_page)
+def current_score_rows(cur, reviews, criteria_map):
+    if cur is not None:
+        expo_api.resolve_criteria(cur, reviews, criteria_map)
+    return expo_api.build_score_rows(reviews, criteria_map)
+
+# Compara a montagem das notas antiga com a atual em um payload sintético (avaliações do expo_stub),
+# página por página. Sem banco mede só a montagem (critérios já no mapa); com --postgres-url também
+# resolve os critérios no schema feedback do banco do benchmark, contando as idas ao banco.
+def bench_score_assembly(n_reviews, n_criteria, postgres_url=None):
+    print(f"\nNotas da Expo ({n_reviews} avaliações, {n_criteria} critérios por avaliação)")
+    reviews = [synthetic_review(1, i, n_criteria) for i in range(n_reviews)]
+    pages = [reviews[i:i + expo_api.PAGE_SIZE] for i in range(0, n_reviews, expo_api.PAGE_SIZE)]
+    approaches = (("antes (fallback no laço)", legacy_score_rows), ("depois (montagem pura)", current_score_rows))
+
+    def run(name, cur, criteria_map, builder):
+        with stage("bench.scores") as stage_metrics:
+            rows = [row for page in pages for row in builder(cur, page, criteria_map)]
+        print(f"{name:<28} notas: {len(rows):>10}  montagem: {stage_metrics.seconds:8.3f}s  idas: {stage_metrics.counters['round_trips']:>6}")
+        return rows
+
+    # Só a montagem: todos os critérios já resolvidos
+    criteria_map = {f"Criterion {c}": c + 1 for c in range(n_criteria)}
+    results = []
+    for name, builder in approaches:
+        results.append(run(name, None, criteria_map, builder))
+    print(f"Mesmo resultado: {results[0] == results[1]}")
+    if not postgres_url:
+        return
+
+    # Com o banco: o mapa começa vazio e cada abordagem roda em uma transação desfeita no final
+    print("\nCom a resolução dos critérios no banco:")
+    conn = psycopg2.connect(postgres_url, cursor_factory=MetricsCursor)
+    try:
+        with conn.cursor() as cur:
+            expo_api.create_tables(cur, conn)
+            for name, builder in approaches:
+                run(name, cur, {}, builder)
+                conn.rollback()
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    # Carrega as envs (BENCH_POSTGRES_URL e as URLs dos bancos do RPA, usadas na proteção)
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Benchmark da montagem dos documentos do MongoDB e das etapas do collect_data.")
+    parser.add_argument("--aulas", type=int, default=500)
+    parser.add_argument("--textos", type=int, default=10)
+    parser.add_argument("--flashcards", type=int, default=20)
+    parser.add_argument("--leis", type=int, default=5)
+    parser.add_argument("--perguntas", type=int, default=10)
+    parser.add_argument("--alternativas", type=int, default=4)
+    parser.add_argument("--corpus", type=int, default=20000, help="Textos do benchmark da divisão dos textos (0 pula)")
+    parser.add_argument("--repeticoes", type=int, default=5, help="Vezes que cada texto do corpus aparece seguido")
+    parser.add_argument("--avaliacoes", type=int, default=100000, help="Avaliações do payload sintético da Expo (0 pula)")
+    parser.add_argument("--criterios", type=int, default=8, help="Critérios por avaliação da Expo")
+
+    # Benchmark das etapas em um Postgres local com o staging sintético
+    parser.add_argument(
+        "--postgres-url", default=os.getenv("BENCH_POSTGRES_URL"),
+        help="Postgres descartável para o benchmark das etapas (o schema staging e as tabelas plans/segments/workers são recriados)"
+    )
+    parser.add_argument("--mongo-url", default=os.getenv("BENCH_MONGODB_URL"), help="MongoDB local (sem ele usa o mongomock)")
+    parser.add_argument("--produtores", type=int, default=10000)
+    parser.add_argument("--planos", type=int, default=50)
+    parser.add_argument("--cursos", type=int, default=200)
+    parser.add_argument("--runs", type=int, default=2, help="Execuções de cada etapa (a primeira com os destinos vazios)")
+    parser.add_argument("--churn", type=float, default=0.01, help="Fração do staging alterada antes de cada execução seguinte")
+    parser.add_argument("--in-database", action="store_true", help="Sincroniza as tabelas relacionais no próprio banco (IN_DATABASE)")
+    parser.add_argument("--law-latency", type=float, default=0.0, help="Latência simulada de cada pesquisa de lei (segundos)")
+    parser.add_argument("--no-memory", action="store_true", help="Não mede o pico de memória (o tracemalloc deixa tudo mais lento)")
+    parser.add_argument("--save-baseline", metavar="ARQUIVO", help="Salva os resultados das etapas em JSON")
+    parser.add_argument("--baseline", metavar="ARQUIVO", help="Compara os resultados das etapas com um JSON salvo antes")
+    args = parser.parse_args()
+
+    # Nunca roda nos bancos do RPA (as URLs deles normalmente estão no .env)
+    if args.postgres_url:
+        env = rpa_database(args.postgres_url)
+        if env:
+            parser.error(f"--postgres-url aponta para o banco do RPA em {env}; use um banco descartável")
+
+    bench_document_build(args.aulas, args.textos, args.flashcards, args.leis, args.perguntas, args.alternativas)
+    if args.corpus:
+        bench_split_text(args.corpus, args.repeticoes)
+
+    if args.avaliacoes:
+        bench_score_assembly(args.avaliacoes, args.criterios, args.postgres_url)
+
+    if args.postgres_url:
+        scale = {
+            "produtores": args.produtores, "planos": args.planos, "cursos": args.cursos, "aulas": args.aulas,
+            "textos": args.textos, "flashcards": args.flashcards, "leis": args.leis,
+            "perguntas": args.perguntas, "alternativas": args.alternativas
+        }
+        results = bench_stages(
+            args.postgres_url, scale, args.mongo_url, args.runs, args.churn,
+            args.in_database, args.law_latency, not args.no_memory
+        )
+        if args.baseline:
+            with open(args.baseline, encoding="utf-8") as baseline_file:
+                compare_baseline(results, json.load(baseline_file))
+        if args.save_baseline:
+            with open(args.save_baseline, "w", encoding="utf-8") as baseline_file:
+                json.dump(results, baseline_file, indent=2)
+    else:
+        print("\nInforme --postgres-url (ou BENCH_POSTGRES_URL) para rodar o benchmark das etapas.")
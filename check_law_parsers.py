@@ -0,0 +1,140 @@
+# Importações
+import os
+import sys
+import json
+from urllib.parse import urljoin
+
+from collect_data import (
+    LAW_SEARCH_URL, LAW_NUMBER_INPUT_XPATH, LAW_SEARCH_BUTTON_XPATH, LAW_FOUND, LAW_NOT_FOUND, LAW_ERROR,
+    LawPageParser, parse_law_search_form, parse_law_first_result, parse_law_no_results, parse_law_description,
+    fetch_law_http
+)
+
+# Verificação offline da pesquisa de leis por HTTP: roda os leitores do collect_data nas páginas de
+# fixtures/law_site (formulário de pesquisa, lista de resultados e página da lei) e compara com os
+# valores de expected.json. As páginas atuais foram escritas à mão seguindo os XPaths do Selenium, não
+# salvas do site: troque-as pelas páginas reais, atualize o expected.json e rode:
+#   python check_law_parsers.py
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-= CONFIGURAÇÕES -=-=-=-=-=-=-=-=-=-=-=-=-=
+# Pasta com as páginas e os valores esperados
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "law_site")
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-= PÁGINAS -=-=-=-=-=-=-=-=-=-=-=-=-=
+# Conteúdo de uma página da pasta
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), encoding="utf-8") as fixture_file:
+        return fixture_file.read()
+
+# Resposta HTTP com o conteúdo de uma página da pasta
+class FixtureResponse:
+    def __init__(self, url, text):
+        self.url = url
+        self.text = text
+
+    def raise_for_status(self):
+        pass
+
+# Sessão que responde com as páginas da pasta: a pesquisa devolve a página indicada (lista de resultados,
+# lista vazia ou outra) e qualquer outro endereço devolve a página da lei
+class FixtureSession:
+    def __init__(self, result_page):
+        self.result_page = result_page
+        self.requests = []
+
+    def get(self, url, params=None, timeout=None):
+        self.requests.append(("GET", url, params))
+        return FixtureResponse(url, load_fixture("law_page.html"))
+
+    def post(self, url, data=None, timeout=None):
+        self.requests.append(("POST", url, data))
+        return FixtureResponse(url, load_fixture(self.result_page))
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-= VERIFICAÇÕES -=-=-=-=-=-=-=-=-=-=-=-=-=
+# Formulário de pesquisa: ação, método, campos ocultos, checkboxes de tipo e campo do número
+def check_search_form(expected):
+    form = parse_law_search_form(load_fixture("search_page.html"))
+    if form is None:
+        return False, "formulário não encontrado"
+    form["checkboxes"] = {key: list(value) for key, value in form["checkboxes"].items()}
+    form["hidden"] = [list(field) for field in form["hidden"]]
+    if form != expected["search_form"]:
+        return False, f"lido {form}"
+    return True, f"{form['method'].upper()} {form['action']}, campo {form['number_field']}, {len(form['checkboxes'])} tipos"
+
+# Os XPaths do Selenium apontam para os mesmos elementos que o leitor HTTP usa
+def check_selenium_xpaths(expected):
+    parser = LawPageParser({"number": LAW_NUMBER_INPUT_XPATH, "button": LAW_SEARCH_BUTTON_XPATH})
+    parser.feed(load_fixture("search_page.html"))
+    number_field = parser.attr("number", "name")
+    button = parser.attr("button", "type")
+    if number_field != expected["search_form"]["number_field"] or button != "submit":
+        return False, f"campo do número {number_field!r}, botão {button!r}"
+    return True, "campo do número e botão de pesquisa encontrados"
+
+# Primeiro resultado da lista (e nenhum na lista vazia)
+def check_first_result(expected):
+    href = parse_law_first_result(load_fixture("result_list.html"))
+    empty = parse_law_first_result(load_fixture("result_list_empty.html"))
+    if href != expected["first_result"] or empty != expected["first_result_empty"]:
+        return False, f"lido {href!r} (lista vazia: {empty!r})"
+    return True, href
+
+# Aviso de pesquisa sem resultados: só na lista vazia (não na lista com resultados nem no formulário)
+def check_no_results(expected):
+    found = {name: parse_law_no_results(load_fixture(name)) for name in ("result_list_empty.html", "result_list.html", "search_page.html")}
+    if found != {"result_list_empty.html": True, "result_list.html": False, "search_page.html": False}:
+        return False, f"lido {found}"
+    return True, "aviso encontrado só na lista vazia"
+
+# Ementa da página da lei
+def check_description(expected):
+    description = parse_law_description(load_fixture("law_page.html"))
+    if description != expected["description"]:
+        return False, f"lido {description!r}"
+    return True, description
+
+# Pesquisa completa (fetch_law_http) com as páginas da pasta: lei encontrada, lei sem resultado e página não reconhecida
+def check_fetch(expected):
+    form = parse_law_search_form(load_fixture("search_page.html"))
+    form["url"] = urljoin(LAW_SEARCH_URL, form["action"])
+
+    session = FixtureSession("result_list.html")
+    result = fetch_law_http(expected["law_number"], session, form)
+    if result != (LAW_FOUND, expected["description"]):
+        return False, f"lei encontrada: {result}"
+    if session.requests[-1][1] != urljoin(form["url"], expected["first_result"]):
+        return False, f"abriu {session.requests[-1][1]}"
+
+    result = fetch_law_http(expected["law_number"], FixtureSession("result_list_empty.html"), form)
+    if result != (LAW_NOT_FOUND, None):
+        return False, f"lei sem resultado: {result}"
+
+    # Uma página que não é a lista de resultados (ex.: o formulário devolvido) é erro, para o navegador tentar
+    result = fetch_law_http(expected["law_number"], FixtureSession("search_page.html"), form)
+    if result != (LAW_ERROR, None):
+        return False, f"página não reconhecida: {result}"
+    return True, "lei encontrada, lei sem resultado e página não reconhecida"
+
+CHECKS = {
+    "formulário de pesquisa": check_search_form,
+    "XPaths do Selenium": check_selenium_xpaths,
+    "primeiro resultado": check_first_result,
+    "pesquisa sem resultados": check_no_results,
+    "ementa": check_description,
+    "pesquisa completa": check_fetch
+}
+
+if __name__ == "__main__":
+    with open(os.path.join(FIXTURES_DIR, "expected.json"), encoding="utf-8") as expected_file:
+        expected = json.load(expected_file)
+
+    failed = 0
+    for name, check in CHECKS.items():
+        try:
+            ok, detail = check(expected)
+        except Exception as e:
+            ok, detail = False, f"erro: {e}"
+        failed += not ok
+        print(f"{'OK  ' if ok else 'FALHOU'} {name}: {detail}")
+    sys.exit(1 if failed else 0)
@@ -1,71 +1,322 @@
 # Importações
 import psycopg2
-from pymongo import MongoClient
+from psycopg2.extras import execute_values
+from pymongo import MongoClient, InsertOne, ReplaceOne
+from pymongo.errors import BulkWriteError
 import os
 from dotenv import load_dotenv
 import re
+import json
+import hashlib
+import uuid
+import argparse
+import unicodedata
+import requests
+from html.parser import HTMLParser
+from urllib.parse import urljoin
 import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from decimal import Decimal
+from collections import OrderedDict
+from metrics import (
+    instrumented, report_counters, bind, instrument_session, write_prometheus,
+    MetricsCursor, MongoMetricsListener
+)
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
-from selenium.common.exceptions import NoSuchElementException, TimeoutException, ElementClickInterceptedException
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import TimeoutException, ElementClickInterceptedException
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-= CONFIGURAÇÕES -=-=-=-=-=-=-=-=-=-=-=-=-=
+# Quantidade de linhas enviadas por comando no execute_values
+BATCH_SIZE = 1000
+
+# Quantidade de linhas trazidas por vez dos cursores no servidor (leituras grandes do staging)
+ITERSIZE = 2000
+
+# Quantidade de operações enviadas por bulk_write no MongoDB
+MONGO_BATCH_SIZE = 500
+
+# Status das pesquisas de leis e por quantos dias cada um fica válido no cache
+LAW_FOUND = "found"
+LAW_NOT_FOUND = "not_found"
+LAW_ERROR = "error"
+LAW_CACHE_TTL_DAYS = {
+    LAW_FOUND: 180,
+    LAW_NOT_FOUND: 30,
+    LAW_ERROR: 1
+}
+
+# Site onde as leis são pesquisadas
+LAW_SEARCH_URL = "https://www.defesa.agricultura.sp.gov.br/legislacoes"
+
+# Quantidade máxima de navegadores abertos ao mesmo tempo e quantas pesquisas cada um faz antes de ser reciclado
+LAW_DRIVER_POOL_SIZE = 3
+LAW_DRIVER_MAX_USES = 50
+
+# Se True, as leis são pesquisadas primeiro por HTTP (sem navegador) e o Selenium só é usado se der erro.
+# Desligado até os leitores serem conferidos com páginas reais do site (as de fixtures/law_site são montadas à mão).
+LAW_HTTP_ENABLED = False
+LAW_HTTP_TIMEOUT = 15
+
+# Tempo máximo (em segundos) de espera por cada etapa da página e pela lista de resultados
+LAW_WAIT_TIMEOUT = 15
+LAW_RESULT_TIMEOUT = 5
+
+# Elementos da página de pesquisa de leis
+LAW_NUMBER_INPUT_XPATH = "/html/body/main/section[2]/div[2]/table/tbody/tr[1]/td/form/table[2]/tbody/tr[1]/td[2]/input"
+LAW_SEARCH_BUTTON_XPATH = "/html/body/main/section[2]/div[2]/table/tbody/tr[1]/td/form/table[2]/tbody/tr[5]/td/input"
+LAW_FIRST_RESULT_XPATH = "/html/body/main/section[2]/div[2]/ul[1]/li/p/a"
+LAW_DESCRIPTION_XPATH = "/html/body/main/section[2]/div[2]/p[2]"
+
+# Área de conteúdo da página de resultados e o aviso que o site mostra nela quando a pesquisa não tem resultados.
+# Na pesquisa por HTTP, uma lei só conta como não encontrada se esse aviso aparecer; qualquer outra página
+# sem resultado (formulário devolvido, sessão recusada, HTML diferente do esperado) é tratada como erro.
+LAW_RESULTS_XPATH = "/html/body/main/section[2]/div[2]"
+LAW_NO_RESULTS_MARKER = "Nenhum registro encontrado"
+
+# Intervalo mínimo (em segundos) entre o início de duas pesquisas no site de leis
+LAW_MIN_INTERVAL_SECONDS = 1.0
+
+# Se True, as tabelas relacionais são sincronizadas inteiramente dentro do Postgres (sem trazer linhas para o Python)
+IN_DATABASE = False
+
+# Tamanho máximo de cada parte dos textos do texto_corrido (campo content da collection classes)
+# e quantos textos já divididos ficam guardados em memória
+TEXT_CHUNK_MAX_LEN = 250
+TEXT_CHUNK_CACHE_SIZE = 4096
+
+# Fim de frase: espaços depois de ponto ou vírgula. A pontuação é capturada (e devolvida à frase) em vez
+# de usar um lookbehind, que é testado em cada posição do texto e deixa a divisão bem mais lenta.
+SENTENCE_BOUNDARY = re.compile(r'([.,])\s+')
 
 # -=-=-=-=-=-=-=-=-=-=-=-=-= FUNÇÕES -=-=-=-=-=-=-=-=-=-=-=-=-=
-# Atualiza a tabela plans
-def update_plans(cur, conn):
+# Imprime o resumo de uma sincronização (contagens e tempo)
+def print_sync_report(report, delete_label="Deletados"):
+    print(f"Inseridos: {report['inserted']}")
+    print(f"Atualizados: {report['updated']}")
+    print(f"Inalterados: {report['unchanged']}")
+    print(f"{delete_label}: {report['deleted']}")
+    print(f"Tempo: {report['seconds']:.2f}s")
+
+# Normaliza um valor para comparação (numeric do banco x float do Python)
+def normalize_value(value):
+    if isinstance(value, (float, Decimal)):
+        return Decimal(str(value))
+    return value
+
+# Cláusula do ON CONFLICT que só reescreve a linha quando algum valor mudou
+def build_update_clause(table, update_columns):
+    set_clause = ", ".join(f"{col} = EXCLUDED.{col}" for col in update_columns)
+    current = ", ".join(f"{table}.{col}" for col in update_columns)
+    excluded = ", ".join(f"EXCLUDED.{col}" for col in update_columns)
+    return f"DO UPDATE SET {set_clause} WHERE ({current}) IS DISTINCT FROM ({excluded})"
+
+# Lê o resultado de uma query com um cursor nomeado (no servidor), trazendo "itersize" linhas por vez,
+# para que a memória não cresça com o tamanho do resultado
+def iter_rows(conn, query, params=None, itersize=ITERSIZE):
+    with conn.cursor(name=f"rpa_{uuid.uuid4().hex}") as cur:
+        cur.itersize = itersize
+        cur.execute(query, params)
+        for row in cur:
+            yield row
+
+# Motor de sincronização em lote das tabelas relacionais:
+# consome as linhas da origem em streaming, compara com os valores atuais (dicionário id -> valores),
+# envia apenas as linhas novas ou alteradas com INSERT ... ON CONFLICT DO UPDATE em lotes de BATCH_SIZE
+# e faz tudo em uma única transação por tabela. A primeira coluna de "columns" deve ser o id.
+def sync_table(cur, conn, table, columns, rows, delete_query, template=None, insert_columns=None, delete_label="Deletados"):
+    start = time.perf_counter()
     try:
-        # Query para buscar as informações no staging
-        query_subscription = """ 
-        SELECT 
-            id, 
-            tp_plano, 
-            preco_fixo
-        FROM staging.assinatura;
+        # Valores atuais da tabela de destino
+        existing = {
+            row[0]: tuple(normalize_value(v) for v in row[1:])
+            for row in iter_rows(conn, f"SELECT {', '.join(columns)} FROM {table};")
+        }
+
+        upsert_query = f"""
+        INSERT INTO {table} ({", ".join(insert_columns or columns)})
+        VALUES %s
+        ON CONFLICT (id) {build_update_clause(table, columns[1:])};
         """
 
-        # Query para buscar as informações na tabela plans do segundo
-        query_plans = "SELECT * FROM plans;"
+        # Separa as linhas novas, alteradas e inalteradas e envia as que mudaram a cada lote
+        to_write = []
+        valid_ids = []
+        seen_ids = set()
+        inserted = updated = unchanged = 0
+        for row in rows:
+            # Ignora ids repetidos na origem (o ON CONFLICT não aceita o mesmo id duas vezes no mesmo comando)
+            if row[0] in seen_ids:
+                continue
+            seen_ids.add(row[0])
+            valid_ids.append(row[0])
+
+            current = existing.get(row[0])
+            if current is None:
+                inserted += 1
+                to_write.append(row)
+            elif current != tuple(normalize_value(v) for v in row[1:]):
+                updated += 1
+                to_write.append(row)
+            else:
+                unchanged += 1
 
-        # Executa no schema staging
-        cur.execute(query_subscription)
-        subscriptions = cur.fetchall()
+            if len(to_write) >= BATCH_SIZE:
+                execute_values(cur, upsert_query, to_write, template=template, page_size=BATCH_SIZE)
+                to_write = []
 
-        # Executa na tabela plans
-        cur.execute(query_plans)
-        plans = cur.fetchall()
+        if to_write:
+            execute_values(cur, upsert_query, to_write, template=template, page_size=BATCH_SIZE)
 
-        # Deleta os registros que não estão na tabela de origem
-        valid_ids = [sub[0] for sub in subscriptions]
+        # Deleta (ou desativa) os registros que não estão na tabela de origem
+        deleted = 0
         if valid_ids:
-            delete_query = "DELETE FROM plans WHERE id NOT IN %s;"
-            cur.execute(delete_query, (tuple(valid_ids),))
-            conn.commit()
+            cur.execute(delete_query, (valid_ids,))
+            deleted = cur.rowcount
         else:
             print("Nenhuma deleção realizada.")
 
-        # Atualiza ou insere os registros na tabela 'plans'
-        for id_subscription, subscription, price in subscriptions:
-            price_clean = float(price.replace("$", "").replace(",", "").strip()) # tirar o "$" do valor do preço da tabela de origem
+        # Um único commit por tabela
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    report = {
+        "table": table,
+        "inserted": inserted,
+        "updated": updated,
+        "unchanged": unchanged,
+        "deleted": deleted,
+        "seconds": time.perf_counter() - start
+    }
+    print_sync_report(report, delete_label)
+    return report
+
+# Sincronização feita inteiramente no Postgres (staging e destino estão no mesmo banco):
+# executa a remoção/desativação e o INSERT ... SELECT ... ON CONFLICT em uma única transação,
+# reescrevendo apenas as linhas que mudaram. Só as contagens voltam para o Python.
+def merge_table(cur, conn, table, insert_columns, update_columns, source_query, delete_query, delete_label="Deletados"):
+    start = time.perf_counter()
+    merge_query = f"""
+    WITH source AS (
+        {source_query}
+    ),
+    upsert AS (
+        INSERT INTO {table} ({", ".join(insert_columns)})
+        SELECT * FROM source
+        ON CONFLICT (id) {build_update_clause(table, update_columns)}
+        RETURNING (xmax = 0) AS inserted
+    )
+    SELECT
+        count(*) FILTER (WHERE inserted),
+        count(*) FILTER (WHERE NOT inserted),
+        (SELECT count(*) FROM source)
+    FROM upsert;
+    """
+    try:
+        # Deleta (ou desativa) os registros que não estão na tabela de origem
+        cur.execute(delete_query)
+        deleted = cur.rowcount
+
+        # Insere ou atualiza os registros e busca apenas as contagens
+        cur.execute(merge_query)
+        inserted, updated, total = cur.fetchone()
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    report = {
+        "table": table,
+        "inserted": inserted,
+        "updated": updated,
+        "unchanged": total - inserted - updated,
+        "deleted": deleted,
+        "seconds": time.perf_counter() - start
+    }
+    print_sync_report(report, delete_label)
+    return report
+
+# Converte o preço da origem ("$1,234.00") para número
+def clean_price(price):
+    return float(price.replace("$", "").replace(",", "").strip())
+
+# Atualiza a tabela plans
+@instrumented("update_plans", counters=report_counters, fail_on_none=True)
+def update_plans(cur, conn, in_database=False):
+    try:
+        if in_database:
+            # Limpeza do preço ("$1,234.00" -> 1234.00) feita no próprio SQL
+            source_query = """
+            SELECT
+                id,
+                tp_plano,
+                trim(replace(replace(preco_fixo::text, '$', ''), ',', ''))::numeric
+            FROM staging.assinatura
+            """
+            # Só deleta se a origem tiver registros (mesmo comportamento do modo Python)
+            delete_query = """
+            DELETE FROM plans pl
+            WHERE NOT EXISTS (SELECT 1 FROM staging.assinatura s WHERE s.id = pl.id)
+              AND EXISTS (SELECT 1 FROM staging.assinatura);
+            """
+            report = merge_table(
+                cur, conn, "plans", ("id", "name", "value"), ("name", "value"), source_query, delete_query
+            )
+            print("Tabela 'plans' atualizada com sucesso!")
+            return report
 
-            exist_ids = [plan[0] for plan in plans] # pega os ids da tabela 'plans'
+        # Query para buscar as informações no staging
+        query_subscription = """ 
+        SELECT 
+            id, 
+            tp_plano, 
+            preco_fixo
+        FROM staging.assinatura;
+        """
 
-            if id_subscription in exist_ids:
-                update_query = "UPDATE plans SET name = %s, value = %s WHERE id = %s;"
-                cur.execute(update_query, (subscription, price_clean, id_subscription))
-            
-            else:
-                insert_query = "INSERT INTO plans (id, name, value) VALUES (%s, %s, %s);"
-                cur.execute(insert_query, (id_subscription, subscription, price_clean))
-                
-            conn.commit()
+        # Lê o schema staging em streaming
+        subscriptions = (
+            (id_subscription, subscription, clean_price(price)) # tirar o "$" do valor do preço da tabela de origem
+            for id_subscription, subscription, price in iter_rows(conn, query_subscription)
+        )
+
+        # Atualiza ou insere os registros na tabela 'plans' e deleta os que não estão na origem
+        report = sync_table(
+            cur, conn, "plans", ("id", "name", "value"), subscriptions,
+            "DELETE FROM plans WHERE id <> ALL(%s);"
+        )
         print("Tabela 'plans' atualizada com sucesso!")
+        return report
     except Exception as e:
         print(f"Erro ao atualizar a tabela 'plans': {e}")
 
 # Atualiza a tabela segments
-def update_segments(cur, conn):
+@instrumented("update_segments", counters=report_counters, fail_on_none=True)
+def update_segments(cur, conn, in_database=False):
     try:
+        if in_database:
+            source_query = "SELECT id, nome FROM staging.curso"
+            delete_query = """
+            DELETE FROM segments sg
+            WHERE NOT EXISTS (SELECT 1 FROM staging.curso c WHERE c.id = sg.id)
+              AND EXISTS (SELECT 1 FROM staging.curso);
+            """
+            report = merge_table(
+                cur, conn, "segments", ("id", "name"), ("name",), source_query, delete_query
+            )
+            print("Tabela 'segments' atualizada com sucesso!")
+            return report
+
         # Query para buscar as informações no staging
         query_course = """ 
         SELECT 
@@ -74,47 +325,53 @@ def update_segments(cur, conn):
         FROM staging.curso;
         """
 
-        # Query para buscar as informações na tabela segments do segundo
-        query_segments = "SELECT * FROM segments;"
+        # Lê o schema staging em streaming
+        segments = iter_rows(conn, query_course)
 
-        # Executa no schema staging
-        cur.execute(query_course)
-        segments = cur.fetchall()
-
-        # Executa na tabela segments
-        cur.execute(query_segments)
-        existing_segments = cur.fetchall()
-
-        # Deleta os registros que não estão na tabela de origem
-        valid_ids = [seg[0] for seg in segments]
-        if valid_ids:
-            delete_query = "DELETE FROM segments WHERE id NOT IN %s;"
-            cur.execute(delete_query, (tuple(valid_ids),))
-            conn.commit()
-        else:
-            print("Nenhuma deleção realizada.")
-
-        # Atualiza ou insere os registros na tabela 'segments'
-        for id_segment, segment_name in segments:
-
-            exist_ids = [seg[0] for seg in existing_segments] # pega os ids da tabela 'segments'
-
-            if id_segment in exist_ids:
-                update_query = "UPDATE segments SET name = %s WHERE id = %s;"
-                cur.execute(update_query, (segment_name, id_segment))
-            
-            else:
-                insert_query = "INSERT INTO segments (id, name) VALUES (%s, %s);"
-                cur.execute(insert_query, (id_segment, segment_name))
-                
-            conn.commit()
+        # Atualiza ou insere os registros na tabela 'segments' e deleta os que não estão na origem
+        report = sync_table(
+            cur, conn, "segments", ("id", "name"), segments,
+            "DELETE FROM segments WHERE id <> ALL(%s);"
+        )
         print("Tabela 'segments' atualizada com sucesso!")
+        return report
     except Exception as e:
         print(f"Erro ao atualizar a tabela 'segments': {e}")
 
 # Atualiza a tabela workers
-def update_workers(cur, conn):
+@instrumented("update_workers", counters=report_counters, fail_on_none=True)
+def update_workers(cur, conn, in_database=False):
     try:
+        if in_database:
+            # created_at e active só são preenchidos na inserção
+            source_query = """
+            SELECT
+                p.id,
+                p.email,
+                p.nome_primeiro||' '||p.nome_ultimo,
+                f.id_empresa,
+                CURRENT_DATE,
+                true
+            FROM staging.produtor p
+            JOIN staging.fornecedor f ON p.id_fornecedor = f.id
+            """
+            delete_query = """
+            UPDATE workers w SET active = false
+            WHERE w.active IS DISTINCT FROM false
+              AND NOT EXISTS (
+                SELECT 1 FROM staging.produtor p
+                JOIN staging.fornecedor f ON p.id_fornecedor = f.id
+                WHERE p.id = w.id
+            )
+              AND EXISTS (SELECT 1 FROM staging.produtor p JOIN staging.fornecedor f ON p.id_fornecedor = f.id);
+            """
+            report = merge_table(
+                cur, conn, "workers", ("id", "email", "name", "company_id", "created_at", "active"),
+                ("email", "name", "company_id"), source_query, delete_query, delete_label="Desativados"
+            )
+            print("Tabela 'workers' atualizada com sucesso!")
+            return report
+
         # Query para buscar as informações no staging
         query_worker = """ 
         SELECT
@@ -126,390 +383,937 @@ def update_workers(cur, conn):
         JOIN staging.fornecedor f ON p.id_fornecedor = f.id;
         """
 
-        # Query para buscar as informações na tabela workers do segundo
-        query_workers = "SELECT id, email, name, company_id FROM workers;"
-
-        # Executa no schema staging
-        cur.execute(query_worker)
-        workers = cur.fetchall()
-
-        # Executa na tabela workers
-        cur.execute(query_workers)
-        existing_workers = cur.fetchall()
-
-        # Deleta os registros que não estão na tabela de origem
-        valid_ids = [w[0] for w in workers]
-        if valid_ids:
-            delete_query = "UPDATE workers SET active = false WHERE id NOT IN %s;"
-            cur.execute(delete_query, (tuple(valid_ids),))
-            conn.commit()
-        else:
-            print("Nenhuma usuário foi desativado.")
-
-        # Atualiza ou insere os registros na tabela 'workers'
-        for id_worker, worker_email, worker_name, company_id in workers:
-
-            exist_ids = [w[0] for w in existing_workers] # pega os ids da tabela 'workers'
-
-            if id_worker in exist_ids:
-                update_query = "UPDATE workers SET name = %s, email = %s, company_id = %s WHERE id = %s;"
-                cur.execute(update_query, (worker_name, worker_email, company_id, id_worker))
-            
-            else:
-                insert_query = "INSERT INTO workers (id, email, name, company_id, created_at, active) VALUES (%s, %s, %s, %s, (SELECT CURRENT_DATE), true);"
-                cur.execute(insert_query, (id_worker, worker_email, worker_name, company_id))
-                
-            conn.commit()
+        # Lê o schema staging em streaming
+        workers = iter_rows(conn, query_worker)
+
+        # Atualiza ou insere os registros na tabela 'workers' e desativa os que não estão na origem
+        # (created_at e active só são preenchidos na inserção)
+        report = sync_table(
+            cur, conn, "workers", ("id", "email", "name", "company_id"), workers,
+            "UPDATE workers SET active = false WHERE id <> ALL(%s) AND active IS DISTINCT FROM false;",
+            template="(%s, %s, %s, %s, CURRENT_DATE, true)",
+            insert_columns=("id", "email", "name", "company_id", "created_at", "active"),
+            delete_label="Desativados"
+        )
         print("Tabela 'workers' atualizada com sucesso!")
+        return report
     except Exception as e:
         print(f"Erro ao atualizar tabela 'workers': {e}")
     
+# Envia as operações para o MongoDB em lotes com bulk_write não ordenado.
+# Um erro em um lote é reportado e os demais lotes continuam sendo enviados.
+def bulk_write_batches(coll, operations, batch_size=MONGO_BATCH_SIZE):
+    inserted = 0
+    updated = 0
+    errors = 0
+    for start in range(0, len(operations), batch_size):
+        batch = operations[start:start + batch_size]
+        try:
+            result = coll.bulk_write(batch, ordered=False)
+            inserted += result.inserted_count
+            updated += result.modified_count
+        except BulkWriteError as e:
+            # As operações que deram certo no lote continuam valendo
+            inserted += e.details.get("nInserted", 0)
+            updated += e.details.get("nModified", 0)
+            write_errors = e.details.get("writeErrors", [])
+            errors += len(write_errors)
+            print(f"Erro no lote {start // batch_size + 1} da collection '{coll.name}': {len(write_errors)} operações falharam.")
+            for error in write_errors[:5]:
+                print(f" - {error.get('errmsg')}")
+        except Exception as e:
+            errors += len(batch)
+            print(f"Erro no lote {start // batch_size + 1} da collection '{coll.name}': {e}")
+    return inserted, updated, errors
+
+# Gera a impressão digital (hash) do conteúdo de um documento em formato canônico (chaves ordenadas)
+def document_fingerprint(doc):
+    content = {key: value for key, value in doc.items() if key != "fingerprint"}
+    canonical = json.dumps(content, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+# Sincroniza uma collection do MongoDB com os documentos montados a partir do staging:
+# compara apenas o campo "fingerprint" dos documentos existentes e envia as operações com bulk_write
+# a cada "batch_size" documentos alterados, consumindo os documentos em streaming (qualquer iterável)
+def sync_collection(coll, documents, batch_size=MONGO_BATCH_SIZE):
+    start = time.perf_counter()
+
+    # Fingerprints atuais da collection (uma única leitura, só _id e fingerprint)
+    existing = {doc["_id"]: doc.get("fingerprint") for doc in coll.find({}, {"_id": 1, "fingerprint": 1})}
+
+    # Insere se não existir e substitui apenas se o fingerprint mudou
+    operations = []
+    valid_ids = set()
+    inserted = updated = unchanged = errors = 0
+    for data in documents:
+        doc_id = data["_id"]
+        valid_ids.add(doc_id)
+        data["fingerprint"] = document_fingerprint(data)
+        if doc_id not in existing:
+            operations.append(InsertOne(data))
+        elif existing[doc_id] != data["fingerprint"]:
+            operations.append(ReplaceOne({"_id": doc_id}, data))
+        else:
+            unchanged += 1
+
+        if len(operations) >= batch_size:
+            batch_inserted, batch_updated, batch_errors = bulk_write_batches(coll, operations, batch_size)
+            inserted += batch_inserted
+            updated += batch_updated
+            errors += batch_errors
+            operations = []
+
+    batch_inserted, batch_updated, batch_errors = bulk_write_batches(coll, operations, batch_size)
+    inserted += batch_inserted
+    updated += batch_updated
+    errors += batch_errors
+
+    # Deleta os documentos que não estão mais no postgres
+    to_delete = existing.keys() - valid_ids
+    deleted = 0
+    if to_delete:
+        result = coll.delete_many({"_id": {"$in": list(to_delete)}})
+        deleted = result.deleted_count
+
+    report = {
+        "collection": coll.name,
+        "inserted": inserted,
+        "updated": updated,
+        "unchanged": unchanged,
+        "deleted": deleted,
+        "errors": errors,
+        "seconds": time.perf_counter() - start
+    }
+    print_sync_report(report)
+    if errors:
+        print(f"Erros: {errors}")
+    return report
+
+# Monta os documentos da collection activities a partir das linhas do staging (uma linha por atividade,
+# com as perguntas e as alternativas já agregadas em JSON). É um gerador: cada atividade é devolvida assim que lida.
+def build_activities(rows):
+    for activity_id, points, class_id, questions, answers in rows:
+        answers = [{"answer": a["answer"], "correct": a["correct"]} for a in answers or []]
+        yield {
+            "_id": activity_id,
+            "class_id": class_id,
+            "points": float(points) if points is not None else 0,
+            # as alternativas são ligadas à atividade (alternativa.id_atividade), então cada pergunta recebe todas elas
+            "questions": [
+                {"question": q["question"], "answers": list(answers)}
+                for q in questions or []
+            ]
+        }
+
 # Atualiza a collection activities no MongoDB
+@instrumented("update_activities", counters=report_counters, fail_on_none=True)
 def update_activities(coll_activities, cur):
     try:
-        # Busca o id da atividade, pontuação, id da aula, perguntas e as alternativas no postgres
+        # Busca as atividades com as perguntas e as alternativas agregadas (uma linha por atividade,
+        # sem o produto cartesiano pergunta x alternativa)
         query = """
         SELECT 
             a.id AS atividade_id,
             a.pontuacao,
             a.id_aula AS class_id,
-            p.id AS pergunta_id,
-            p.pergunta,
-            alt.id AS alternativa_id,
-            alt.alternativa,
-            alt.correta
+            (
+                SELECT json_agg(json_build_object('id', p.id, 'question', p.pergunta) ORDER BY p.id)
+                FROM staging.pergunta p
+                WHERE p.id_atividade = a.id
+            ) AS perguntas,
+            (
+                SELECT json_agg(json_build_object('answer', alt.alternativa, 'correct', alt.correta) ORDER BY alt.id)
+                FROM staging.alternativa alt
+                WHERE alt.id_atividade = a.id AND alt.alternativa <> ''
+            ) AS alternativas
         FROM staging.atividade a
-        LEFT JOIN staging.pergunta p ON p.id_atividade = a.id
-        LEFT JOIN staging.alternativa alt ON alt.id_atividade = a.id
-        ORDER BY a.id, p.id, alt.id;
+        ORDER BY a.id;
         """
-        cur.execute(query)
-        rows = cur.fetchall()
-
-        # Monta a estrutura agrupada
-        activities = {}
-        for r in rows:
-            activity_id, points, class_id, question_id, question, alternative_id, alternative, correct = r
-
-            # Se o id da atividade não estiver no dicionário
-            if activity_id not in activities:
-                activities[activity_id] = {
-                    "_id": activity_id,
-                    "class_id": class_id,
-                   "points": float(points) if points is not None else 0,
-                    "questions": {}
-                }
-            
-            # Pula perguntas sme id
-            if not question_id:
-                continue
-
-            # Se as perguntas e seus ids não estiverem no dicionário
-            if question_id not in activities[activity_id]["questions"]:
-                activities[activity_id]["questions"][question_id] = {
-                    "question": question,
-                    "answers": []
-                }
-
-            # adiciona alternativas
-            if alternative:
-                activities[activity_id]["questions"][question_id]["answers"].append({
-                    "answer": alternative,
-                    "correct": correct
-                })
-
-        # Converte questions de dict para lista
-        for activity in activities.values():
-            activity["questions"] = list(activity["questions"].values())
-
-        # Atualiza o mongo
-        existing_docs = list(coll_activities.find({}, {"_id": 1}))
-        existing_ids = {doc["_id"] for doc in existing_docs}
-        valid_ids = set(activities.keys())
-
-        # Insere se não existir e atualiza se for necessário
-        inserted = 0
-        updated = 0
-        for atividade_id, data in activities.items():
-            try:
-                existing = coll_activities.find_one({"_id": atividade_id})
-                if not existing: # se não existir, ele insere
-                    coll_activities.insert_one(data)
-                    inserted += 1
-                    print(f"Atividade {atividade_id} inserida.")
-                else: # verificar se precisa atualizar
-                    if existing != data:
-                        coll_activities.replace_one({"_id": atividade_id}, data)
-                        updated += 1
-                        print("Atividade {atividade_id} atualizada.")
-            except Exception as e:
-                print(f"Erro ao processar atividade {atividade_id}: {e}")
 
-        # Deleta os documentos que não estão mais no postgres
-        to_delete = existing_ids - valid_ids
-        deleted = 0
-        if to_delete:
-            result = coll_activities.delete_many({"_id": {"$in": list(to_delete)}})
-            deleted = result.deleted_count
-            print(f"Total de atividades deletadas: {deleted}")
-
-        # Resumo geral
+        # Lê as linhas em streaming, monta cada atividade e envia ao mongo em lotes
+        activities = build_activities(iter_rows(cur.connection, query))
+        report = sync_collection(coll_activities, activities)
         print("Collection activities sincronizada com sucesso!")
-        print(f"Inseridos: {inserted}")
-        print(f"Atualizados: {updated}")
-        print(f"Deletados: {deleted}")
-    
+        return report
+
     except Exception as e:
         print(f"Erro ao sincronizar atividades: {e}")
 
-# Ajuda ao dividir o texto text_corrido da tabela texto_corrido em partes menores para o campo content (na collection classes)
-def split_text(text, max_len=250):
-            sentences = re.split(r'(?<=[.,])\s+', text)
-            parts = []
-            current = ""
-
-            for sentence in sentences:
-                if len(current) + len(sentence) + 1 > max_len:
-                    parts.append(current.strip())
-                    current = sentence
-                else:
-                    current += " " + sentence
-
-            if current:
-                parts.append(current.strip())
+# Quebra uma frase maior que max_len em pedaços de até max_len, de preferência nos espaços entre as palavras
+def split_long_sentence(sentence, max_len):
+    pieces = []
+    while len(sentence) > max_len:
+        cut = sentence.rfind(" ", 1, max_len + 1)
+        if cut == -1:
+            cut = max_len
+        pieces.append(sentence[:cut].rstrip())
+        sentence = sentence[cut:].lstrip()
+    if sentence:
+        pieces.append(sentence)
+    return pieces
+
+# Divide um texto do texto_corrido em partes de até max_len, juntando frases inteiras (frases maiores que
+# max_len são quebradas). Retorna uma tupla, que pode ser compartilhada sem risco de ser alterada.
+def divide_text(text, max_len=TEXT_CHUNK_MAX_LEN):
+    parts = []
+    current = []
+    # Tamanho contado como na versão anterior (a primeira parte com um espaço a mais),
+    # para as partes dos textos já sincronizados não mudarem
+    size = 0
+    pieces = SENTENCE_BOUNDARY.split(text)
+    sentences = [sentence + mark for sentence, mark in zip(pieces[::2], pieces[1::2])]
+    sentences.append(pieces[-1])
+    if any(len(sentence) > max_len for sentence in sentences):
+        sentences = [
+            piece for sentence in sentences
+            for piece in (split_long_sentence(sentence, max_len) if len(sentence) > max_len else (sentence,))
+        ]
+    for sentence in sentences:
+        length = len(sentence)
+        if not length:
+            continue
+        if current and size + length + 1 > max_len:
+            parts.append(" ".join(current).strip())
+            current = [sentence]
+            size = length
+        else:
+            current.append(sentence)
+            size += length + 1
+    if current:
+        parts.append(" ".join(current).strip())
+    return tuple(part for part in parts if part)
+
+# Partes dos textos já divididos, na ordem de uso (LRU): {(digest do texto, max_len): partes}.
+# A chave é o digest, então o cache guarda só as partes, e não uma cópia de cada texto.
+TEXT_CHUNK_CACHE = OrderedDict()
+TEXT_CHUNK_CACHE_STATS = {"hits": 0, "misses": 0}
+TEXT_CHUNK_CACHE_LOCK = threading.Lock()
+
+# Divide o texto como o divide_text, guardando o resultado dos últimos TEXT_CHUNK_CACHE_SIZE textos
+# para o mesmo texto não ser dividido de novo
+def chunk_text(text, max_len=TEXT_CHUNK_MAX_LEN):
+    key = (hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest(), max_len)
+    with TEXT_CHUNK_CACHE_LOCK:
+        parts = TEXT_CHUNK_CACHE.get(key)
+        if parts is not None:
+            TEXT_CHUNK_CACHE.move_to_end(key)
+            TEXT_CHUNK_CACHE_STATS["hits"] += 1
             return parts
+    parts = divide_text(text, max_len)
+    with TEXT_CHUNK_CACHE_LOCK:
+        TEXT_CHUNK_CACHE[key] = parts
+        TEXT_CHUNK_CACHE_STATS["misses"] += 1
+        if len(TEXT_CHUNK_CACHE) > TEXT_CHUNK_CACHE_SIZE:
+            TEXT_CHUNK_CACHE.popitem(last=False)
+    return parts
+
+# Esvazia o cache das partes dos textos e zera as contagens
+def clear_text_chunk_cache():
+    with TEXT_CHUNK_CACHE_LOCK:
+        TEXT_CHUNK_CACHE.clear()
+        TEXT_CHUNK_CACHE_STATS.update(hits=0, misses=0)
 
-# Com base na lei recebida do banco, pesquisa no site da defesa agropecuária de São Paulo
-def search_law(law_number: str):
+# Ajuda ao dividir o texto text_corrido da tabela texto_corrido em partes menores para o campo content (na collection classes)
+def split_text(text, max_len=TEXT_CHUNK_MAX_LEN):
+    return list(chunk_text(text, max_len))
+
+# Divide vários textos de uma vez (ex.: os textos de uma aula ou todos os textos de uma execução);
+# textos repetidos são divididos uma única vez. Retorna {texto: partes}, na ordem dos textos.
+def split_texts(texts, max_len=TEXT_CHUNK_MAX_LEN):
+    return {text: chunk_text(text, max_len) for text in dict.fromkeys(texts) if text}
+
+# Abre um Chrome headless
+def create_driver():
+    chrome_options = Options()
+    chrome_options.add_argument("--headless=new")
+    return webdriver.Chrome(options=chrome_options)
+
+# Pool de navegadores reutilizados entre as pesquisas de leis.
+# Os navegadores são abertos sob demanda (até "size"), reciclados depois de "max_uses" pesquisas
+# ou quando dão erro, e todos são fechados ao sair do bloco "with".
+class DriverPool:
+    def __init__(self, size=LAW_DRIVER_POOL_SIZE, max_uses=LAW_DRIVER_MAX_USES):
+        self.size = size
+        self.max_uses = max_uses
+        self._idle = queue.Queue()
+        self._slots = threading.Semaphore(size)
+        self._uses = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # Pega um navegador livre (ou abre um novo se ainda houver vaga no pool)
+    def acquire(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            driver = create_driver()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._uses[driver] = 0
+        return driver
+
+    # Devolve o navegador ao pool; se quebrou ou atingiu o limite de usos, fecha e libera a vaga
+    def release(self, driver, broken=False):
+        with self._lock:
+            self._uses[driver] += 1
+            recycle = broken or self._uses[driver] >= self.max_uses
+            if recycle:
+                self._uses.pop(driver)
+        if recycle:
+            self._quit(driver)
+        else:
+            self._idle.put(driver)
+        self._slots.release()
+
+    # Fecha todos os navegadores abertos
+    def close(self):
+        with self._lock:
+            drivers = list(self._uses)
+            self._uses.clear()
+        for driver in drivers:
+            self._quit(driver)
+        self._idle = queue.Queue()
+
+    @staticmethod
+    def _quit(driver):
+        try:
+            driver.quit()
+        except Exception as e:
+            print(f"Erro ao fechar o navegador: {e}")
+
+# Retorna o id do checkbox do tipo da lei na página de pesquisa (ou None se o tipo não for reconhecido)
+def law_type_id(law_number):
+    law_lower = law_number.lower()
+    if "decreto" in law_lower:
+        return "id_tipo_leg[]_1"
+    elif "lei complementar" in law_lower:
+        return "id_tipo_leg[]_4"
+    elif "lei" in law_lower:
+        return "id_tipo_leg[]_5"
+    elif "instrução normativa" in law_lower or "in " in law_lower:
+        return "id_tipo_leg[]_2"
+    elif "portaria" in law_lower:
+        return "id_tipo_leg[]_6"
+    elif "nota técnica" in law_lower:
+        return "id_tipo_leg[]_8"
+    elif "resolução" in law_lower:
+        return "id_tipo_leg[]_7"
+    return None
+
+# Expressão regular para pegar número e ano da lei ("Lei 1.234/2020" -> ("1.234", "2020"))
+def parse_law_number(law_number):
+    match = re.search(r'([\d\.]+)\s*/\s*(\d{4})', law_number)
+    if not match:
+        return None, None
+    return match.group(1), match.group(2)
+
+# Mede o tempo de uma etapa da pesquisa e acumula em "timings" ({etapa: segundos})
+@contextmanager
+def timed_step(timings, step):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[step] = timings.get(step, 0.0) + time.perf_counter() - start
+
+# Com base na lei recebida do banco, pesquisa no site da defesa agropecuária de São Paulo.
+# Retorna (status, descrição), onde status é "found", "not_found" ou "error"
+# Se "driver" não for informado, abre um navegador só para essa pesquisa e fecha no final.
+# Cada etapa espera apenas até a condição da página ser atendida (até LAW_WAIT_TIMEOUT segundos)
+# e o tempo gasto em cada uma é acumulado em "timings".
+def fetch_law(law_number: str, driver=None, timings=None):
+    # Verifica cada categoria de leis
+    type_id = law_type_id(law_number)
+    number, _ = parse_law_number(law_number)
+
+    # caso type_id esteja vazio ou não tenha número/ano
+    if not type_id or not number:
+        return LAW_NOT_FOUND, None
+
+    own_driver = driver is None
     try:
-        chrome_options = Options()
-        chrome_options.add_argument("--headless=new")
-
         # Conecta ao site da Câmara (para buscar as leis)
-        driver = webdriver.Chrome(options=chrome_options)
-        driver.get("https://www.defesa.agricultura.sp.gov.br/legislacoes")
-        time.sleep(2)
-
-        # Verifica cada categoria de leis
-        type_id = None
-        if "decreto" in law_number.lower():
-            type_id = "id_tipo_leg[]_1"
-        elif "lei complementar" in law_number.lower():
-            type_id = "id_tipo_leg[]_4"
-        elif "lei" in law_number.lower():
-            type_id = "id_tipo_leg[]_5"
-        elif "instrução normativa" in law_number.lower() or "in " in law_number.lower():
-            type_id = "id_tipo_leg[]_2"
-        elif "portaria" in law_number.lower():
-            type_id = "id_tipo_leg[]_6"
-        elif "nota técnica" in law_number.lower():
-            type_id = "id_tipo_leg[]_8"
-        elif "resolução" in law_number.lower():
-            type_id = "id_tipo_leg[]_7"
-
-        # caso type_id esteja vazio
-        if not type_id:
-            return None
+        with timed_step(timings, "open_page"):
+            if own_driver:
+                driver = create_driver()
+            driver.get(LAW_SEARCH_URL)
+            wait = WebDriverWait(driver, LAW_WAIT_TIMEOUT)
 
         try:
-            # Se não estiver vazio, clica na opção correspondente da página
-            driver.find_element(By.ID, type_id).click()
-        except NoSuchElementException:
-            return None
-        
-        # Expressão regular para pegar número e ano
-        match = re.search(r'([\d\.]+)\s*/\s*(\d{4})', law_number)
-        if match:
-            law_number = match.group(1)
-            law_year = match.group(2)
+            # Clica na opção correspondente ao tipo da lei
+            with timed_step(timings, "select_type"):
+                wait.until(EC.element_to_be_clickable((By.ID, type_id))).click()
+
+            # Preenche o número da lei
+            with timed_step(timings, "fill_number"):
+                number_box = wait.until(EC.visibility_of_element_located((By.XPATH, LAW_NUMBER_INPUT_XPATH)))
+                number_box.send_keys(number)
+
+            # Clica no botão de buscar e espera a página de resultados carregar
+            with timed_step(timings, "submit"):
+                search_button = wait.until(EC.element_to_be_clickable((By.XPATH, LAW_SEARCH_BUTTON_XPATH)))
+                search_button.click()
+                wait.until(EC.staleness_of(search_button))
+        except TimeoutException:
+            return LAW_ERROR, None
+
+        # Clica no primeiro resultado (se não aparecer nenhum, a lei não foi encontrada)
+        with timed_step(timings, "open_result"):
+            try:
+                first_result = WebDriverWait(driver, LAW_RESULT_TIMEOUT).until(
+                    EC.element_to_be_clickable((By.XPATH, LAW_FIRST_RESULT_XPATH))
+                )
+            except TimeoutException:
+                return LAW_NOT_FOUND, None
+            driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", first_result)
+            first_result.click()
+
+        # Pega o texto da ementa
+        with timed_step(timings, "read_description"):
+            try:
+                law_description = wait.until(EC.visibility_of_element_located((By.XPATH, LAW_DESCRIPTION_XPATH))).text
+            except TimeoutException:
+                return LAW_ERROR, None
+        return LAW_FOUND, law_description
+
+    except Exception as e:
+        print("Ocorreu um erro durante a execução do script:", e)
+        return LAW_ERROR, None
+    finally:
+        if own_driver and driver is not None:
+            driver.quit()
+
+# Lê o HTML guardando o caminho absoluto de cada elemento (ex.: /html/body/main/section[2]) para
+# encontrar os mesmos elementos das XPaths usadas no Selenium, sem precisar de navegador.
+class LawPageParser(HTMLParser):
+    VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+    # Tags de bloco que fecham um <p> aberto (como o navegador faz)
+    CLOSES_P = {
+        "address", "article", "aside", "blockquote", "div", "dl", "fieldset", "footer", "form", "h1", "h2", "h3",
+        "h4", "h5", "h6", "header", "hr", "main", "nav", "ol", "p", "pre", "section", "table", "ul"
+    }
+
+    def __init__(self, xpaths):
+        super().__init__(convert_charrefs=True)
+        self.xpaths = {name: self.parse_xpath(xpath) for name, xpath in xpaths.items()}
+        self.stack = [] # [(tag, índice entre os irmãos, atributos)]
+        self.counters = [{}] # contagem de tags por nível, para calcular o índice
+        self.matches = {} # {nome: {"attrs": ..., "text": [...]}} (apenas o primeiro elemento encontrado)
+        self.open_matches = [] # (nome, profundidade) dos elementos encontrados que ainda estão abertos
+        self.forms = [] # formulários com os seus campos
+
+    @staticmethod
+    def parse_xpath(xpath):
+        steps = []
+        for step in xpath.strip("/").split("/"):
+            match = re.fullmatch(r"(\w+)(?:\[(\d+)\])?", step)
+            steps.append((match.group(1), int(match.group(2)) if match.group(2) else None))
+        return steps
+
+    def path_matches(self, steps):
+        if len(steps) != len(self.stack):
+            return False
+        return all(
+            tag == s_tag and (index is None or index == s_index)
+            for (tag, index), (s_tag, s_index, _) in zip(steps, self.stack)
+        )
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+
+        # Campos de formulário (não dependem do caminho)
+        if tag == "form":
+            self.forms.append({"action": attrs.get("action", ""), "method": (attrs.get("method") or "get").lower(), "inputs": []})
+        elif tag in ("input", "select", "textarea") and self.forms:
+            self.forms[-1]["inputs"].append({
+                "tag": tag,
+                "type": (attrs.get("type") or "text").lower(),
+                "name": attrs.get("name"),
+                "id": attrs.get("id"),
+                "value": attrs.get("value", "")
+            })
+
+        # Fecha implicitamente <p> e <li> que não foram fechados (como o navegador faz)
+        if tag in self.CLOSES_P and self.stack and self.stack[-1][0] == "p":
+            self.handle_endtag("p")
+        if tag == "li" and self.stack and self.stack[-1][0] == "li":
+            self.handle_endtag("li")
+
+        counter = self.counters[-1]
+        counter[tag] = counter.get(tag, 0) + 1
+        self.stack.append((tag, counter[tag], attrs))
+        for name, steps in self.xpaths.items():
+            if name not in self.matches and self.path_matches(steps):
+                self.matches[name] = {"attrs": attrs, "text": []}
+                self.open_matches.append((name, len(self.stack)))
+
+        if tag in self.VOID_TAGS:
+            self.pop()
         else:
-            law_number, law_year = None, None
-            return None
-        
-        time.sleep(2)
+            self.counters.append({})
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in self.VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self.VOID_TAGS or not any(item[0] == tag for item in self.stack):
+            return
+        while self.stack:
+            closed = self.stack[-1][0]
+            self.pop()
+            self.counters.pop()
+            if closed == tag:
+                break
+
+    def pop(self):
+        depth = len(self.stack)
+        self.open_matches = [(name, d) for name, d in self.open_matches if d < depth]
+        self.stack.pop()
+
+    def handle_data(self, data):
+        for name, _ in self.open_matches:
+            self.matches[name]["text"].append(data)
+
+    # Texto do elemento encontrado (espaços normalizados, como o .text do Selenium)
+    def text(self, name):
+        match = self.matches.get(name)
+        return " ".join("".join(match["text"]).split()) if match else None
+
+    def attr(self, name, attr):
+        match = self.matches.get(name)
+        return match["attrs"].get(attr) if match else None
+
+# Lê o formulário de pesquisa de leis: ação, método, campos ocultos, checkboxes de tipo e o campo do número
+# (o nome do mesmo campo que o Selenium preenche, em LAW_NUMBER_INPUT_XPATH)
+def parse_law_search_form(html):
+    parser = LawPageParser({"number": LAW_NUMBER_INPUT_XPATH})
+    parser.feed(html)
+    number_field = parser.attr("number", "name")
+    for form in parser.forms:
+        checkboxes = {
+            field["id"]: (field["name"], field["value"])
+            for field in form["inputs"]
+            if field["type"] == "checkbox" and field["id"] and field["id"].startswith("id_tipo_leg")
+        }
+        if not checkboxes:
+            continue
+        hidden = [(field["name"], field["value"]) for field in form["inputs"] if field["type"] == "hidden" and field["name"]]
+        return {
+            "action": form["action"],
+            "method": form["method"],
+            "hidden": hidden,
+            "checkboxes": checkboxes,
+            "number_field": number_field
+        }
+    return None
+
+# Link do primeiro resultado da lista de leis (mesmo elemento de LAW_FIRST_RESULT_XPATH)
+def parse_law_first_result(html):
+    parser = LawPageParser({"first_result": LAW_FIRST_RESULT_XPATH})
+    parser.feed(html)
+    return parser.attr("first_result", "href")
+
+# True se a página é a lista de resultados com o aviso de que a pesquisa não encontrou nenhuma lei
+def parse_law_no_results(html):
+    parser = LawPageParser({"results": LAW_RESULTS_XPATH})
+    parser.feed(html)
+    return LAW_NO_RESULTS_MARKER.lower() in (parser.text("results") or "").lower()
+
+# Texto da ementa na página da lei (mesmo elemento de LAW_DESCRIPTION_XPATH)
+def parse_law_description(html):
+    parser = LawPageParser({"description": LAW_DESCRIPTION_XPATH})
+    parser.feed(html)
+    return parser.text("description") or None
+
+# Sessão HTTP reutilizada em todas as pesquisas (mantém as conexões abertas)
+def create_law_session(pool_size=LAW_DRIVER_POOL_SIZE):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["User-Agent"] = "Zeta-RPA"
+    return instrument_session(session)
+
+# Baixa e lê o formulário de pesquisa (uma vez por execução)
+def load_law_search_form(session, search_url=LAW_SEARCH_URL):
+    response = session.get(search_url, timeout=LAW_HTTP_TIMEOUT)
+    response.raise_for_status()
+    form = parse_law_search_form(response.text)
+    if form is None or not form["number_field"]:
+        raise ValueError("Formulário de pesquisa de leis não encontrado na página.")
+    form["url"] = urljoin(response.url, form["action"])
+    return form
+
+# Pesquisa a lei enviando o mesmo formulário da página por HTTP, sem abrir o navegador.
+# Retorna (status, descrição) como o fetch_law; erros de rede ou páginas não reconhecidas retornam "error"
+def fetch_law_http(law_number, session, form, timings=None):
+    type_id = law_type_id(law_number)
+    number, _ = parse_law_number(law_number)
+    if not type_id or not number:
+        return LAW_NOT_FOUND, None
+    if type_id not in form["checkboxes"]:
+        return LAW_ERROR, None
 
-        # Preenche o número da lei
-        try:
-            number_box = driver.find_element(By.XPATH, "/html/body/main/section[2]/div[2]/table/tbody/tr[1]/td/form/table[2]/tbody/tr[1]/td[2]/input")
-            number_box.send_keys(law_number)
-            time.sleep(2)
+    try:
+        # Envia o formulário com o tipo e o número da lei
+        with timed_step(timings, "http_search"):
+            params = list(form["hidden"])
+            params.append(form["checkboxes"][type_id])
+            params.append((form["number_field"], number))
+            if form["method"] == "post":
+                response = session.post(form["url"], data=params, timeout=LAW_HTTP_TIMEOUT)
+            else:
+                response = session.get(form["url"], params=params, timeout=LAW_HTTP_TIMEOUT)
+            response.raise_for_status()
+            result_href = parse_law_first_result(response.text)
+
+        # Sem resultado: só é "não encontrada" se a página disser isso; senão o navegador tenta de novo
+        if not result_href:
+            if parse_law_no_results(response.text):
+                return LAW_NOT_FOUND, None
+            print(f"Página de resultados não reconhecida na pesquisa HTTP da lei {law_number}")
+            return LAW_ERROR, None
+
+        # Abre o primeiro resultado e pega o texto da ementa
+        with timed_step(timings, "http_description"):
+            response = session.get(urljoin(response.url, result_href), timeout=LAW_HTTP_TIMEOUT)
+            response.raise_for_status()
+            law_description = parse_law_description(response.text)
+
+        if not law_description:
+            return LAW_ERROR, None
+        return LAW_FOUND, law_description
+    except Exception as e:
+        print(f"Erro na pesquisa HTTP da lei {law_number}: {e}")
+        return LAW_ERROR, None
 
-        except Exception as e:
-            return None
+# Retorna apenas a descrição da lei (ou None caso não encontre)
+@instrumented("search_law")
+def search_law(law_number: str):
+    return fetch_law(law_number)[1]
+
+# Normaliza o número da lei para ser usado como chave do cache ("Lei  nº 1.234 / 2020" -> "lei nº 1.234/2020")
+def normalize_law_number(law_number):
+    law_key = unicodedata.normalize("NFKC", law_number).strip().lower()
+    law_key = re.sub(r"\s*/\s*", "/", law_key)
+    return re.sub(r"\s+", " ", law_key)
+
+# Cria a tabela de cache das descrições de leis (caso não exista)
+def create_law_cache(cur, conn):
+    cur.execute("CREATE SCHEMA IF NOT EXISTS rpa;")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS rpa.law_cache (
+        law_key TEXT PRIMARY KEY,
+        law_number TEXT NOT NULL,
+        description TEXT,
+        status TEXT NOT NULL,
+        fetched_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    """)
+    conn.commit()
+
+# Carrega as entradas do cache que ainda estão dentro do prazo de validade (TTL) do seu status
+def load_law_cache(cur):
+    cur.execute("""
+    SELECT law_key, status, description
+    FROM rpa.law_cache
+    WHERE fetched_at > now() - make_interval(days => CASE status
+        WHEN 'found' THEN %s
+        WHEN 'not_found' THEN %s
+        ELSE %s
+    END);
+    """, (LAW_CACHE_TTL_DAYS[LAW_FOUND], LAW_CACHE_TTL_DAYS[LAW_NOT_FOUND], LAW_CACHE_TTL_DAYS[LAW_ERROR]))
+    return {law_key: (status, description) for law_key, status, description in cur.fetchall()}
+
+# Grava (ou atualiza) as leis pesquisadas no cache. entries: lista de (law_key, law_number, status, description)
+def save_law_cache(cur, conn, entries):
+    if not entries:
+        return
+    execute_values(cur, """
+    INSERT INTO rpa.law_cache (law_key, law_number, status, description)
+    VALUES %s
+    ON CONFLICT (law_key) DO UPDATE SET
+        law_number = EXCLUDED.law_number,
+        status = EXCLUDED.status,
+        description = EXCLUDED.description,
+        fetched_at = now();
+    """, entries)
+    conn.commit()
+
+# Garante um intervalo mínimo entre as requisições a um mesmo site (compartilhado entre as threads)
+class RateLimiter:
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self._next_time = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            wait_time = max(0.0, self._next_time - now)
+            self._next_time = max(now, self._next_time) + self.min_interval
+        if wait_time:
+            time.sleep(wait_time)
+
+# Pesquisa uma lei primeiro por HTTP (se houver sessão e formulário) e, se der erro, usando um navegador do pool.
+# Se a pesquisa no navegador deu erro, ele é reciclado.
+@instrumented("search_law")
+def fetch_law_pooled(law_number, pool, limiter, timings, session=None, form=None):
+    limiter.wait()
+    if session is not None and form is not None:
+        status, description = fetch_law_http(law_number, session, form, timings)
+        if status != LAW_ERROR:
+            return status, description
+
+    driver = pool.acquire()
+    status, description = LAW_ERROR, None
+    try:
+        status, description = fetch_law(law_number, driver, timings)
+    finally:
+        pool.release(driver, broken=status == LAW_ERROR)
+    return status, description
+
+# Imprime o tempo total, médio e máximo de cada etapa das pesquisas de leis
+def print_law_timings(step_timings):
+    if not step_timings:
+        return
+    print("Tempo por etapa da pesquisa de leis (total / médio / máximo):")
+    for step, values in step_timings.items():
+        print(f" - {step}: {sum(values):.2f}s / {sum(values) / len(values):.2f}s / {max(values):.2f}s")
+
+# Resolve as descrições de todas as leis de uma vez: usa o cache e pesquisa as que faltam (ou estão na lista
+# de refresh) em paralelo, com no máximo "pool.size" navegadores e um intervalo mínimo entre as pesquisas.
+# Retorna {número normalizado: descrição} e a lista de novas pesquisas para gravar no cache.
+def resolve_laws(law_numbers, cache, refresh, pool, min_interval=LAW_MIN_INTERVAL_SECONDS):
+    descriptions = {}
+    to_fetch = {}
+    for law_number in law_numbers:
+        law_key = normalize_law_number(law_number)
+        if law_key in cache and law_key not in refresh:
+            descriptions[law_key] = cache[law_key][1]
+        else:
+            to_fetch.setdefault(law_key, law_number) # pesquisa cada lei no máximo uma vez por execução
 
-        # Clica no botão de buscar
-        try:
-            driver.find_element(By.XPATH, '/html/body/main/section[2]/div[2]/table/tbody/tr[1]/td/form/table[2]/tbody/tr[5]/td/input').click()
-            time.sleep(2)
-        except Exception as e:
-            return None
+    pending = []
+    if not to_fetch:
+        return descriptions, pending
 
-        # Scrolla a tela para baixo
+    # Pesquisa por HTTP antes do navegador, se ligada (o Selenium fica como alternativa)
+    session = form = None
+    if LAW_HTTP_ENABLED:
+        session = create_law_session(pool.size)
         try:
-            driver.execute_script("window.scrollTo(0, 200);")
-
-            # Clica no primeiro resultado
-            first_result = driver.find_element(By.XPATH, '/html/body/main/section[2]/div[2]/ul[1]/li/p/a')
-            if first_result:
-                first_result.click()
-            else: 
-                return None
-            time.sleep(2)
-
-            # Pega o texto da ementa
-            law_description = driver.find_element(By.XPATH, '/html/body/main/section[2]/div[2]/p[2]').text
-            return law_description
-            
+            form = load_law_search_form(session)
         except Exception as e:
-            return None
+            print(f"Pesquisa HTTP de leis indisponível, usando apenas o navegador: {e}")
+
+    limiter = RateLimiter(min_interval)
+    lookup_timings = {law_key: {} for law_key in to_fetch}
+    with ThreadPoolExecutor(max_workers=pool.size) as executor:
+        futures = {
+            executor.submit(bind(fetch_law_pooled), law_number, pool, limiter, lookup_timings[law_key], session, form): (law_key, law_number)
+            for law_key, law_number in to_fetch.items()
+        }
+        for future in as_completed(futures):
+            law_key, law_number = futures[future]
+            try:
+                status, description = future.result()
+            except Exception as e:
+                print(f"Erro ao pesquisar a lei {law_number}: {e}")
+                status, description = LAW_ERROR, None
+            cache[law_key] = (status, description)
+            descriptions[law_key] = description
+            pending.append((law_key, law_number, status, description))
+
+    # Junta os tempos de cada pesquisa por etapa
+    step_timings = {}
+    for timings in lookup_timings.values():
+        for step, seconds in timings.items():
+            step_timings.setdefault(step, []).append(seconds)
+    print_law_timings(step_timings)
+
+    if session is not None:
+        session.close()
+    return descriptions, pending
+
+# Monta os documentos da collection classes a partir das linhas do staging (uma linha por aula, com os
+# textos, flashcards e leis já agregados), com as descrições das leis. É um gerador: cada aula é devolvida assim que lida.
+def build_classes(rows, law_descriptions):
+    for class_id, class_name, module_id, module_name, texts, flashcards, laws in rows:
+        doc = {
+            "_id": class_id,
+            "program_id": module_id,
+            "title": class_name,
+            "description": module_name,
+            "content": [],
+            "flashcards": [],
+            "laws": []
+        }
+
+        # adiciona texto corrido (quebra em partes) - sem duplicar
+        seen_parts = set()
+        for parts in split_texts(texts or []).values():
+            for part in parts:
+                if part not in seen_parts:
+                    seen_parts.add(part)
+                    doc["content"].append(part)
+
+        # adiciona flashcards - sem duplicar
+        seen_flashcards = set()
+        for front, back in flashcards or []:
+            if front and back and (front, back) not in seen_flashcards:
+                seen_flashcards.add((front, back))
+                doc["flashcards"].append({
+                    "front": front,
+                    "back": back
+                })
 
-    except (TimeoutException, Exception) as e:
-        print("Ocorreu um erro durante a execução do script:", e)
-        return None
+        # adiciona leis com a descrição já resolvida - sem duplicar
+        seen_laws = set()
+        for law_number in laws or []:
+            if law_number not in seen_laws:
+                seen_laws.add(law_number)
+                doc["laws"].append({
+                    "number": law_number,
+                    "description": law_descriptions.get(normalize_law_number(law_number))
+                })
 
-# Atualiza collection classes no MongoDB
-def update_classes(coll_classes, cur):
+        yield doc
+
+# Leis distintas das aulas do staging
+def load_class_laws(cur):
+    cur.execute("""
+    SELECT DISTINCT l.lei
+    FROM staging.lei l
+    JOIN staging.aula a ON l.id_aula = a.id
+    WHERE l.lei IS NOT NULL;
+    """)
+    return [row[0] for row in cur.fetchall()]
+
+# Leis das aulas do staging sem entrada válida no cache (nunca pesquisadas ou com o prazo do status vencido),
+# que o enrich_laws pesquisaria no site
+def find_stale_laws(cur):
+    create_law_cache(cur, cur.connection)
+    law_cache = load_law_cache(cur)
+    return [law for law in load_class_laws(cur) if normalize_law_number(law) not in law_cache]
+
+# Resolve as descrições de todas as leis distintas das aulas do staging (cache + pesquisa no site em paralelo)
+# e salva no cache as leis pesquisadas. Retorna {número normalizado: descrição}.
+@instrumented("enrich_laws")
+def enrich_laws(cur, refresh_laws=()):
+    # Navegadores usados nas pesquisas de leis (sempre fechados no final)
+    driver_pool = DriverPool()
     try:
-        # Query para buscar as informações no staging
+        # Cache das descrições de leis (evita abrir o navegador para leis já conhecidas)
+        create_law_cache(cur, cur.connection)
+        law_cache = load_law_cache(cur)
+        law_refresh = {normalize_law_number(law) for law in refresh_laws}
+
+        law_numbers = load_class_laws(cur)
+        law_descriptions, law_pending = resolve_laws(law_numbers, law_cache, law_refresh, driver_pool)
+    finally:
+        # Fecha os navegadores usados nas pesquisas
+        driver_pool.close()
+
+    # Salva no cache as leis pesquisadas nesta execução
+    save_law_cache(cur, cur.connection, law_pending)
+    print(f"Leis pesquisadas no site: {len(law_pending)}")
+    return law_descriptions
+
+# Atualiza collection classes no MongoDB. As descrições das leis podem vir já resolvidas (law_descriptions);
+# senão são resolvidas aqui com enrich_laws.
+@instrumented("update_classes", counters=report_counters, fail_on_none=True)
+def update_classes(coll_classes, cur, refresh_laws=(), law_descriptions=None):
+    try:
+        if law_descriptions is None:
+            law_descriptions = enrich_laws(cur, refresh_laws)
+
+        # Query para buscar as informações no staging: uma linha por aula, com cada relação filha agregada
+        # separadamente (sem o produto cartesiano texto x flashcard x lei)
         query = """ 
         SELECT
             a.id AS aula_id,
             a.nome AS aula_nome,
             a.id_modulo AS modulo_id,
             m.modulo AS modulo_nome,
-            t.texto_corrido,
-            f.frente AS flashcard_frente,
-            f.verso AS flashcard_verso,
-            l.lei AS lei_numero
+            (
+                SELECT array_agg(t.texto_corrido ORDER BY t.id)
+                FROM staging.texto_corrido t
+                WHERE t.id_aula = a.id AND t.texto_corrido <> ''
+            ) AS textos,
+            (
+                SELECT json_agg(json_build_array(f.frente, f.verso) ORDER BY f.id)
+                FROM staging.flash_card f
+                WHERE f.id_aula = a.id
+            ) AS flashcards,
+            (
+                SELECT array_agg(l.lei ORDER BY l.id)
+                FROM staging.lei l
+                WHERE l.id_aula = a.id AND l.lei <> ''
+            ) AS leis
         FROM staging.aula a
         LEFT JOIN staging.modulo m ON a.id_modulo = m.id
-        LEFT JOIN staging.texto_corrido t ON t.id_aula = a.id
-        LEFT JOIN staging.flash_card f ON f.id_aula = a.id
-        LEFT JOIN staging.lei l ON l.id_aula = a.id
         ORDER BY a.id;
         """
 
-        # Executa no schema staging
-        cur.execute(query)
-        rows = cur.fetchall()
-
-        # Monta a estrutura agrupada por aula
-        classes = {}
-        for r in rows:
-            class_id, class_name, module_id, module_name, text, front, back, law_number = r
-
-            if class_id not in classes:
-                classes[class_id] = {
-                    "_id": class_id,
-                    "program_id": module_id,
-                    "title": class_name,
-                    "description": module_name,
-                    "content": [],
-                    "flashcards": [],
-                    "laws": [],
-                    # sets de controle (evitam duplicações)
-                    "_seen_content_parts": set(),
-                    "_seen_flashcards": set(),
-                    "_seen_laws": set()
-                }
-
-            doc = classes[class_id]
-
-            # adiciona texto corrido (quebra em partes) - sem duplicar
-            if text:
-                parts = split_text(text)
-                for part in parts:
-                    if part not in doc["_seen_content_parts"]:
-                        doc["_seen_content_parts"].add(part)
-                        doc["content"].append(part)
-
-            # adiciona flashcards - sem duplicar
-            if front and back:
-                key = f"{front}||{back}"
-                if key not in doc["_seen_flashcards"]:
-                    doc["_seen_flashcards"].add(key)
-                    doc["flashcards"].append({
-                        "front": front,
-                        "back": back
-                    })
-
-             # adiciona leis (a descrição será preenchida por outro RPA futuramente) - sem duplicar
-            if law_number and law_number not in doc["_seen_laws"]:
-                law_description = search_law(law_number) # Chama a função search_law (um web scraping para a lei)
-                doc["_seen_laws"].add(law_number)
-                doc["laws"].append({
-                    "number": law_number,
-                    "description": law_description
-                })
-
-        # Remove os sets de controle antes de enviar ao MongoDB
-        for c in classes.values():
-            c.pop("_seen_content_parts", None)
-            c.pop("_seen_flashcards", None)
-            c.pop("_seen_laws", None)
-
-        # Atualiza o MongoDB
-        existing_docs = list(coll_classes.find({}, {"_id": 1}))
-        existing_ids = {doc["_id"] for doc in existing_docs}
-        valid_ids = set(classes.keys())
-
-        inserted = 0
-        updated = 0
-
-        for aula_id, data in classes.items():
-            existing = coll_classes.find_one({"_id": aula_id})
-            if not existing:
-                coll_classes.insert_one(data)
-                inserted += 1
-            else:
-                # se houver diferença, atualiza
-                if existing != data:
-                    coll_classes.replace_one({"_id": aula_id}, data)
-                    updated += 1
-
-        # Remove aulas que não existem mais no Postgres
-        to_delete = existing_ids - valid_ids
-        deleted = 0
-        if to_delete:
-            result = coll_classes.delete_many({"_id": {"$in": list(to_delete)}})
-            deleted = result.deleted_count
-
-        print(f"Sincronização concluída com sucesso!")
-        print(f"Inseridos: {inserted}")
-        print(f"Atualizados: {updated}")
-        print(f"Deletados: {deleted}")
+        # Lê as linhas em streaming, monta cada aula e envia ao MongoDB em lotes
+        classes = build_classes(iter_rows(cur.connection, query), law_descriptions)
+        report = sync_collection(coll_classes, classes)
+        print("Sincronização concluída com sucesso!")
+        return report
     except Exception as e:
         print(f"Erro ao sincronizar a collection 'classes': {e}")
 
 # Chamando as funções 
 if "__main__" == __name__:
     try:
+        # Argumentos da linha de comando
+        parser = argparse.ArgumentParser(description="Sincroniza o staging com o PostgreSQL e o MongoDB.")
+        parser.add_argument(
+            "--refresh-laws", nargs="+", default=[], metavar="LEI",
+            help="Leis que devem ser pesquisadas novamente no site, ignorando o cache (ex.: \"Lei 1.234/2020\")"
+        )
+        args = parser.parse_args()
+
         # Declarando as variáveis de ambiente
         load_dotenv()
 
         # banco Postgres
         POSTGRES_URL = os.getenv("POSTGRES_URL_2")
-        conn = psycopg2.connect(POSTGRES_URL)
+        conn = psycopg2.connect(POSTGRES_URL, cursor_factory=MetricsCursor)
         cur = conn.cursor()
 
         # banco MongoDB
         mongo_url = os.getenv("MONGODB_URL")
-        client = MongoClient(mongo_url)
+        client = MongoClient(mongo_url, event_listeners=[MongoMetricsListener()])
         dbZeta = client["Zeta"] 
         activities = dbZeta['activities']
         classes = dbZeta['classes']
 
         # Atualizando a tabela plans
         print("Atualizando a tabela 'plans'...")
-        update_plans(cur, conn)
+        update_plans(cur, conn, IN_DATABASE)
 
         # Atualizando a tabela segments
         print("\nAtualizando a tabela 'segments'...")
-        update_segments(cur, conn)
+        update_segments(cur, conn, IN_DATABASE)
 
         # Atualiza a tabela workers 
         print("\nAtualizando a tabela 'workers'...")
-        update_workers(cur, conn)
+        update_workers(cur, conn, IN_DATABASE)
 
         # Atualiza ou insere documentos na collection activities
         print("\nSincronizando a collection 'activities'...")
@@ -517,11 +1321,14 @@ if "__main__" == __name__:
 
         # Atuliza ou insere documentos na collection classes
         print("\nAtualizando a collection 'classes'...")
-        update_classes(classes, cur)
+        update_classes(classes, cur, args.refresh_laws)
     except Exception as e:
         print(f"Erro ao executar o RPA: {e}")
     finally:
         # Fecha as conexões
         cur.close()
         conn.close()
-        client.close()
\ No newline at end of file
+        client.close()
+
+        # Métricas das etapas desta execução (se METRICS_PROMETHEUS_FILE estiver configurado)
+        write_prometheus()
\ No newline at end of file
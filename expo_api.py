@@ -1,157 +1,670 @@
 import os
+import sys
+import json
+import queue
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import psycopg2
 from psycopg2.extras import execute_values
 from dotenv import load_dotenv
-
-load_dotenv()
+from metrics import stage, instrumented, record, bind, instrument_session, write_prometheus, MetricsCursor
 
 # ---------- Configuration ----------
-MAP_NUMBER = 5
-LOGIN_URL = "https://expo-tech-backend.onrender.com/users/login"
-REVIEWS_URL = "https://expo-tech-backend.onrender.com/reviews/project/"
-LOGIN_DATA = {
-    "username": f"expositor_project-uuid-{MAP_NUMBER}@example.com",
-    "password": "senha123"
-}
+# Base URL of the Expo backend (point it at a local stub server with EXPO_API_URL or --base-url)
+API_BASE_URL = "https://expo-tech-backend.onrender.com"
+LOGIN_PATH = "/users/login"
+REVIEWS_PATH = "/reviews/project/"
+
+# Maps (projects) ingested by default; each map logs in with its own expositor account
+MAP_NUMBERS = [5]
+LOGIN_USERNAME = "expositor_project-uuid-{map_number}@example.com"
+LOGIN_PASSWORD = "senha123"
 LOGIN_HEADERS = {
     "accept": "application/json",
     "Content-Type": "application/x-www-form-urlencoded"
 }
 
+# (connect, read) timeouts: the onrender backend can take close to a minute to cold-start
+REQUEST_TIMEOUT = (10, 90)
+
+# Retries with exponential backoff (BACKOFF_FACTOR * 2^n seconds) on timeouts, connection errors and 5xx
+MAX_RETRIES = 5
+BACKOFF_FACTOR = 2
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# Maps fetched at the same time (one pooled session shared by all of them)
+CONCURRENCY = 4
+
+# Reviews requested per page and score rows sent per INSERT statement
+PAGE_SIZE = 200
+BATCH_SIZE = 1000
+
+# Fetched pages waiting to be written (bounds memory when the API is faster than the database)
+MAX_PENDING_PAGES = 8
+
+# Skip reviews already loaded with the same content (review id + content hash in feedback.reviews)
+CHANGED_ONLY = True
+
+# Aggregate tables refreshed with the reviews of each load (see create_aggregate_tables)
+AGGREGATE_TABLES = ("feedback.review_scores", "feedback.project_scores", "feedback.criteria_scores")
+
 # If True, drop & recreate tables (destructive). Default False -> keep/append.
 replace_tables = False
 
-DB_URL = os.getenv("DATABASE_URL")
-if not DB_URL:
-    raise ValueError("Set DATABASE_URL in your environment (.env)")
-
-# ---------- 1) Login to API ----------
-resp = requests.post(LOGIN_URL, data=LOGIN_DATA, headers=LOGIN_HEADERS)
-resp.raise_for_status()
-token = resp.json().get("access_token")
-if not token:
-    raise ValueError("Could not obtain access token from login response")
-
-# ---------- 2) Fetch reviews ----------
-headers = {"accept": "application/json", "Authorization": f"Bearer {token}"}
-reviews_resp = requests.get(REVIEWS_URL, headers=headers)
-reviews_resp.raise_for_status()
-reviews = reviews_resp.json()
-if not isinstance(reviews, list):
-    raise ValueError("API returned unexpected structure (expected list of reviews)")
-
-# ---------- 3) Connect to Postgres ----------
-conn = psycopg2.connect(DB_URL)
-cur = conn.cursor()
-
-# ---------- 4) Create tables (if needed) ----------
-if replace_tables:
-    cur.execute("DROP TABLE IF EXISTS feedback.scores CASCADE;")
-    cur.execute("DROP TABLE IF EXISTS feedback.criteria CASCADE;")
-    conn.commit()
+# ---------- Database ----------
+# Creates the feedback schema, its tables and the ingestion checkpoints
+def create_tables(cur, conn):
+    if replace_tables:
+        cur.execute("DROP TABLE IF EXISTS feedback.scores CASCADE;")
+        cur.execute("DROP TABLE IF EXISTS feedback.criteria CASCADE;")
+        cur.execute("DROP TABLE IF EXISTS feedback.reviews CASCADE;")
+        for table in AGGREGATE_TABLES:
+            cur.execute(f"DROP TABLE IF EXISTS {table};")
+        conn.commit()
+
+    # Ensure schema exists
+    cur.execute("CREATE SCHEMA IF NOT EXISTS feedback;")
+
+    # Create criteria table:
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS feedback.criteria (
+        id SERIAL PRIMARY KEY,
+        name TEXT UNIQUE NOT NULL,
+        weight NUMERIC
+    );
+    """)
+
+    # Create scores table (one score per review and criterion):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS feedback.scores (
+        id SERIAL PRIMARY KEY,
+        review_id TEXT NOT NULL,
+        criteria_id INT REFERENCES feedback.criteria(id),
+        score INT,
+        CONSTRAINT scores_review_criteria_key UNIQUE (review_id, criteria_id)
+    );
+    """)
+    # review_id first: rows without it would also be counted as duplicates by ensure_scores_key
+    ensure_scores_review_id(cur)
+    ensure_scores_key(cur)
+    # Scores of a criterion (aggregate refresh and criteria lookups). Lookups by review_id already use
+    # the (review_id, criteria_id) unique key, whose leading column is review_id.
+    cur.execute("CREATE INDEX IF NOT EXISTS scores_criteria_id_idx ON feedback.scores (criteria_id);")
 
-# Ensure schema exists
-cur.execute("CREATE SCHEMA IF NOT EXISTS feedback;")
-
-# Create criteria table:
-cur.execute("""
-CREATE TABLE IF NOT EXISTS feedback.criteria (
-    id SERIAL PRIMARY KEY,
-    name TEXT UNIQUE NOT NULL,
-    weight NUMERIC
-);
-""")
-
-# Create scores table:
-cur.execute("""
-CREATE TABLE IF NOT EXISTS feedback.scores (
-    id SERIAL PRIMARY KEY,
-    review_id TEXT,
-    criteria_id INT REFERENCES feedback.criteria(id),
-    score INT
-);
-""")
-conn.commit()
-
-# ---------- 5) Upsert criteria and collect criteria_id mapping ----------
-# We'll upsert each unique criterion (name + weight) and collect its id.
-criteria_map = {}  # name -> id
-
-# Build a set of unique (name, weight) from API data
-unique_criteria = {}
-for review in reviews:
-    for g in review.get("grades", []):
-        name = g["name"]
-        weight = g.get("weight")
-        # If the same name appears with different weights, we'll prefer the latest seen value.
-        unique_criteria[name] = weight
-
-# Upsert all unique criteria and store ids
-upsert_query = """
-INSERT INTO feedback.criteria (name, weight)
-VALUES %s
-ON CONFLICT (name) DO UPDATE SET weight = EXCLUDED.weight
-RETURNING id, name;
-"""
-
-values = [(name, unique_criteria[name]) for name in unique_criteria]
-if values:
-    execute_values(cur, upsert_query, values)
-    returned = cur.fetchall()
-    # Build name -> id map
-    for cid, name in returned:
-        criteria_map[name] = cid
+    # Reviews already loaded: map and content hash, used to skip unchanged reviews
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS feedback.reviews (
+        review_id TEXT PRIMARY KEY,
+        map_number INT,
+        content_hash TEXT NOT NULL,
+        loaded_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    """)
+
+    # Progress of each map: the cursor of the next page to fetch (JSON: offset or "next" link),
+    # saved in the same transaction as the page's scores
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS feedback.ingestion_checkpoints (
+        map_number INT PRIMARY KEY,
+        next_cursor TEXT,
+        status TEXT NOT NULL,
+        pages INT NOT NULL DEFAULT 0,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    """)
+
+    # Aggregates read by the dashboards; built from the existing scores when first created
+    if create_aggregate_tables(cur):
+        rebuild_score_aggregates(cur)
     conn.commit()
 
-# In case some criteria were already present (no RETURNING rows for them), ensure we fetch ids for all
-if set(criteria_map.keys()) != set(unique_criteria.keys()):
-    # fetch missing ids
-    missing = tuple(set(unique_criteria.keys()) - set(criteria_map.keys()))
+# Creates the aggregate tables kept up to date by every load. Sums and counts are stored so each load can
+# subtract and add back only the reviews it touches; the averages are generated columns.
+#  - review_scores: weighted score of each review
+#  - project_scores: weighted score of each map (project), over all its scores
+#  - criteria_scores: average score of each criterion in each map
+# Returns True if they didn't exist yet.
+def create_aggregate_tables(cur):
+    cur.execute("SELECT to_regclass('feedback.review_scores') IS NULL;")
+    created = cur.fetchone()[0]
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS feedback.review_scores (
+        review_id TEXT PRIMARY KEY,
+        map_number INT,
+        scores INT NOT NULL,
+        score_sum NUMERIC NOT NULL,
+        weighted_sum NUMERIC NOT NULL,
+        weight_sum NUMERIC NOT NULL,
+        weighted_score NUMERIC GENERATED ALWAYS AS (weighted_sum / NULLIF(weight_sum, 0)) STORED,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS feedback.project_scores (
+        map_number INT PRIMARY KEY,
+        reviews INT NOT NULL,
+        scores INT NOT NULL,
+        score_sum NUMERIC NOT NULL,
+        weighted_sum NUMERIC NOT NULL,
+        weight_sum NUMERIC NOT NULL,
+        weighted_score NUMERIC GENERATED ALWAYS AS (weighted_sum / NULLIF(weight_sum, 0)) STORED,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS feedback.criteria_scores (
+        map_number INT NOT NULL,
+        criteria_id INT NOT NULL REFERENCES feedback.criteria(id),
+        reviews INT NOT NULL,
+        scores INT NOT NULL,
+        score_sum NUMERIC NOT NULL,
+        avg_score NUMERIC GENERATED ALWAYS AS (score_sum / NULLIF(scores, 0)) STORED,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (map_number, criteria_id)
+    );
+    """)
+    return created
+
+# Adds the (review_id, criteria_id) unique key to a scores table created before it existed.
+# Fails if the table still has the duplicated rows older runs appended; remove them once with --compact.
+def ensure_scores_key(cur):
+    cur.execute("""
+    SELECT 1 FROM pg_constraint
+    WHERE conrelid = 'feedback.scores'::regclass AND conname = 'scores_review_criteria_key';
+    """)
+    if cur.fetchone():
+        return
+    cur.execute("""
+    SELECT EXISTS (
+        SELECT 1 FROM feedback.scores GROUP BY review_id, criteria_id HAVING count(*) > 1
+    );
+    """)
+    if cur.fetchone()[0]:
+        raise ValueError("feedback.scores has duplicated (review_id, criteria_id) rows: run `python expo_api.py --compact` once")
+    cur.execute("ALTER TABLE feedback.scores ADD CONSTRAINT scores_review_criteria_key UNIQUE (review_id, criteria_id);")
+
+# Makes review_id NOT NULL on a scores table created before it was required. Fails if the table still has
+# the rows without a review_id older runs wrote; remove them once with --compact.
+def ensure_scores_review_id(cur):
+    cur.execute("""
+    SELECT is_nullable = 'YES' FROM information_schema.columns
+    WHERE table_schema = 'feedback' AND table_name = 'scores' AND column_name = 'review_id';
+    """)
+    if not cur.fetchone()[0]:
+        return
+    cur.execute("SELECT EXISTS (SELECT 1 FROM feedback.scores WHERE review_id IS NULL);")
+    if cur.fetchone()[0]:
+        raise ValueError("feedback.scores has rows without review_id: run `python expo_api.py --compact` once")
+    cur.execute("ALTER TABLE feedback.scores ALTER COLUMN review_id SET NOT NULL;")
+
+# One-time cleanup of the rows older runs left behind: removes the scores without a review_id (they belong
+# to no review and no aggregate counts them), keeps the newest row of each (review_id, criteria_id), makes
+# review_id NOT NULL, adds the unique key, rebuilds the aggregates and vacuums the table.
+# Returns (rows without review_id removed, duplicated rows removed).
+def compact_scores(conn):
+    with conn.cursor() as cur:
+        # Blocks concurrent loads while the rows are removed
+        cur.execute("LOCK TABLE feedback.scores IN SHARE ROW EXCLUSIVE MODE;")
+        cur.execute("DELETE FROM feedback.scores WHERE review_id IS NULL;")
+        without_review = cur.rowcount
+        cur.execute("""
+        DELETE FROM feedback.scores
+        WHERE id IN (
+            SELECT id FROM (
+                SELECT id, row_number() OVER (PARTITION BY review_id, criteria_id ORDER BY id DESC) AS rn
+                FROM feedback.scores
+            ) ranked
+            WHERE ranked.rn > 1
+        );
+        """)
+        removed = cur.rowcount
+        ensure_scores_review_id(cur)
+        ensure_scores_key(cur)
+        # Aggregates that don't exist yet are built by the next load (create_tables)
+        cur.execute("SELECT to_regclass('feedback.review_scores') IS NOT NULL;")
+        if cur.fetchone()[0]:
+            rebuild_score_aggregates(cur)
+        conn.commit()
+
+        # Frees the removed rows for reuse and refreshes the planner statistics (VACUUM can't run in a transaction)
+        conn.autocommit = True
+        try:
+            cur.execute("VACUUM ANALYZE feedback.scores;")
+        finally:
+            conn.autocommit = False
+    return without_review, removed
+
+# Returns the cursor each map starts from: where an unfinished run stopped, or the first page
+# (also for maps that finished last time, or for every map with restart=True)
+def start_checkpoints(cur, conn, map_numbers, restart=False):
     cur.execute(
-        "SELECT id, name FROM feedback.criteria WHERE name IN %s",
-        (missing,)
+        "SELECT map_number, next_cursor FROM feedback.ingestion_checkpoints WHERE status = 'running' AND map_number = ANY(%s);",
+        (list(map_numbers),)
     )
-    for cid, name in cur.fetchall():
-        criteria_map[name] = cid
-
-# ---------- 6) Insert scores rows ----------
-# We'll bulk insert into feedback.scores: (review_id, criteria_id, score)
-rows_to_insert = []
-for review in reviews:
-    review_id = review.get("id")
-    for g in review.get("grades", []):
-        criteria_name = g["name"]
-        score = g.get("score")
-        criteria_id = criteria_map.get(criteria_name)
-        if criteria_id is None:
-            # Fallback: try to query (shouldn't normally happen)
-            cur.execute("SELECT id FROM feedback.criteria WHERE name = %s", (criteria_name,))
-            r = cur.fetchone()
-            if r:
-                criteria_id = r[0]
-                criteria_map[criteria_name] = criteria_id
-            else:
-                # create it (very unlikely unless race condition)
-                cur.execute("INSERT INTO feedback.criteria (name, weight) VALUES (%s, %s) RETURNING id",
-                            (criteria_name, g.get("weight")))
-                criteria_id = cur.fetchone()[0]
-                conn.commit()
-                criteria_map[criteria_name] = criteria_id
-
-        rows_to_insert.append((review_id, criteria_id, score))
-
-if rows_to_insert:
-    insert_scores_q = """
+    unfinished = {} if restart else {map_number: json.loads(cursor) for map_number, cursor in cur.fetchall()}
+
+    cursors = {}
+    for map_number in map_numbers:
+        if map_number in unfinished:
+            cursors[map_number] = unfinished[map_number]
+            print(f"Map {map_number}: resuming from {cursors[map_number]!r}")
+            continue
+        cursors[map_number] = 0
+        cur.execute("""
+        INSERT INTO feedback.ingestion_checkpoints (map_number, next_cursor, status, pages)
+        VALUES (%s, %s, 'running', 0)
+        ON CONFLICT (map_number) DO UPDATE SET
+            next_cursor = EXCLUDED.next_cursor, status = 'running', pages = 0, updated_at = now();
+        """, (map_number, json.dumps(0)))
+    conn.commit()
+    return cursors
+
+# Moves the map checkpoint past the page just written (the caller commits both together)
+def save_checkpoint(cur, map_number, next_cursor):
+    cur.execute("""
+    UPDATE feedback.ingestion_checkpoints SET
+        next_cursor = %s,
+        status = %s,
+        pages = pages + 1,
+        updated_at = now()
+    WHERE map_number = %s;
+    """, (
+        json.dumps(next_cursor) if next_cursor is not None else None,
+        "running" if next_cursor is not None else "done",
+        map_number
+    ))
+
+# Resolves the ids of every criterion in the reviews with two set-based statements: one upsert of all
+# (name, weight) pairs and one SELECT of the ids by name. Adds the ids to criteria_map.
+# Returns the names of the existing criteria whose weight changed.
+def resolve_criteria(cur, reviews, criteria_map):
+    # Build a set of unique (name, weight) from API data
+    unique_criteria = {}
+    for review in reviews:
+        for g in review.get("grades", []):
+            # If the same name appears with different weights, we'll prefer the latest seen value.
+            unique_criteria[g["name"]] = g.get("weight")
+    if not unique_criteria:
+        return set()
+
+    # Only new criteria and changed weights are written; xmax <> 0 tells the updated rows from the inserted ones
+    upsert_query = """
+    INSERT INTO feedback.criteria (name, weight)
+    VALUES %s
+    ON CONFLICT (name) DO UPDATE SET weight = EXCLUDED.weight
+    WHERE feedback.criteria.weight IS DISTINCT FROM EXCLUDED.weight
+    RETURNING name, xmax <> 0
+    """
+    written = execute_values(cur, upsert_query, list(unique_criteria.items()), page_size=BATCH_SIZE, fetch=True)
+
+    # Ids of all criteria of the page, new or not (the upsert only returns rows it wrote)
+    cur.execute("SELECT id, name FROM feedback.criteria WHERE name = ANY(%s);", (list(unique_criteria),))
+    criteria_map.update((name, cid) for cid, name in cur.fetchall())
+    return {name for name, updated in written if updated}
+
+# Builds the feedback.scores rows (review_id, criteria_id, score) of the reviews.
+# Pure assembly: every criterion must already be in criteria_map (see resolve_criteria).
+def build_score_rows(reviews, criteria_map):
+    return [
+        (review.get("id"), criteria_map[g["name"]], g.get("score"))
+        for review in reviews
+        for g in review.get("grades", [])
+    ]
+
+# Hash of the review content in canonical form (sorted keys), used to detect changed reviews
+def review_hash(review):
+    canonical = json.dumps(review, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+# Content hashes of the reviews already loaded, among the given ids: {review_id: hash}
+def load_review_hashes(cur, review_ids):
+    if not review_ids:
+        return {}
+    cur.execute("SELECT review_id, content_hash FROM feedback.reviews WHERE review_id = ANY(%s::text[]);", (review_ids,))
+    return dict(cur.fetchall())
+
+# Records the map and content hash of the loaded reviews
+def save_review_hashes(cur, map_number, hashes):
+    if not hashes:
+        return
+    execute_values(cur, """
+    INSERT INTO feedback.reviews (review_id, map_number, content_hash)
+    VALUES %s
+    ON CONFLICT (review_id) DO UPDATE SET
+        map_number = EXCLUDED.map_number,
+        content_hash = EXCLUDED.content_hash,
+        loaded_at = now();
+    """, [(review_id, map_number, content_hash) for review_id, content_hash in hashes.items()], page_size=BATCH_SIZE)
+
+# Upserts the scores on (review_id, criteria_id), only rewriting rows whose score changed.
+# A key repeated in the rows keeps its last score (one statement can't update the same row twice).
+# Returns how many rows were inserted or updated.
+def upsert_scores(cur, rows):
+    rows = list({(review_id, criteria_id): (review_id, criteria_id, score) for review_id, criteria_id, score in rows}.values())
+    if not rows:
+        return 0
+    upsert_scores_q = """
     INSERT INTO feedback.scores (review_id, criteria_id, score)
     VALUES %s
+    ON CONFLICT (review_id, criteria_id) DO UPDATE SET score = EXCLUDED.score
+    WHERE feedback.scores.score IS DISTINCT FROM EXCLUDED.score
+    RETURNING 1
     """
-    execute_values(cur, insert_scores_q, rows_to_insert)
-    conn.commit()
+    return len(execute_values(cur, upsert_scores_q, rows, page_size=BATCH_SIZE, fetch=True))
+
+# Removes the scores of criteria that no longer appear in reloaded reviews
+def delete_stale_scores(cur, review_ids, rows):
+    if not review_ids:
+        return
+    cur.execute("""
+    DELETE FROM feedback.scores s
+    WHERE s.review_id = ANY(%s::text[])
+      AND NOT EXISTS (
+        SELECT 1 FROM unnest(%s::text[], %s::int[]) AS n(review_id, criteria_id)
+        WHERE n.review_id = s.review_id AND n.criteria_id = s.criteria_id
+    );
+    """, (review_ids, [row[0] for row in rows], [row[1] for row in rows]))
+
+# ---------- Aggregates ----------
+# Scores of the reviews (or of every review, with review_ids=None) with their map and criterion weight.
+# Filters by review_id through the scores unique key; reviews without a feedback.reviews row have no map and are left out.
+def score_contributions(review_ids):
+    where = "s.review_id = ANY(%(review_ids)s::text[])" if review_ids is not None else "TRUE"
+    return f"""
+    WITH contributions AS (
+        SELECT r.map_number, s.review_id, s.criteria_id, s.score, c.weight
+        FROM feedback.scores s
+        JOIN feedback.reviews r ON r.review_id = s.review_id
+        JOIN feedback.criteria c ON c.id = s.criteria_id
+        WHERE {where}
+    )
+    """
+
+# Adds (sign=1) or subtracts (sign=-1) the current scores of the reviews to/from the aggregate tables
+# (review_ids=None adds every review, after the tables were truncated).
+# A load subtracts the reviews it is about to rewrite, writes their scores and adds them back, so only
+# the touched reviews are read. Aggregates left without reviews or scores are removed.
+def apply_score_aggregates(cur, review_ids, sign):
+    if review_ids is not None and not review_ids:
+        return
+    params = {"review_ids": review_ids, "sign": sign}
+    contributions = score_contributions(review_ids)
+
+    if sign < 0:
+        cur.execute("DELETE FROM feedback.review_scores WHERE review_id = ANY(%s::text[]);", (review_ids,))
+    else:
+        cur.execute(contributions + """
+        INSERT INTO feedback.review_scores (review_id, map_number, scores, score_sum, weighted_sum, weight_sum)
+        SELECT review_id, map_number, count(score), coalesce(sum(score), 0),
+               coalesce(sum(weight * score), 0), coalesce(sum(weight) FILTER (WHERE score IS NOT NULL), 0)
+        FROM contributions
+        GROUP BY review_id, map_number
+        ON CONFLICT (review_id) DO UPDATE SET
+            map_number = EXCLUDED.map_number, scores = EXCLUDED.scores, score_sum = EXCLUDED.score_sum,
+            weighted_sum = EXCLUDED.weighted_sum, weight_sum = EXCLUDED.weight_sum, updated_at = now();
+        """, params)
+
+    cur.execute(contributions + """
+    INSERT INTO feedback.project_scores AS p (map_number, reviews, scores, score_sum, weighted_sum, weight_sum)
+    SELECT map_number, %(sign)s * count(DISTINCT review_id), %(sign)s * count(score),
+           %(sign)s * coalesce(sum(score), 0), %(sign)s * coalesce(sum(weight * score), 0),
+           %(sign)s * coalesce(sum(weight) FILTER (WHERE score IS NOT NULL), 0)
+    FROM contributions
+    GROUP BY map_number
+    ON CONFLICT (map_number) DO UPDATE SET
+        reviews = p.reviews + EXCLUDED.reviews, scores = p.scores + EXCLUDED.scores,
+        score_sum = p.score_sum + EXCLUDED.score_sum, weighted_sum = p.weighted_sum + EXCLUDED.weighted_sum,
+        weight_sum = p.weight_sum + EXCLUDED.weight_sum, updated_at = now();
+    """, params)
+
+    cur.execute(contributions + """
+    INSERT INTO feedback.criteria_scores AS a (map_number, criteria_id, reviews, scores, score_sum)
+    SELECT map_number, criteria_id, %(sign)s * count(*), %(sign)s * count(score), %(sign)s * coalesce(sum(score), 0)
+    FROM contributions
+    GROUP BY map_number, criteria_id
+    ON CONFLICT (map_number, criteria_id) DO UPDATE SET
+        reviews = a.reviews + EXCLUDED.reviews, scores = a.scores + EXCLUDED.scores,
+        score_sum = a.score_sum + EXCLUDED.score_sum, updated_at = now();
+    """, params)
+
+    if sign < 0:
+        cur.execute("DELETE FROM feedback.project_scores WHERE reviews <= 0;")
+        cur.execute("DELETE FROM feedback.criteria_scores WHERE reviews <= 0;")
+
+# Recomputes every aggregate from feedback.scores (first run, --compact, or a criterion weight changed)
+def rebuild_score_aggregates(cur):
+    cur.execute(f"TRUNCATE {', '.join(AGGREGATE_TABLES)};")
+    apply_score_aggregates(cur, None, 1)
+
+# Writes one page: criteria, scores (upserted in batches of BATCH_SIZE), review hashes and the map checkpoint,
+# in one transaction. With changed_only, reviews loaded before with the same content are skipped.
+# Reviews without an id can't be keyed in feedback.scores and are left out.
+# Returns (score rows written, reviews skipped, reviews without id).
+def write_page(cur, conn, map_number, reviews, next_cursor, criteria_map, changed_only=CHANGED_ONLY):
+    with stage("expo_api.insert", map=map_number):
+        without_id = sum(1 for review in reviews if review.get("id") is None)
+        reviews = [review for review in reviews if review.get("id") is not None]
+        # Review ids are stored as text (feedback.scores.review_id)
+        hashes = {str(review["id"]): review_hash(review) for review in reviews}
+        known = load_review_hashes(cur, list(hashes))
+        if changed_only:
+            reviews = [review for review in reviews if known.get(str(review["id"])) != hashes[str(review["id"])]]
+        loaded_ids = [str(review["id"]) for review in reviews]
+        skipped = len(hashes) - len(set(loaded_ids))
+
+        reloaded_ids = [review_id for review_id in loaded_ids if review_id in known]
+        apply_score_aggregates(cur, reloaded_ids, -1)
+
+        reweighted = resolve_criteria(cur, reviews, criteria_map)
+        rows_to_insert = build_score_rows(reviews, criteria_map)
+        written = upsert_scores(cur, rows_to_insert)
+        delete_stale_scores(cur, reloaded_ids, rows_to_insert)
+        save_review_hashes(cur, map_number, {review_id: hashes[review_id] for review_id in loaded_ids})
+
+        # A new weight changes the weighted score of every review with that criterion
+        if reweighted:
+            rebuild_score_aggregates(cur)
+        else:
+            apply_score_aggregates(cur, loaded_ids, 1)
+
+        save_checkpoint(cur, map_number, next_cursor)
+        conn.commit()
+        record(rows_written=written)
+    return written, skipped, without_id
+
+# ---------- API ----------
+# Pooled session shared by the map workers, retrying timeouts and 5xx responses with exponential backoff
+def create_session(pool_size=CONCURRENCY):
+    retry = Retry(
+        total=MAX_RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset({"GET", "POST"}),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return instrument_session(session)
 
-cur.close()
-conn.close()
+# Logs in as the map's expositor and returns the headers for the reviews requests
+def login(session, base_url, map_number):
+    resp = session.post(
+        urljoin(base_url, LOGIN_PATH),
+        data={"username": LOGIN_USERNAME.format(map_number=map_number), "password": LOGIN_PASSWORD},
+        headers=LOGIN_HEADERS,
+        timeout=REQUEST_TIMEOUT
+    )
+    resp.raise_for_status()
+    token = resp.json().get("access_token")
+    if not token:
+        raise ValueError(f"Could not obtain access token from login response (map {map_number})")
+    return {"accept": "application/json", "Authorization": f"Bearer {token}"}
+
+# Fetches one page of reviews. The cursor is an offset (sent as skip/limit) or a "next" link.
+# Accepts a plain list of reviews or an object with the reviews under "items"/"results"/"reviews"
+# and an optional "next" link. Returns (reviews, next cursor), the cursor being None on the last page.
+def fetch_page(session, base_url, headers, cursor):
+    if isinstance(cursor, str):
+        resp = session.get(urljoin(base_url, cursor), headers=headers, timeout=REQUEST_TIMEOUT)
+    else:
+        resp = session.get(
+            urljoin(base_url, REVIEWS_PATH), headers=headers,
+            params={"skip": cursor, "limit": PAGE_SIZE}, timeout=REQUEST_TIMEOUT
+        )
+    resp.raise_for_status()
+    body = resp.json()
+
+    next_link = None
+    if isinstance(body, dict):
+        next_link = body.get("next")
+        body = next((body[key] for key in ("items", "results", "reviews") if isinstance(body.get(key), list)), None)
+    if not isinstance(body, list):
+        raise ValueError("API returned unexpected structure (expected list of reviews)")
+
+    if next_link:
+        return body, next_link
+    # Offset pagination: a short page is the last one
+    if isinstance(cursor, int) and len(body) == PAGE_SIZE:
+        return body, cursor + len(body)
+    return body, None
+
+# Puts an item on the pages queue, giving up if the writer stopped
+def put_page(pages, stop, item):
+    while not stop.is_set():
+        try:
+            pages.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+# Fetches every page of a map, from the checkpoint cursor on, and hands each page to the writer.
+# Always ends with a (map_number, None, None) marker, even on error.
+def fetch_map_reviews(session, base_url, map_number, cursor, pages, stop):
+    try:
+        with stage("expo_api.fetch", map=map_number):
+            headers = login(session, base_url, map_number)
+            previous_first_id = None
+            while cursor is not None:
+                reviews, next_cursor = fetch_page(session, base_url, headers, cursor)
+                record(rows_read=len(reviews))
+
+                # A server that ignores skip/limit returns the same full page forever
+                first_id = reviews[0].get("id") if reviews else None
+                if first_id is not None and first_id == previous_first_id:
+                    print(f"Map {map_number}: the API ignored pagination, stopping after the pages already read")
+                    reviews, next_cursor = [], None
+                previous_first_id = first_id
+
+                if not put_page(pages, stop, (map_number, reviews, next_cursor)):
+                    return
+                cursor = next_cursor
+    finally:
+        put_page(pages, stop, (map_number, None, None))
+
+# Ingests the reviews of every map: the maps are fetched concurrently and each page is written as soon
+# as it arrives, committed together with the map checkpoint, so a failed run resumes from the last page written.
+# Returns {"pages", "reviews", "skipped", "scores", "failed_maps"}.
+@instrumented("expo_api.ingest")
+def ingest_reviews(conn, map_numbers, base_url=API_BASE_URL, concurrency=CONCURRENCY, restart=False, changed_only=CHANGED_ONLY):
+    summary = {"pages": 0, "reviews": 0, "skipped": 0, "without_id": 0, "scores": 0, "failed_maps": []}
+    with conn.cursor() as cur:
+        cursors = start_checkpoints(cur, conn, map_numbers, restart)
+        session = create_session(concurrency)
+        pages = queue.Queue(maxsize=MAX_PENDING_PAGES)
+        stop = threading.Event()
+        criteria_map = {}  # name -> id
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {
+                executor.submit(bind(fetch_map_reviews), session, base_url, map_number, cursors[map_number], pages, stop): map_number
+                for map_number in map_numbers
+            }
+            try:
+                running = len(futures)
+                while running:
+                    map_number, reviews, next_cursor = pages.get()
+                    if reviews is None:
+                        running -= 1
+                        continue
+                    written, skipped, without_id = write_page(cur, conn, map_number, reviews, next_cursor, criteria_map, changed_only)
+                    if without_id:
+                        print(f"Map {map_number}: {without_id} reviews without id left out")
+                    summary["scores"] += written
+                    summary["skipped"] += skipped
+                    summary["without_id"] += without_id
+                    summary["pages"] += 1
+                    summary["reviews"] += len(reviews)
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                # Releases the workers if the writer failed
+                stop.set()
+
+        for future, map_number in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Map {map_number} failed (it resumes from its checkpoint next run): {e}")
+                summary["failed_maps"].append(map_number)
+        session.close()
+    return summary
+
+# ---------- Main ----------
+def main(argv=None):
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Loads the Expo reviews into the feedback schema.")
+    parser.add_argument("--maps", type=int, nargs="+", default=MAP_NUMBERS, help="Map (project) numbers to ingest")
+    parser.add_argument("--base-url", default=os.getenv("EXPO_API_URL", API_BASE_URL), help="Expo backend URL (e.g. a local stub server)")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="Maps fetched at the same time")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoints of unfinished runs and start every map over")
+    parser.add_argument("--all-reviews", action="store_true", help="Reload every review, even the ones already loaded unchanged")
+    parser.add_argument("--compact", action="store_true", help="Remove the scores without review_id and the duplicates left by older runs, add the constraints and exit")
+    args = parser.parse_args(argv)
+
+    DB_URL = os.getenv("DATABASE_URL")
+    if not DB_URL:
+        raise ValueError("Set DATABASE_URL in your environment (.env)")
+
+    conn = psycopg2.connect(DB_URL, cursor_factory=MetricsCursor)
+    try:
+        if args.compact:
+            without_review, removed = compact_scores(conn)
+            print(f"Removed {without_review} rows without review_id and {removed} duplicated rows from feedback.scores.")
+            return 0
+        with conn.cursor() as cur:
+            create_tables(cur, conn)
+        summary = ingest_reviews(
+            conn, args.maps, args.base_url, args.concurrency, args.restart, changed_only=not args.all_reviews
+        )
+    finally:
+        conn.close()
+        # Stage metrics for this run (written only if METRICS_PROMETHEUS_FILE is set)
+        write_prometheus()
+
+    print(
+        f"✅ Done: {summary['reviews']} reviews in {summary['pages']} pages "
+        f"({summary['skipped']} unchanged skipped, {summary['without_id']} without id left out), "
+        f"{summary['scores']} scores inserted or changed. Tables in schema 'feedback':"
+    )
+    print(" - feedback.criteria (id serial, name, weight)")
+    print(" - feedback.scores (id serial, review_id not null, criteria_id, score, unique (review_id, criteria_id))")
+    print(" - feedback.reviews (review_id, map_number, content_hash)")
+    print(" - feedback.ingestion_checkpoints (map_number, next_cursor, status, pages)")
+    print(" - feedback.review_scores (review_id, map_number, scores, weighted_score)")
+    print(" - feedback.project_scores (map_number, reviews, scores, weighted_score)")
+    print(" - feedback.criteria_scores (map_number, criteria_id, reviews, scores, avg_score)")
+    return 1 if summary["failed_maps"] else 0
 
-print("✅ Done. Tables in schema 'feedback':")
-print(" - feedback.criteria (id serial, name, weight)")
-print(" - feedback.scores (id serial, review_id, criteria_id, score)")
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# Local stand-in for the Expo backend, used to run expo_api against synthetic reviews:
+#   python expo_stub.py --reviews 100000 --port 8000
+#   EXPO_API_URL=http://localhost:8000 python expo_api.py --maps 1 2 3
+# It answers POST /users/login and GET /reviews/project/?skip=&limit=, and can simulate
+# the onrender cold start (--cold-start) and intermittent 503s (--fail-rate).
+
+# ---------- Configuration ----------
+USERNAME_PATTERN = re.compile(r"project-uuid-(\d+)@")
+DEFAULT_LIMIT = 100
+
+# ---------- Synthetic data ----------
+# Builds a review of a map, always the same for the same (map, index) pair
+def synthetic_review(map_number, index, criteria):
+    rnd = random.Random(map_number * 1_000_003 + index)
+    return {
+        "id": f"review-{map_number}-{index}",
+        "grades": [
+            {"name": f"Criterion {c}", "weight": 1 + c % 3, "score": rnd.randint(0, 10)}
+            for c in range(criteria)
+        ]
+    }
+
+# ---------- Server ----------
+class ExpoStubHandler(BaseHTTPRequestHandler):
+    server_version = "ExpoStub/1.0"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    # Cold start (first request only) and random 503s, like the real backend on onrender
+    def simulate_flakiness(self):
+        with self.server.lock:
+            cold = not self.server.warm
+            self.server.warm = True
+        if cold and self.server.cold_start:
+            time.sleep(self.server.cold_start)
+        if self.server.rnd.random() < self.server.fail_rate:
+            self.send_json(503, {"detail": "Service Unavailable"})
+            return True
+        return False
+
+    def do_POST(self):
+        if self.simulate_flakiness():
+            return
+        if urlparse(self.path).path.rstrip("/") != "/users/login":
+            self.send_json(404, {"detail": "Not Found"})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        form = parse_qs(self.rfile.read(length).decode("utf-8"))
+        match = USERNAME_PATTERN.search(form.get("username", [""])[0])
+        if not match:
+            self.send_json(401, {"detail": "Incorrect username or password"})
+            return
+        self.send_json(200, {"access_token": f"stub-token-{match.group(1)}", "token_type": "bearer"})
+
+    def do_GET(self):
+        if self.simulate_flakiness():
+            return
+        url = urlparse(self.path)
+        if url.path.rstrip("/") != "/reviews/project":
+            self.send_json(404, {"detail": "Not Found"})
+            return
+        token = self.headers.get("Authorization", "")
+        if not token.startswith("Bearer stub-token-"):
+            self.send_json(401, {"detail": "Not authenticated"})
+            return
+        map_number = int(token.rsplit("-", 1)[1])
+        query = parse_qs(url.query)
+        skip = int(query.get("skip", ["0"])[0])
+        limit = int(query.get("limit", [str(DEFAULT_LIMIT)])[0])
+        end = min(skip + limit, self.server.reviews)
+        self.send_json(200, [synthetic_review(map_number, i, self.server.criteria) for i in range(skip, end)])
+
+# Creates the stub server (call serve_forever, or use it from a thread in a test)
+def create_stub_server(port=8000, reviews=1000, criteria=5, cold_start=0.0, fail_rate=0.0, seed=42, verbose=False):
+    server = ThreadingHTTPServer(("127.0.0.1", port), ExpoStubHandler)
+    server.reviews = reviews
+    server.criteria = criteria
+    server.cold_start = cold_start
+    server.fail_rate = fail_rate
+    server.rnd = random.Random(seed)
+    server.lock = threading.Lock()
+    server.warm = False
+    server.verbose = verbose
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stub of the Expo backend for expo_api.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--reviews", type=int, default=1000, help="Reviews per map")
+    parser.add_argument("--criteria", type=int, default=5, help="Grades per review")
+    parser.add_argument("--cold-start", type=float, default=0.0, help="Delay (seconds) of the first request")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of requests answered with 503")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    server = create_stub_server(args.port, args.reviews, args.criteria, args.cold_start, args.fail_rate, verbose=args.verbose)
+    print(f"Expo stub listening on http://127.0.0.1:{args.port} ({args.reviews} reviews per map)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,277 @@
+# Importações
+import os
+import sys
+import json
+import time
+import uuid
+import threading
+from functools import wraps
+from contextlib import contextmanager
+import psycopg2.extensions
+from pymongo import monitoring
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-= CONFIGURAÇÕES -=-=-=-=-=-=-=-=-=-=-=-=-=
+# Variáveis de ambiente (lidas na hora de escrever, depois do load_dotenv dos scripts):
+# METRICS_LOG_FILE: arquivo com os logs JSON das etapas (uma linha por etapa). Sem ele, os logs vão para o stderr.
+# METRICS_PROMETHEUS_FILE: arquivo .prom no formato textfile do Prometheus (node_exporter), reescrito no final da execução.
+
+# Contadores registrados em cada etapa
+COUNTERS = ("rows_read", "rows_written", "round_trips", "bytes")
+
+# Identificador da execução (liga as linhas de log de uma mesma execução)
+RUN_ID = uuid.uuid4().hex
+
+# Totais por etapa nesta execução (usados no arquivo do Prometheus): {etapa: {"calls", "errors", "seconds", contadores...}}
+TOTALS = {}
+TOTALS_LOCK = threading.Lock()
+LOG_LOCK = threading.Lock()
+
+# Pilha de etapas em andamento de cada thread
+_local = threading.local()
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-= ETAPAS -=-=-=-=-=-=-=-=-=-=-=-=-=
+# Métricas de uma execução de uma etapa. Os contadores podem ser somados por várias threads ao mesmo tempo.
+class StageMetrics:
+    def __init__(self, name, labels=None):
+        self.name = name
+        self.labels = dict(labels or {})
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.status = "ok"
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, **counters):
+        with self._lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+# Etapa em andamento na thread atual (None se não houver)
+def current_stage():
+    stack = _stack()
+    return stack[-1] if stack else None
+
+# Soma contadores em todas as etapas em andamento na thread atual (uma etapa inclui as etapas internas)
+def record(**counters):
+    for stage_metrics in _stack():
+        stage_metrics.add(**counters)
+
+# Adiciona rótulos (ex.: nome da tabela) à etapa em andamento
+def label(**labels):
+    stage_metrics = current_stage()
+    if stage_metrics is not None:
+        stage_metrics.labels.update(labels)
+
+# Marca a etapa em andamento como erro (para funções que tratam o próprio erro)
+def mark_error():
+    stage_metrics = current_stage()
+    if stage_metrics is not None:
+        stage_metrics.status = "error"
+
+# Liga a função às etapas em andamento na thread atual, para que ela conte nessas etapas
+# mesmo rodando em outra thread (ThreadPoolExecutor)
+def bind(func):
+    parents = list(_stack())
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        stack = _stack()
+        saved = list(stack)
+        stack[:] = parents
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stack[:] = saved
+    return wrapper
+
+# Mede uma etapa: tempo de relógio e contadores; no final grava a linha de log JSON e soma nos totais
+@contextmanager
+def stage(name, **labels):
+    stage_metrics = StageMetrics(name, labels)
+    stack = _stack()
+    stack.append(stage_metrics)
+    start = time.perf_counter()
+    try:
+        yield stage_metrics
+    except BaseException:
+        stage_metrics.status = "error"
+        raise
+    finally:
+        stage_metrics.seconds = time.perf_counter() - start
+        stack.remove(stage_metrics)
+        finish_stage(stage_metrics)
+
+# Decorador que mede cada chamada da função como uma etapa.
+# "counters" recebe o retorno da função e devolve contadores extras (ex.: linhas gravadas do relatório);
+# com "fail_on_none" o retorno None (funções que tratam o próprio erro) marca a etapa como erro.
+def instrumented(name, counters=None, fail_on_none=False):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name) as stage_metrics:
+                result = func(*args, **kwargs)
+                if result is None and fail_on_none:
+                    stage_metrics.status = "error"
+                elif counters is not None and result is not None:
+                    record(**counters(result))
+                return result
+        return wrapper
+    return decorator
+
+# Linhas gravadas de acordo com o relatório das sincronizações (sync_table, merge_table, sync_collection)
+def report_counters(report):
+    return {"rows_written": report["inserted"] + report["updated"] + report["deleted"]}
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-= SAÍDA -=-=-=-=-=-=-=-=-=-=-=-=-=
+# Grava a linha de log JSON da etapa e soma a etapa nos totais da execução
+def finish_stage(stage_metrics):
+    line = {
+        "event": "stage",
+        "run_id": RUN_ID,
+        "ts": time.time(),
+        "stage": stage_metrics.name,
+        "status": stage_metrics.status,
+        "seconds": round(stage_metrics.seconds, 6),
+        **stage_metrics.counters
+    }
+    if stage_metrics.labels:
+        line["labels"] = stage_metrics.labels
+    write_log(json.dumps(line, ensure_ascii=False, default=str))
+
+    with TOTALS_LOCK:
+        totals = TOTALS.setdefault(stage_metrics.name, {"calls": 0, "errors": 0, "seconds": 0.0, **dict.fromkeys(COUNTERS, 0)})
+        totals["calls"] += 1
+        totals["errors"] += stage_metrics.status != "ok"
+        totals["seconds"] += stage_metrics.seconds
+        for key in COUNTERS:
+            totals[key] += stage_metrics.counters.get(key, 0)
+
+# Escreve uma linha de log no arquivo de METRICS_LOG_FILE (ou no stderr)
+def write_log(line):
+    log_path = os.getenv("METRICS_LOG_FILE")
+    with LOG_LOCK:
+        if log_path:
+            with open(log_path, "a", encoding="utf-8") as log_file:
+                log_file.write(line + "\n")
+        else:
+            print(line, file=sys.stderr)
+
+# Escreve os totais da execução no formato textfile do Prometheus. O arquivo é escrito em um temporário
+# e renomeado, para o node_exporter nunca ler um arquivo pela metade.
+def write_prometheus(path=None):
+    path = path or os.getenv("METRICS_PROMETHEUS_FILE")
+    if not path:
+        return
+    metrics = [
+        ("rpa_stage_calls", "calls", "Execuções da etapa na última execução do RPA"),
+        ("rpa_stage_errors", "errors", "Execuções da etapa que terminaram com erro"),
+        ("rpa_stage_seconds", "seconds", "Tempo de relógio da etapa (segundos)"),
+        ("rpa_stage_rows_read", "rows_read", "Linhas lidas pela etapa"),
+        ("rpa_stage_rows_written", "rows_written", "Linhas gravadas pela etapa"),
+        ("rpa_stage_round_trips", "round_trips", "Idas e voltas aos bancos, ao site de leis e à API da Expo"),
+        ("rpa_stage_bytes", "bytes", "Bytes trafegados (queries, COPY e respostas HTTP)")
+    ]
+    with TOTALS_LOCK:
+        totals = {name: dict(values) for name, values in TOTALS.items()}
+
+    lines = []
+    for metric, key, help_text in metrics:
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} gauge")
+        for name in sorted(totals):
+            lines.append(f'{metric}{{stage="{name}"}} {totals[name][key]}')
+    lines.append("# HELP rpa_last_run_timestamp_seconds Fim da última execução do RPA")
+    lines.append("# TYPE rpa_last_run_timestamp_seconds gauge")
+    lines.append(f"rpa_last_run_timestamp_seconds {time.time():.0f}")
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as prom_file:
+        prom_file.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-= INSTRUMENTAÇÃO DOS CLIENTES -=-=-=-=-=-=-=-=-=-=-=-=-=
+# Arquivo que conta os bytes lidos/escritos (usado nos COPY)
+class CountingFile:
+    def __init__(self, file):
+        self.file = file
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        record(bytes=len(data))
+        return data
+
+    def readline(self, size=-1):
+        data = self.file.readline(size)
+        record(bytes=len(data))
+        return data
+
+    def write(self, data):
+        record(bytes=len(data))
+        return self.file.write(data)
+
+# Cursor do psycopg2 que conta as idas ao banco, as linhas lidas e os bytes enviados (texto das queries).
+# Use com psycopg2.connect(url, cursor_factory=MetricsCursor); vale também para os cursores nomeados.
+class MetricsCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        try:
+            return super().execute(query, vars)
+        finally:
+            record(round_trips=1, bytes=len(self.query or b""))
+
+    def copy_expert(self, sql, file, size=8192):
+        try:
+            return super().copy_expert(sql, CountingFile(file), size)
+        finally:
+            record(round_trips=1)
+
+    def fetchone(self):
+        row = super().fetchone()
+        record(rows_read=row is not None, round_trips=self.name is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        record(rows_read=len(rows), round_trips=self.name is not None)
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        record(rows_read=len(rows), round_trips=self.name is not None)
+        return rows
+
+    # Cursores nomeados buscam "itersize" linhas por ida ao banco; os outros já têm o resultado inteiro na memória
+    def __iter__(self):
+        if self.name is None:
+            yield from self.fetchall()
+            return
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            yield from rows
+
+# Listener do pymongo que conta cada comando enviado ao MongoDB como uma ida ao banco.
+# Use com MongoClient(url, event_listeners=[MongoMetricsListener()]).
+class MongoMetricsListener(monitoring.CommandListener):
+    def started(self, event):
+        record(round_trips=1)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+# Hook do requests que conta cada resposta HTTP (ida ao servidor e bytes recebidos).
+# Use em requests.get(..., hooks={"response": count_response}) ou com instrument_session.
+def count_response(response, *args, **kwargs):
+    record(round_trips=1, bytes=len(response.content))
+
+# Conta as respostas HTTP de todas as requisições de uma sessão do requests
+def instrument_session(session):
+    session.hooks["response"].append(count_response)
+    return session
@@ -0,0 +1,321 @@
+# Importações
+import os
+import sys
+import time
+import argparse
+import psycopg2
+from psycopg2.extras import execute_values
+from pymongo import MongoClient
+from dotenv import load_dotenv
+
+from schema_staging import (
+    TRANSFER_CONCURRENCY, create_staging_schema, get_foreign_keys, sync_schema,
+    transfer_data, transfer_data_parallel, create_transfer_control, load_table_versions
+)
+from metrics import stage, mark_error, write_prometheus, MetricsCursor, MongoMetricsListener
+from collect_data import (
+    IN_DATABASE, update_plans, update_segments, update_workers,
+    update_activities, enrich_laws, update_classes, find_stale_laws
+)
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-= CONFIGURAÇÕES -=-=-=-=-=-=-=-=-=-=-=-=-=
+# Status de cada etapa
+STAGE_OK = "ok"
+STAGE_SKIPPED = "skipped"
+STAGE_FAILED = "failed"
+STAGE_BLOCKED = "blocked"
+
+# Etapas do pipeline (DAG): {etapa: (etapas das quais depende, tabelas do staging que ela lê)}.
+# Uma etapa só roda se alguma das tabelas que ela lê tem alterações que ela ainda não processou com sucesso
+# (versões em rpa.table_versions x rpa.stage_progress), ou com --force.
+# "laws" lê as mesmas tabelas de "classes" porque a collection precisa das descrições de todas as suas leis.
+CLASS_TABLES = {"aula", "modulo", "texto_corrido", "flash_card", "lei"}
+STAGES = {
+    "staging": ((), set()),
+    "plans": (("staging",), {"assinatura"}),
+    "segments": (("staging",), {"curso"}),
+    "workers": (("staging",), {"produtor", "fornecedor"}),
+    "activities": (("staging",), {"atividade", "pergunta", "alternativa"}),
+    "laws": (("staging",), CLASS_TABLES),
+    "classes": (("laws",), CLASS_TABLES)
+}
+
+# Etapas que também rodam quando alguma lei das aulas está sem descrição válida no cache: as entradas do
+# rpa.law_cache vencem pelo prazo do status (LAW_CACHE_TTL_DAYS), sem nenhuma alteração no staging
+LAW_CACHE_STAGES = {"laws", "classes"}
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-= CONTROLE DAS ETAPAS -=-=-=-=-=-=-=-=-=-=-=-=-=
+# Cria a tabela com a versão de cada tabela do staging que cada etapa já processou com sucesso
+def create_stage_control(cur, conn):
+    create_transfer_control(cur, conn)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS rpa.stage_progress (
+        stage TEXT NOT NULL,
+        table_name TEXT NOT NULL,
+        version BIGINT NOT NULL,
+        processed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (stage, table_name)
+    );
+    """)
+    conn.commit()
+
+# Versões já processadas: {(etapa, tabela): versão}
+def load_stage_progress(cur):
+    cur.execute("SELECT stage, table_name, version FROM rpa.stage_progress;")
+    return {(stage, table): version for stage, table, version in cur.fetchall()}
+
+# Registra que a etapa processou as tabelas nas versões lidas depois da transferência
+def save_stage_progress(cur, conn, name, tables, versions):
+    rows = [(name, table, versions.get(table, 0)) for table in tables]
+    if rows:
+        execute_values(cur, """
+        INSERT INTO rpa.stage_progress (stage, table_name, version) VALUES %s
+        ON CONFLICT (stage, table_name) DO UPDATE SET version = EXCLUDED.version, processed_at = now();
+        """, rows)
+    conn.commit()
+
+# Tabelas com alterações ainda não processadas pela etapa. Inclui as pendentes das etapas que dependem
+# dela (ex.: "laws" roda sempre que "classes" for rodar, porque "classes" usa as descrições resolvidas).
+def pending_tables(name, ctx):
+    _, tables = STAGES[name]
+    # Tabela que a etapa nunca processou (ex.: primeira execução) também conta como pendente
+    progress = ctx["stage_progress"]
+    pending = {
+        table for table in tables
+        if (name, table) not in progress or ctx["table_versions"].get(table, 0) > progress[(name, table)]
+    }
+    for child, (deps, _) in STAGES.items():
+        if name in deps:
+            pending |= pending_tables(child, ctx)
+    return pending
+
+# Leis das aulas sem entrada válida no cache (consultado uma vez, antes da etapa "laws", e guardado no contexto
+# para "classes" gravar as descrições que "laws" pesquisar)
+def stale_laws(ctx):
+    if ctx["stale_laws"] is None:
+        ctx["stale_laws"] = find_stale_laws(ctx["cur_dest"])
+        ctx["conn_dest"].commit()
+    return ctx["stale_laws"]
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-= ETAPAS -=-=-=-=-=-=-=-=-=-=-=-=-=
+# Sincroniza a estrutura e transfere os dados para o staging. Guarda no contexto as versões das tabelas
+# depois da transferência e as tabelas que deram erro.
+def run_staging(ctx):
+    args = ctx["args"]
+    create_staging_schema(ctx["conn_dest"], ctx["cur_dest"])
+
+    print("\nSincronizando a estrutura das tabelas no schema 'staging':")
+    sync_schema(ctx["cur_src"], ctx["cur_dest"], ctx["conn_dest"], "staging")
+
+    print("\nTransferindo os dados para o schema 'staging':")
+    incremental = args.full_resync != []
+    if args.concurrency > 1:
+        # A transferência paralela abre os seus próprios pools (até "concurrency" conexões com cada banco)
+        foreign_keys = get_foreign_keys(ctx["cur_src"], "public")
+        results = transfer_data_parallel(
+            ctx["src_url"], ctx["dest_url"], foreign_keys, "staging",
+            incremental=incremental, full_tables=args.full_resync, concurrency=args.concurrency
+        )
+    else:
+        results = transfer_data(
+            ctx["cur_src"], ctx["cur_dest"], ctx["conn_dest"], "staging",
+            incremental=incremental, full_tables=args.full_resync
+        )
+
+    ctx["failed_tables"] = {r["table"] for r in results if r["status"] == "error"}
+    ctx["table_versions"] = load_table_versions(ctx["cur_dest"])
+    ctx["conn_dest"].commit()
+    changed = sorted(r["table"] for r in results if r["status"] == "ok" and (r["changed"] or r["deleted"]))
+    print(f"\nTabelas alteradas no staging nesta execução: {changed or 'nenhuma'}")
+    return True
+
+# Etapas relacionais (retornam False quando a função de sincronização falhou)
+def run_plans(ctx):
+    return update_plans(ctx["cur_dest"], ctx["conn_dest"], IN_DATABASE) is not None
+
+def run_segments(ctx):
+    return update_segments(ctx["cur_dest"], ctx["conn_dest"], IN_DATABASE) is not None
+
+def run_workers(ctx):
+    return update_workers(ctx["cur_dest"], ctx["conn_dest"], IN_DATABASE) is not None
+
+# Etapas do MongoDB (erros em lotes do bulk_write também contam como falha)
+def run_activities(ctx):
+    report = update_activities(ctx["mongo"]["activities"], ctx["cur_dest"])
+    return report is not None and not report["errors"]
+
+# Resolve as descrições das leis uma única vez para a collection classes
+def run_laws(ctx):
+    ctx["law_descriptions"] = enrich_laws(ctx["cur_dest"], ctx["args"].refresh_laws)
+    return True
+
+# Monta a collection classes com as descrições resolvidas na etapa "laws"
+def run_classes(ctx):
+    report = update_classes(
+        ctx["mongo"]["classes"], ctx["cur_dest"], law_descriptions=ctx["law_descriptions"]
+    )
+    return report is not None and not report["errors"]
+
+# Função de cada etapa
+STAGE_RUNNERS = {
+    "staging": run_staging,
+    "plans": run_plans,
+    "segments": run_segments,
+    "workers": run_workers,
+    "activities": run_activities,
+    "laws": run_laws,
+    "classes": run_classes
+}
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-= ORQUESTRAÇÃO -=-=-=-=-=-=-=-=-=-=-=-=-=
+# Ordena as etapas de forma que cada uma venha depois das etapas das quais depende
+def stage_order(stages):
+    order = []
+    pending = dict(stages)
+    while pending:
+        ready = [name for name, (deps, _) in pending.items() if all(dep in order for dep in deps)]
+        if not ready:
+            raise ValueError(f"Ciclo entre as etapas {sorted(pending)}")
+        for name in ready:
+            order.append(name)
+            pending.pop(name)
+    return order
+
+# Decide o que fazer com a etapa antes de executá-la: None para executar ou o status (blocked/skipped) com o motivo
+def stage_decision(name, ctx, statuses):
+    deps, tables = STAGES[name]
+    failed_deps = [dep for dep in deps if statuses.get(dep) in (STAGE_FAILED, STAGE_BLOCKED)]
+    if failed_deps:
+        return STAGE_BLOCKED, f"dependência falhou: {', '.join(failed_deps)}"
+    failed_tables = tables & ctx["failed_tables"]
+    if failed_tables:
+        return STAGE_BLOCKED, f"tabelas com erro na transferência: {', '.join(sorted(failed_tables))}"
+    if not tables or ctx["args"].force or name in ctx["forced_stages"]:
+        return None
+    if pending_tables(name, ctx):
+        return None
+    if name not in LAW_CACHE_STAGES:
+        return STAGE_SKIPPED, "nenhuma alteração pendente nas tabelas do staging"
+    if stale_laws(ctx):
+        print(f"\n[{name}] {len(stale_laws(ctx))} leis sem descrição válida no cache")
+        return None
+    return STAGE_SKIPPED, "nenhuma alteração pendente nas tabelas do staging nem leis vencidas no cache"
+
+# Executa as etapas na ordem do DAG. Retorna {etapa: (status, segundos, motivo)}
+def run_pipeline(ctx):
+    statuses = {}
+    summary = {}
+    for name in stage_order(STAGES):
+        decision = stage_decision(name, ctx, statuses)
+        if decision is not None:
+            statuses[name] = decision[0]
+            summary[name] = (decision[0], 0.0, decision[1])
+            print(f"\n[{name}] {decision[0]}: {decision[1]}")
+            continue
+
+        print(f"\n[{name}] executando...")
+        start = time.perf_counter()
+        reason = ""
+        try:
+            with stage(f"pipeline.{name}"):
+                ok = STAGE_RUNNERS[name](ctx)
+                if ok:
+                    # Só uma etapa concluída consome as alterações; se falhar, elas continuam pendentes para a próxima execução
+                    save_stage_progress(ctx["cur_dest"], ctx["conn_dest"], name, STAGES[name][1], ctx["table_versions"])
+                else:
+                    mark_error()
+        except Exception as e:
+            ok = False
+            reason = str(e)
+            print(f"Erro na etapa '{name}': {e}")
+        if not ok:
+            # Desfaz o que ficou pendente para não deixar a conexão compartilhada em uma transação abortada
+            ctx["conn_dest"].rollback()
+            ctx["cur_src"].connection.rollback()
+        statuses[name] = STAGE_OK if ok else STAGE_FAILED
+        summary[name] = (statuses[name], time.perf_counter() - start, reason)
+    return summary
+
+# Imprime o status e o tempo de cada etapa
+def print_pipeline_summary(summary, failed_tables):
+    print("\nResumo do pipeline (etapa: status, tempo):")
+    for name, (status, seconds, reason) in summary.items():
+        detail = f" ({reason})" if reason else ""
+        print(f" - {name}: {status}, {seconds:.2f}s{detail}")
+    if failed_tables:
+        print(f"Tabelas com erro na transferência: {', '.join(sorted(failed_tables))}")
+
+# Função principal: roda o pipeline inteiro com uma conexão para cada banco e retorna o código de saída
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Executa o RPA completo: staging, PostgreSQL, leis e MongoDB.")
+    parser.add_argument(
+        "--full-resync", nargs="*", default=None, metavar="TABELA",
+        help="Ignora as marcas d'água e transfere por completo as tabelas informadas (ou todas, se nenhuma for informada)"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=TRANSFER_CONCURRENCY,
+        help="Quantidade máxima de tabelas transferidas ao mesmo tempo (1 = uma por vez, usando só as conexões do pipeline; "
+             "acima de 1 a transferência abre um pool próprio com até essa quantidade de conexões com cada banco)"
+    )
+    parser.add_argument(
+        "--refresh-laws", nargs="+", default=[], metavar="LEI",
+        help="Leis que devem ser pesquisadas novamente no site, ignorando o cache (ex.: \"Lei 1.234/2020\")"
+    )
+    parser.add_argument(
+        "--force", action="store_true",
+        help="Executa todas as etapas, mesmo as que não têm alterações pendentes no staging"
+    )
+    args = parser.parse_args(argv)
+
+    # Carrega as envs
+    load_dotenv()
+    src_url = os.getenv("POSTGRES_URL_1")
+    dest_url = os.getenv("POSTGRES_URL_2")
+
+    conn_src = conn_dest = client = None
+    try:
+        # Uma conexão com cada banco, usada por todas as etapas (a transferência com --concurrency > 1
+        # abre, só durante a transferência, os seus próprios pools de conexões)
+        conn_src = psycopg2.connect(src_url, cursor_factory=MetricsCursor)
+        conn_dest = psycopg2.connect(dest_url, cursor_factory=MetricsCursor)
+        client = MongoClient(os.getenv("MONGODB_URL"), event_listeners=[MongoMetricsListener()])
+
+        with conn_src.cursor() as cur_src, conn_dest.cursor() as cur_dest:
+            create_stage_control(cur_dest, conn_dest)
+            ctx = {
+                "args": args,
+                "src_url": src_url,
+                "dest_url": dest_url,
+                "cur_src": cur_src,
+                "cur_dest": cur_dest,
+                "conn_dest": conn_dest,
+                "mongo": client["Zeta"],
+                "table_versions": {},
+                "stage_progress": load_stage_progress(cur_dest),
+                "failed_tables": set(),
+                # Leis pedidas para nova pesquisa obrigam a refazer as leis e a collection classes
+                "forced_stages": {"laws", "classes"} if args.refresh_laws else set(),
+                "stale_laws": None,
+                "law_descriptions": None
+            }
+            start = time.perf_counter()
+            summary = run_pipeline(ctx)
+            print_pipeline_summary(summary, ctx["failed_tables"])
+            print(f"Tempo total: {time.perf_counter() - start:.2f}s")
+    except Exception as e:
+        print(f"Erro ao executar o pipeline: {e}")
+        return 1
+    finally:
+        # Fecha as conexões
+        for resource in (conn_src, conn_dest, client):
+            if resource is not None:
+                resource.close()
+
+        # Métricas das etapas desta execução (se METRICS_PROMETHEUS_FILE estiver configurado)
+        write_prometheus()
+
+    failed = [name for name, (status, _, _) in summary.items() if status in (STAGE_FAILED, STAGE_BLOCKED)]
+    return 1 if failed or ctx["failed_tables"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,28 @@
 # Importações
 import psycopg2
 import os
+import time
+import argparse
+import threading
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from psycopg2.pool import ThreadedConnectionPool
 from dotenv import load_dotenv
+from metrics import instrumented, label, mark_error, record, bind, write_prometheus, MetricsCursor
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-= CONFIGURAÇÕES -=-=-=-=-=-=-=-=-=-=-=-=-=
+# Tamanho (em bytes) dos blocos lidos/escritos pelo COPY entre os dois bancos
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Quantidade máxima de tabelas transferidas ao mesmo tempo (1 = uma por vez)
+TRANSFER_CONCURRENCY = 4
+
+# Recuo da marca d'água do updated_at: linhas com updated_at até esse tempo antes da marca são lidas de novo
+# (transações longas que terminam depois da leitura com um updated_at anterior, relógios diferentes)
+UPDATED_AT_OVERLAP = timedelta(minutes=10)
+
+# Catálogo (estrutura) de cada banco/schema lido nesta execução: {(dsn, schema): catálogo}
+CATALOG_CACHE = {}
 
 # -=-=-=-=-=-=-=-=-=-=-=-=-= FUNÇÕES -=-=-=-=-=-=-=-=-=-=-=-=-=
 # Criação do schema staging caso não exista
@@ -22,301 +43,631 @@ def create_staging_schema(conn, cur):
         conn.rollback()
 
 
-# Como base na tabela infomation_schema pega todas as tabelas e suas respectivas colunas, tipo do dado e se é nulo ou não
-def get_tables_columns(cur):
-    # Pega todas as tabelas do banco
-    cur.execute('''
-    SELECT table_name
-    FROM information_schema.tables
-    WHERE table_schema = 'public';
-    ''')
-    tables = cur.fetchall()
-
-    # cria um dicionário com a estrutura do banco
-    structure = {}
-    for table in tables:
-        table_name = table[0]
-        cur.execute(f'''
-        SELECT column_name, data_type, is_nullable, character_maximum_length
-        FROM information_schema.columns
-        WHERE table_name = '{table_name}'
-        ORDER BY ordinal_position;
-        ''')
-        columns = cur.fetchall()
-
-        # Armazena as colunas nesse dicionário
-        structure[table_name] = columns
-        
-    return structure
-
-
-# Cria as querys de CREATE TABLE e executa isso no banco do segundo ano, no schema staging
-def create_tables(cur, conn, structure, schema="staging"):
-    for table, columns in structure.items():
-        column_line = []
-
-        for column in columns:
-            column_name = column[0] # Pegar o nome da coluna
-            data_type = column[1].upper() # Pegar o tipo da coluna
-            nullable = "NOT NULL" if column[2] == "NO" else "" # list comprehension para verificar se é nulo ou não
-            character_maximum_length = column[3] # Pegar o tamanho máximo do caractere (caso seja varchar)
-
-            if column_name.lower() == "id": # Verifica se o nome da coluna é "id"
-                data_type = "SERIAL PRIMARY KEY"
-            else: 
-                if data_type.lower() == "character varying": # Verifica se o tipo é varchar e trasnforma em TEXT
-                    data_type = f"VARCHAR ({character_maximum_length})" 
-                
-            column_line.append(f"{column_name} {data_type} {nullable}")
-
-        # Junta as as linhas separando-as com vírgulas (,)
-        column_definition = ", ".join(column_line)
-
-        # Cria a query para criar as tabelas com as colunas
-        create_query = f"CREATE TABLE IF NOT EXISTS {schema}.{table} ({column_definition});"
+# Lê de uma vez (uma única query no pg_catalog) a estrutura de um schema: tabelas com as suas colunas
+# (nome, tipo, se aceita nulo, tamanho máximo), o tipo de cada relação (relkind: 'r'/'p' tabela,
+# 'v' view, 'f' tabela estrangeira), chaves primárias e FKs. O resultado fica em cache
+# durante a execução; use refresh=True depois de alterar a estrutura do schema.
+def get_catalog(cur, schema="public", refresh=False):
+    cache_key = (cur.connection.dsn, schema)
+    if not refresh and cache_key in CATALOG_CACHE:
+        return CATALOG_CACHE[cache_key]
+
+    cur.execute("""
+    WITH rel AS (
+        SELECT c.oid, c.relname, c.relkind
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %(schema)s AND c.relkind IN ('r', 'p', 'v', 'f')
+    )
+    SELECT
+        (
+            SELECT json_object_agg(rel.relname, rel.relkind) FROM rel
+        ) AS kinds,
+        (
+            SELECT json_agg(json_build_array(
+                rel.relname,
+                a.attname,
+                format_type(a.atttypid, NULL),
+                CASE WHEN a.attnotnull THEN 'NO' ELSE 'YES' END,
+                CASE WHEN a.atttypid IN ('varchar'::regtype, 'bpchar'::regtype) AND a.atttypmod > 0 THEN a.atttypmod - 4 END
+            ) ORDER BY rel.relname, a.attnum)
+            FROM rel
+            JOIN pg_attribute a ON a.attrelid = rel.oid AND a.attnum > 0 AND NOT a.attisdropped
+        ) AS columns,
+        (
+            SELECT json_agg(json_build_array(rel.relname, a.attname) ORDER BY rel.relname, a.attnum)
+            FROM rel
+            JOIN pg_constraint pk ON pk.conrelid = rel.oid AND pk.contype = 'p'
+            JOIN pg_attribute a ON a.attrelid = rel.oid AND a.attnum = ANY(pk.conkey)
+        ) AS primary_keys,
+        (
+            SELECT json_agg(json_build_array(rel.relname, a.attname, tr.relname, ar.attname, tc.conname) ORDER BY rel.relname, tc.conname)
+            FROM rel
+            JOIN pg_constraint tc ON tc.conrelid = rel.oid AND tc.contype = 'f'
+            JOIN pg_attribute a ON a.attrelid = rel.oid AND a.attnum = ANY(tc.conkey)
+            JOIN pg_class tr ON tr.oid = tc.confrelid
+            JOIN pg_attribute ar ON ar.attrelid = tr.oid AND ar.attnum = ANY(tc.confkey)
+        ) AS foreign_keys;
+    """, {"schema": schema})
+    kinds, columns, primary_keys, foreign_keys = cur.fetchone()
+
+    # Monta o catálogo no mesmo formato que as funções abaixo já usavam
+    tables = {}
+    for table_name, column_name, data_type, is_nullable, char_max in columns or []:
+        tables.setdefault(table_name, []).append((column_name, data_type, is_nullable, char_max))
+    pks = {}
+    for table_name, column_name in primary_keys or []:
+        pks.setdefault(table_name, []).append(column_name)
+
+    catalog = {
+        "tables": tables,
+        "kinds": kinds or {},
+        "primary_keys": pks,
+        "foreign_keys": [tuple(fk) for fk in foreign_keys or []]
+    }
+    CATALOG_CACHE[cache_key] = catalog
+    return catalog
 
-        try:
-            cur.execute(create_query)
-            conn.commit()
-            print(f"A tabela {table} foi criada com sucesso.")
-        except Exception as e:
-            print(f"Erro ao criar a tabela {table}: {e}. Tente novamente mais tarde.\n")
 
 # Retorna as FKs do banco de origem (banco do primeiro ano)
+# Cada FK: (tabela_origem, coluna_origem, tabela_referenciada, coluna_referenciada, nome_constraint)
 def get_foreign_keys(cur, schema="public"):
-    query_fk = """ 
-    SELECT
-        t.relname AS tabela_origem,
-        a.attname AS coluna_origem,
-        tr.relname AS tabela_referenciada,
-        ar.attname AS coluna_referenciada,
-        tc.conname AS nome_constraint
-    FROM pg_constraint tc
-    JOIN pg_class t ON t.oid = tc.conrelid
-    JOIN pg_namespace tn ON tn.oid = t.relnamespace
-    JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = ANY(tc.conkey)
-    JOIN pg_class tr ON tr.oid = tc.confrelid
-    JOIN pg_namespace trn ON trn.oid = tr.relnamespace
-    JOIN pg_attribute ar ON ar.attrelid = tr.oid AND ar.attnum = ANY(tc.confkey)
-    WHERE tc.contype = 'f'
-      AND tn.nspname = %s
-    ORDER BY t.relname, tc.conname;  
-    """
-     # Executa a query para pegar as FKs
-    cur.execute(query_fk, (schema,))
-    foreign_keys = cur.fetchall()
-    return foreign_keys
-
-# Cria as FKs no banco de destino (banco do segundo ano)
-def create_foreign_keys(cur, conn, foreign_keys, schema="staging"):
-    # Itera cada FK e cria a query de ALTER TABLE para adicionar a FK
-    for fk in foreign_keys:
-        tabela_origem = fk[0]
-        coluna_origem = fk[1]
-        tabela_referenciada = fk[2]
-        coluna_referenciada = fk[3]
-        nome_constraint = fk[4]
-
-        alter_query = f"""
-        ALTER TABLE {schema}.{tabela_origem}
-        ADD CONSTRAINT {nome_constraint}
-        FOREIGN KEY ({coluna_origem})
-        REFERENCES {schema}.{tabela_referenciada} ({coluna_referenciada});
-        """
-
-        try:
-            # Executa o ALTER TABLE para criar as FKs nas tabelas do segundo ano (no schema staging)
-            cur.execute(alter_query)
-            conn.commit()
-            print(f"FK {nome_constraint} criada com sucesso.\n")
-        except Exception as e:
-            print(f"Erro ao criar FK {nome_constraint}: {e}\n")
-            cur.connection.rollback()
-
-# função de verificar se foi criado uma coluna
-def sync_table_structure(cur_src, cur_dest, conn_dest, schema="staging"):
-    query_tables = """
-        SELECT table_name FROM information_schema.tables
-        WHERE table_schema = 'public';
-    """
-    cur_src.execute(query_tables)
-    tables = [table[0] for table in cur_src.fetchall()]
-
-    for table in tables:
-        # Colunas do banco origem - primeiro ano
-        cur_src.execute("""
-            SELECT column_name, data_type, character_maximum_length
-            FROM information_schema.columns
-            WHERE table_schema = 'public' AND table_name = %s;
-            """, ( table,)
+    return get_catalog(cur, schema)["foreign_keys"]
+
+# Tipo da coluna usado no DDL do staging (varchar mantém o tamanho máximo)
+def column_type(data_type, char_max):
+    if data_type.lower() == "character varying" and char_max:
+        return f"VARCHAR ({char_max})"
+    return data_type.upper()
+
+# Definição de uma coluna no CREATE TABLE (a coluna "id" vira SERIAL PRIMARY KEY)
+def column_definition(column):
+    column_name, data_type, is_nullable, char_max = column
+    if column_name.lower() == "id":
+        return f"{column_name} SERIAL PRIMARY KEY"
+    nullable = " NOT NULL" if is_nullable == "NO" else ""
+    return f"{column_name} {column_type(data_type, char_max)}{nullable}"
+
+# Agrupa as FKs do catálogo por constraint: {(tabela, constraint): (colunas, tabela referenciada, colunas referenciadas)}
+def group_foreign_keys(foreign_keys):
+    grouped = {}
+    for tabela_origem, coluna_origem, tabela_referenciada, coluna_referenciada, nome_constraint in foreign_keys:
+        columns, _, ref_columns = grouped.setdefault(
+            (tabela_origem, nome_constraint), ([], tabela_referenciada, [])
         )
-        src_rows = cur_src.fetchall()
-        src_cols = {row[0]: row[1] for row in src_rows}
-        # print(f"Colunas do primeiro: {src_cols}")
-
-        # Colunas do banco destino - segundo ano (staging)
-        cur_dest.execute(f"""
-            SELECT column_name, data_type, character_maximum_length
-            FROM information_schema.columns
-            WHERE table_schema = %s AND table_name = %s;
-            """, (schema, table)
-        )
-        dest_rows = cur_dest.fetchall()
-        dest_cols = {row[0]: row[1] for row in dest_rows}
-        # print(f"Colunas do segundo: {dest_cols}")
-
-        # Normalização: trabalhar com nomes lower/strip para comparar
-        src_cols_norm = {
-            col_name.strip().lower(): (col_name, data_type, char_max)
-            for col_name, data_type, char_max in src_rows
-        }
-        dest_cols_norm = {
-            col_name.strip().lower(): (col_name, data_type, char_max)
-            for col_name, data_type, char_max in dest_rows
-        }
-
-        # Descobre quais colunas existem no origem e não no destino (colunas que serão adicionadas)
-        missing_norm = {k: v for k, v in src_cols_norm.items() if k not in dest_cols_norm}
-
-        # Descobre quais colunas existem no destino e não no origem (colunas que serão removidas)
-        removed_norm = {k: v for k, v in dest_cols_norm.items() if k not in src_cols_norm}
-
-        # Adiciona as colunas que estão faltando no banco do segundo ano
-        for norm_name, (orig_colname, data_type, char_max) in missing_norm.items():
-            col_to_add = orig_colname
-            data_type = f"VARCHAR ({char_max})" if data_type.lower() == "character varying" else data_type.lower()
-
-            print(f"Adicionando coluna '{col_to_add}' ({data_type}) na tabela '{schema}.{table}'...")
-            alter_query = f"ALTER TABLE {schema}.{table} ADD COLUMN {col_to_add} {data_type};"
-            try:
-                cur_dest.execute(alter_query)
-                conn_dest.commit()
-                print(f"Coluna '{col_to_add}' adicionada.")
-
-            except Exception as e:
-                conn_dest.rollback()
-                print(f"Erro ao adicionar coluna {col_to_add} em {table}: {e}")
-
-
-        for norm_name, (orig_dest_colname, data_type, char_max) in removed_norm.items():
-            if norm_name == "id":
-                continue  # Não remove a coluna 'id'
-
-            col_to_drop = orig_dest_colname
-            print(f"Removendo coluna '{col_to_drop}' da tabela '{schema}.{table}'...")
-            query_drop = f"ALTER TABLE {schema}.{table} DROP COLUMN IF EXISTS {col_to_drop} CASCADE;"
-            try:
-                cur_dest.execute(query_drop)
-                conn_dest.commit()
-                print(f"Coluna '{col_to_drop}' removida com sucesso de '{schema}.{table}'.")
-            except Exception as e:
-                conn_dest.rollback()
-                print(f"Erro ao remover coluna {col_to_drop} em {table}: {e}")
-
-
-# Transfere os dados do banco do primeiro ano para o schema staging do segundo ano
-def transfer_data(cur_src, cur_dest, conn_dest, schema="staging"):
-    # Query que retorna todas as tabelas
-    query_tables = """ 
-    SELECT table_name FROM information_schema.tables
-    WHERE table_schema = %s;
-    """
-    # Exexucta a query no banco do primeiro ano
-    cur_src.execute(query_tables, ('public',))
-    tables_src = cur_src.fetchall()
-    tables_src = [table[0] for table in tables_src]
-
-    # Exexucta a query no banco do segundo ano
-    cur_src.execute(query_tables, (schema,))
-    tables_dest = cur_src.fetchall()
-    tables_dest = [table[0] for table in tables_dest]
-
-    for table_name in tables_src:
-        # print(f"Transferindo dados da tabela '{table_name}'...")
-
-        # Executa um SELECT em cada tabela do primeiro ano
-        query_select = f"SELECT * FROM public.{table_name};"
-        cur_src.execute(query_select)
-        rows_src = cur_src.fetchall()
-
-        # Executa um SELECT em cada tabela do primeiro ano
-        query_select = f"SELECT * FROM {schema}.{table_name};"
-        cur_dest.execute(query_select)
-        rows_dest = cur_dest.fetchall()
-
-        # Caso a tabela esteja vazia
-        if not rows_src:
-            print(f"Nenhum dado encontrado em '{table_name}'")
+        if coluna_origem not in columns:
+            columns.append(coluna_origem)
+        if coluna_referenciada not in ref_columns:
+            ref_columns.append(coluna_referenciada)
+    return grouped
+
+# Compara o catálogo da origem (public) com o do staging e monta o plano mínimo de DDL, já na ordem de execução:
+# 1) tabelas novas, 2) colunas adicionadas / com tipo alterado / removidas, 3) FKs que ainda não existem no staging.
+# Retorna uma lista de (descrição, query); a lista vazia significa que a estrutura já está igual.
+def plan_schema_changes(src_catalog, dest_catalog, schema="staging"):
+    create_steps, column_steps, fk_steps = [], [], []
+    dest_tables = dest_catalog["tables"]
+
+    for table, src_columns in src_catalog["tables"].items():
+        if table not in dest_tables:
+            definition = ", ".join(column_definition(column) for column in src_columns)
+            create_steps.append((
+                f"Criar a tabela {schema}.{table}",
+                f"CREATE TABLE {schema}.{table} ({definition});"
+            ))
             continue
 
-        # Caso estiver diferente as tabelas
-        if len(rows_src) == len(rows_dest):
-            print(f"Tabela '{table_name}' já está atualizada. Pulando...")
+        # Normalização: trabalhar com nomes lower/strip para comparar
+        src_cols = {column[0].strip().lower(): column for column in src_columns}
+        dest_cols = {column[0].strip().lower(): column for column in dest_tables[table]}
+
+        for norm_name, (col_name, data_type, _, char_max) in src_cols.items():
+            new_type = column_type(data_type, char_max)
+            if norm_name not in dest_cols:
+                column_steps.append((
+                    f"Adicionar a coluna {col_name} ({new_type}) em {schema}.{table}",
+                    f"ALTER TABLE {schema}.{table} ADD COLUMN {col_name} {new_type};"
+                ))
+                continue
+            # A coluna "id" do staging é sempre SERIAL, então o tipo dela não é comparado
+            dest_name, dest_type, _, dest_char_max = dest_cols[norm_name]
+            if norm_name != "id" and new_type != column_type(dest_type, dest_char_max):
+                column_steps.append((
+                    f"Alterar o tipo de {schema}.{table}.{dest_name} para {new_type}",
+                    f"ALTER TABLE {schema}.{table} ALTER COLUMN {dest_name} TYPE {new_type} USING {dest_name}::{new_type};"
+                ))
+
+        for norm_name, (dest_name, _, _, _) in dest_cols.items():
+            if norm_name not in src_cols and norm_name != "id":  # Não remove a coluna 'id'
+                column_steps.append((
+                    f"Remover a coluna {dest_name} de {schema}.{table}",
+                    f"ALTER TABLE {schema}.{table} DROP COLUMN {dest_name} CASCADE;"
+                ))
+
+    # Só as FKs que ainda não existem no staging (comparadas pela tabela e pelo nome da constraint)
+    dest_fks = group_foreign_keys(dest_catalog["foreign_keys"])
+    for (table, nome_constraint), (columns, ref_table, ref_columns) in group_foreign_keys(src_catalog["foreign_keys"]).items():
+        if (table, nome_constraint) in dest_fks:
             continue
-        else:
-            print(f"Transferindo dados da tabela '{table_name}'...")
-
-            # Prepara a query do INSERT com base nas colunas da tabela
-            colnames = [desc[0] for desc in cur_src.description]
-            columns_str = ", ".join(colnames)
-            placeholders = ", ".join(["%s"] * len(colnames))
-
-            insert_query = f"""
-                INSERT INTO {schema}.{table_name} ({columns_str})
-                VALUES ({placeholders})
-                ON CONFLICT (id) DO NOTHING;
-            """
+        fk_steps.append((
+            f"Criar a FK {nome_constraint} em {schema}.{table}",
+            f"ALTER TABLE {schema}.{table} ADD CONSTRAINT {nome_constraint} "
+            f"FOREIGN KEY ({', '.join(columns)}) REFERENCES {schema}.{ref_table} ({', '.join(ref_columns)});"
+        ))
+
+    return create_steps + column_steps + fk_steps
+
+# Imprime o plano de DDL e, fora do dry-run, aplica tudo em uma única transação
+# (se algum passo falhar nada é aplicado). Retorna a quantidade de passos do plano.
+def apply_schema_plan(cur, conn, plan, dry_run=False):
+    if not plan:
+        print("A estrutura do staging já está atualizada.")
+        return 0
+
+    print(f"Plano de alterações ({len(plan)} passos):")
+    for description, query in plan:
+        print(f" - {description}")
+        if dry_run:
+            print(f"   {query}")
+    if dry_run:
+        return len(plan)
 
+    try:
+        for description, query in plan:
+            cur.execute(query)
+        conn.commit()
+        print("Estrutura do staging atualizada.")
+    except Exception as e:
+        conn.rollback()
+        print(f"Erro ao aplicar o plano (nenhuma alteração foi feita) em '{description}': {e}")
+        raise
+    return len(plan)
+
+# Sincroniza a estrutura do staging com a do banco de origem: lê os dois catálogos, monta o plano e aplica
+@instrumented("sync_schema")
+def sync_schema(cur_src, cur_dest, conn_dest, schema="staging", dry_run=False):
+    src_catalog = get_catalog(cur_src, "public")
+    dest_catalog = get_catalog(cur_dest, schema, refresh=True)
+    plan = plan_schema_changes(src_catalog, dest_catalog, schema)
+    if plan and not dry_run:
+        # Com a estrutura alterada, todas as tabelas contam como alteradas (na mesma transação do DDL)
+        create_transfer_control(cur_dest, conn_dest)
+        plan.append(("Marca todas as tabelas do staging como alteradas", bump_versions_query(cur_dest, src_catalog["tables"])))
+    applied = apply_schema_plan(cur_dest, conn_dest, plan, dry_run)
+    # A estrutura do staging mudou: a próxima leitura do catálogo precisa ir ao banco
+    if applied and not dry_run:
+        CATALOG_CACHE.pop((cur_dest.connection.dsn, schema), None)
+    return plan
+
+# Cria a tabela de controle com a marca d'água (high-water mark) de cada tabela transferida
+def create_transfer_control(cur_dest, conn_dest):
+    cur_dest.execute("CREATE SCHEMA IF NOT EXISTS rpa;")
+    cur_dest.execute("""
+    CREATE TABLE IF NOT EXISTS rpa.transfer_watermarks (
+        table_name TEXT PRIMARY KEY,
+        strategy TEXT NOT NULL,
+        watermark TEXT NOT NULL,
+        synced_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    """)
+    # Versão de cada tabela do staging: aumenta a cada transferência que muda linhas (ou a estrutura).
+    # Quem consome o staging (pipeline.py) compara com a versão que já processou.
+    cur_dest.execute("""
+    CREATE TABLE IF NOT EXISTS rpa.table_versions (
+        table_name TEXT PRIMARY KEY,
+        version BIGINT NOT NULL,
+        changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    """)
+    conn_dest.commit()
+
+# Query que aumenta a versão das tabelas (o commit é feito junto com os dados ou com o DDL)
+def bump_versions_query(cur_dest, table_names):
+    return cur_dest.mogrify("""
+    INSERT INTO rpa.table_versions (table_name, version)
+    SELECT unnest(%s::text[]), 1
+    ON CONFLICT (table_name) DO UPDATE SET
+        version = rpa.table_versions.version + 1,
+        changed_at = now();
+    """, (list(table_names),)).decode()
+
+# Versões atuais das tabelas do staging: {tabela: versão}
+def load_table_versions(cur_dest):
+    cur_dest.execute("SELECT table_name, version FROM rpa.table_versions;")
+    return dict(cur_dest.fetchall())
+
+# Retorna as marcas d'água salvas: {tabela: (estratégia, marca)}
+def load_watermarks(cur_dest):
+    cur_dest.execute("SELECT table_name, strategy, watermark FROM rpa.transfer_watermarks;")
+    return {table: (strategy, watermark) for table, strategy, watermark in cur_dest.fetchall()}
+
+# Salva a marca d'água da tabela (o commit é feito junto com os dados)
+def save_watermark(cur_dest, table_name, strategy, watermark):
+    cur_dest.execute("""
+    INSERT INTO rpa.transfer_watermarks (table_name, strategy, watermark)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (table_name) DO UPDATE SET
+        strategy = EXCLUDED.strategy,
+        watermark = EXCLUDED.watermark,
+        synced_at = now();
+    """, (table_name, strategy, str(watermark)))
+
+# Escolhe como detectar as linhas novas/alteradas: pela coluna updated_at (se existir)
+# ou pelo xmin (id da transação que gravou a linha) do Postgres de origem
+def watermark_strategy(colnames):
+    return "updated_at" if "updated_at" in colnames else "xmin"
+
+# Id (32 bits) da transação mais antiga ainda em andamento no banco de origem.
+# Toda transação que ainda não terminou tem id maior ou igual a esse valor.
+def current_xmin(cur_src):
+    cur_src.execute("SELECT txid_snapshot_xmin(txid_current_snapshot()) % 4294967296;")
+    return cur_src.fetchone()[0]
+
+# Filtro (WHERE) das linhas novas/alteradas desde a marca d'água (vazio na transferência completa)
+def watermark_filter(cur_src, strategy, watermark):
+    if watermark is None:
+        return ""
+    if strategy == "xmin":
+        return cur_src.mogrify(" WHERE xmin::text::bigint >= %s", (int(watermark),)).decode()
+    return cur_src.mogrify(" WHERE updated_at >= %s", (watermark,)).decode()
+
+# Executa o COPY ... TO STDOUT da origem escrevendo no pipe (roda em uma thread separada)
+def copy_out(cur_src, query, writer, errors):
+    try:
+        cur_src.copy_expert(query, writer, size=COPY_BUFFER_SIZE)
+    except Exception as e:
+        errors.append(e)
+    finally:
         try:
-            # Executa os INSERTs nas tabelas do segundo ano
-            cur_dest.executemany(insert_query, rows_src)
-
-            # Commita as alterações realizadas
-            conn_dest.commit()
-            print(f"{len(rows_src)} registros inseridos em {schema}.{table_name}.")
+            writer.close()
+        except Exception:
+            pass
+
+# Liga um COPY ... TO STDOUT da origem a um COPY ... FROM STDIN no destino por um pipe (memória constante).
+# Retorna a quantidade de linhas copiadas.
+def pipe_copy(cur_src, cur_dest, query_out, query_in):
+    read_fd, write_fd = os.pipe()
+    reader = os.fdopen(read_fd, "rb")
+    writer = os.fdopen(write_fd, "wb")
+    errors = []
+    thread = threading.Thread(target=copy_out, args=(cur_src, query_out, writer, errors), daemon=True)
+    thread.start()
+    try:
+        cur_dest.copy_expert(query_in, reader, size=COPY_BUFFER_SIZE)
+        copied = cur_dest.rowcount
+    finally:
+        # Fecha a leitura para destravar a thread caso o COPY do destino tenha falhado no meio
+        reader.close()
+        thread.join()
+    if errors:
+        raise errors[0]
+    return copied
+
+# Transfere as linhas da origem para o staging em streaming: COPY public.t TO STDOUT na origem ligado por um
+# pipe ao COPY FROM STDIN de uma tabela temporária no destino (memória constante, independente do tamanho
+# da tabela), e depois faz o merge com ON CONFLICT (id) DO UPDATE. Depois remove do staging as linhas que não
+# existem mais na origem: na transferência completa pelas linhas copiadas e na incremental pelos ids da origem
+# (só a coluna id é copiada, para uma tabela temporária).
+# Retorna (linhas copiadas, linhas novas/alteradas, linhas removidas, nova marca d'água).
+# O commit fica por conta de quem chama.
+def stream_table(cur_src, cur_dest, table_name, colnames, strategy, watermark=None, schema="staging"):
+    columns_str = ", ".join(colnames)
+    temp_table = f"tmp_{table_name}"
+
+    # As marcas são tiradas antes da leitura para não perder transações que terminarem durante a cópia:
+    # o xmin da origem, ou a hora da origem (limite da marca do updated_at)
+    if strategy == "xmin":
+        new_watermark = current_xmin(cur_src)
+    else:
+        new_watermark = watermark
+        cur_src.execute("SELECT clock_timestamp();")
+        read_started = cur_src.fetchone()[0]
+
+    cur_dest.execute(f"""
+    CREATE TEMP TABLE {temp_table} (LIKE {schema}.{table_name} INCLUDING DEFAULTS) ON COMMIT DROP;
+    """)
+    query_out = f"COPY (SELECT {columns_str} FROM public.{table_name}{watermark_filter(cur_src, strategy, watermark)}) TO STDOUT"
+    copied = pipe_copy(cur_src, cur_dest, query_out, f"COPY {temp_table} ({columns_str}) FROM STDIN")
+
+    # Merge da tabela temporária no staging. Só reescreve as linhas que mudaram (comparadas como texto, que
+    # funciona para qualquer tipo, inclusive json); o rowcount é a quantidade de linhas novas ou alteradas.
+    update_cols = [col for col in colnames if col != "id"]
+    if update_cols:
+        set_clause = ", ".join(f"{col} = EXCLUDED.{col}" for col in update_cols)
+        current_row = ", ".join(f"s.{col}" for col in update_cols)
+        new_row = ", ".join(f"EXCLUDED.{col}" for col in update_cols)
+        conflict = f"DO UPDATE SET {set_clause} WHERE ROW({current_row})::text IS DISTINCT FROM ROW({new_row})::text"
+    else:
+        conflict = "DO NOTHING"
+    cur_dest.execute(f"""
+    INSERT INTO {schema}.{table_name} AS s ({columns_str})
+    SELECT {columns_str} FROM {temp_table}
+    ON CONFLICT (id) {conflict};
+    """)
+    merged = cur_dest.rowcount
+
+    # Nova marca d'água pelo updated_at das linhas copiadas, nunca depois do início da leitura e recuada
+    # UPDATED_AT_OVERLAP: uma linha gravada por uma transação que terminou depois, com um updated_at anterior
+    # à marca, é lida de novo na próxima execução (o merge ignora as linhas que não mudaram)
+    if strategy == "updated_at":
+        cur_dest.execute(f"SELECT max(updated_at) FROM {temp_table};")
+        max_updated = cur_dest.fetchone()[0]
+        if max_updated is not None:
+            if max_updated.tzinfo is not None:
+                max_updated = min(max_updated, read_started)
+            new_watermark = (max_updated - UPDATED_AT_OVERLAP).isoformat()
+
+    # Linhas que ainda existem na origem: as copiadas (completa) ou os ids da origem (incremental)
+    existing_table = temp_table
+    if watermark is not None:
+        existing_table = f"tmp_{table_name}_ids"
+        cur_dest.execute(f"CREATE TEMP TABLE {existing_table} ON COMMIT DROP AS SELECT id FROM {schema}.{table_name} WITH NO DATA;")
+        existing = pipe_copy(cur_src, cur_dest, f"COPY (SELECT id FROM public.{table_name}) TO STDOUT", f"COPY {existing_table} (id) FROM STDIN")
+    else:
+        existing = copied
+
+    # Remove as linhas deletadas na origem (só se a origem não veio vazia).
+    # Usa um savepoint para que uma falha (ex.: FK no staging) não desfaça as linhas já transferidas.
+    deleted = 0
+    if existing:
+        cur_dest.execute("SAVEPOINT delete_missing;")
+        try:
+            cur_dest.execute(f"""
+            DELETE FROM {schema}.{table_name} s
+            WHERE NOT EXISTS (SELECT 1 FROM {existing_table} t WHERE t.id = s.id);
+            """)
+            deleted = cur_dest.rowcount
+            cur_dest.execute("RELEASE SAVEPOINT delete_missing;")
         except Exception as e:
-            # Caso ocorra algum erro, desfaz as alterações
-            conn_dest.rollback()
-            print(f"Erro ao inserir em {table_name}: {e}")
+            cur_dest.execute("ROLLBACK TO SAVEPOINT delete_missing;")
+            print(f"Erro ao remover linhas deletadas de {schema}.{table_name}: {e}")
+
+    cur_dest.execute(f"DROP TABLE {temp_table};")
+    if existing_table != temp_table:
+        cur_dest.execute(f"DROP TABLE {existing_table};")
+    return copied, merged, deleted, new_watermark
+
+# Tabelas do schema public do banco de origem com as suas colunas: {tabela: [colunas]}
+def get_source_tables(cur_src):
+    tables = get_catalog(cur_src, "public")["tables"]
+    return {table: [column[0] for column in columns] for table, columns in tables.items()}
+
+# Views e tabelas estrangeiras da origem: não têm xmin (e o updated_at delas não garante as alterações),
+# então são sempre transferidas por completo
+def get_full_only_tables(cur_src):
+    return {table for table, kind in get_catalog(cur_src, "public")["kinds"].items() if kind not in ("r", "p")}
+
+# Transfere uma tabela do banco do primeiro ano para o schema staging do segundo ano.
+# No modo incremental só as linhas novas/alteradas desde a última marca d'água são lidas (e os ids da origem,
+# para remover as linhas deletadas); a tabela volta para a transferência completa quando não há marca
+# (watermarks sem a tabela), quando está em "full_tables" (onde também entram as views e tabelas estrangeiras)
+# ou quando houve wraparound do xmin.
+# Retorna um resumo da tabela: {"table", "status", "copied", "changed", "deleted", "seconds"}
+@instrumented("transfer_table")
+def transfer_table(cur_src, cur_dest, conn_dest, table_name, colnames, watermarks, full_tables=(), schema="staging"):
+    label(table=table_name)
+    start = time.perf_counter()
+    result = {"table": table_name, "status": "ok", "copied": 0, "changed": 0, "deleted": 0, "seconds": 0.0}
+    try:
+        # Estratégia de marca d'água de acordo com as colunas da tabela
+        if "id" not in colnames:
+            print(f"Tabela '{table_name}' não tem coluna 'id'. Pulando...")
+            result["status"] = "skipped"
+            return result
+        strategy = watermark_strategy(colnames)
+
+        # Decide entre transferência incremental ou completa
+        saved = watermarks.get(table_name)
+        watermark = None
+        if saved and saved[0] == strategy and table_name not in full_tables:
+            watermark = saved[1]
+            if strategy == "xmin" and current_xmin(cur_src) < int(watermark):
+                print(f"Wraparound do xmin detectado em '{table_name}'. Fazendo a transferência completa...")
+                watermark = None
+
+        full = watermark is None
+        print(f"Transferindo dados da tabela '{table_name}' ({'completa' if full else 'incremental'})...")
+        copied, changed, deleted, new_watermark = stream_table(cur_src, cur_dest, table_name, colnames, strategy, watermark, schema)
+
+        if new_watermark is not None:
+            save_watermark(cur_dest, table_name, strategy, new_watermark)
+        # Linhas realmente novas/alteradas ou removidas mudam a versão da tabela (junto com os dados)
+        if changed or deleted:
+            cur_dest.execute(bump_versions_query(cur_dest, [table_name]))
+
+        # Commita os dados e a marca d'água juntos
+        conn_dest.commit()
+        cur_src.connection.commit()
+        result.update(copied=copied, changed=changed, deleted=deleted, seconds=time.perf_counter() - start)
+        record(rows_read=copied, rows_written=changed + deleted)
+        if changed or deleted:
+            rate = copied / result["seconds"] if result["seconds"] else 0
+            print(f"{copied} registros transferidos ({changed} novos/alterados) e {deleted} removidos em {schema}.{table_name} ({result['seconds']:.2f}s, {rate:.0f} linhas/s).")
+        else:
+            print(f"Tabela '{table_name}' já está atualizada.")
+    except Exception as e:
+        # Caso ocorra algum erro, desfaz as alterações
+        conn_dest.rollback()
+        cur_src.connection.rollback()
+        print(f"Erro ao transferir {table_name}: {e}")
+        result.update(status="error", error=str(e), seconds=time.perf_counter() - start)
+        mark_error()
+    return result
+
+# Transfere os dados do banco do primeiro ano para o schema staging do segundo ano, uma tabela por vez,
+# na ordem das FKs.
+# Retorna a lista com o resumo de cada tabela (ver transfer_table).
+@instrumented("transfer_data")
+def transfer_data(cur_src, cur_dest, conn_dest, schema="staging", incremental=True, full_tables=None):
+    tables_src = get_source_tables(cur_src)
+
+    # Marcas d'água da última execução
+    create_transfer_control(cur_dest, conn_dest)
+    watermarks = load_watermarks(cur_dest) if incremental else {}
+    full_tables = set(full_tables or ()) | get_full_only_tables(cur_src)
+
+    # Mesma ordem das FKs da transferência paralela: as tabelas referenciadas antes das que as referenciam
+    order = dependency_order(tables_src, get_foreign_keys(cur_src, "public"))
+    results = [
+        transfer_table(cur_src, cur_dest, conn_dest, table_name, tables_src[table_name], watermarks, full_tables, schema)
+        for table_name in order
+    ]
+    print_transfer_summary(results)
+    return results
+
+# Monta o grafo de dependências a partir das FKs: {tabela: tabelas que ela referencia}
+# (auto-referências e tabelas fora da lista são ignoradas)
+def build_dependency_graph(tables, foreign_keys):
+    tables = set(tables)
+    graph = {table: set() for table in tables}
+    for tabela_origem, _, tabela_referenciada, _, _ in foreign_keys:
+        if tabela_origem in tables and tabela_referenciada in tables and tabela_origem != tabela_referenciada:
+            graph[tabela_origem].add(tabela_referenciada)
+    return graph
+
+# Ordena as tabelas de forma que cada uma venha depois das tabelas que ela referencia (ordem topológica do
+# grafo de FKs, com as tabelas na ordem do catálogo dentro de cada nível). Tabelas em ciclo vão no final.
+def dependency_order(tables, foreign_keys):
+    pending = build_dependency_graph(tables, foreign_keys)
+    order = []
+    while pending:
+        ready = [table for table in tables if table in pending and pending[table] <= set(order)]
+        if not ready:
+            print(f"Ciclo de FKs entre as tabelas {sorted(pending)}. Transferindo sem ordem.")
+            ready = [table for table in tables if table in pending]
+        for table in ready:
+            order.append(table)
+            pending.pop(table)
+    return order
+
+# Transfere as tabelas em paralelo, respeitando as FKs: uma tabela só começa depois que as tabelas
+# que ela referencia terminaram. Usa um pool de conexões com no máximo "concurrency" pares origem/destino.
+# Tabelas em ciclo de FKs são liberadas quando não há mais nada para executar.
+@instrumented("transfer_data")
+def transfer_data_parallel(src_url, dest_url, foreign_keys, schema="staging", incremental=True, full_tables=None, concurrency=TRANSFER_CONCURRENCY):
+    start = time.perf_counter()
+    pool_src = ThreadedConnectionPool(1, concurrency, src_url, cursor_factory=MetricsCursor)
+    pool_dest = ThreadedConnectionPool(1, concurrency, dest_url, cursor_factory=MetricsCursor)
+    try:
+        # Tabelas, grafo de FKs e marcas d'água (lidos uma vez)
+        conn_src = pool_src.getconn()
+        conn_dest = pool_dest.getconn()
+        try:
+            with conn_src.cursor() as cur_src, conn_dest.cursor() as cur_dest:
+                tables_src = get_source_tables(cur_src)
+                full_tables = set(full_tables or ()) | get_full_only_tables(cur_src)
+                create_transfer_control(cur_dest, conn_dest)
+                watermarks = load_watermarks(cur_dest) if incremental else {}
+            conn_src.commit()
+        finally:
+            pool_src.putconn(conn_src)
+            pool_dest.putconn(conn_dest)
+        pending = build_dependency_graph(tables_src, foreign_keys)
+
+        # Cada thread pega um par de conexões do pool para a sua tabela
+        def run(table_name):
+            conn_src = pool_src.getconn()
+            conn_dest = pool_dest.getconn()
+            try:
+                with conn_src.cursor() as cur_src, conn_dest.cursor() as cur_dest:
+                    return transfer_table(cur_src, cur_dest, conn_dest, table_name, tables_src[table_name], watermarks, full_tables, schema)
+            finally:
+                pool_src.putconn(conn_src)
+                pool_dest.putconn(conn_dest)
+
+        results = []
+        done = set()
+        running = {}
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while pending or running:
+                # Libera as tabelas cujas dependências já terminaram
+                ready = [table for table, deps in pending.items() if deps <= done]
+                if not ready and not running:
+                    # Ciclo de FKs: libera as tabelas restantes
+                    print(f"Ciclo de FKs entre as tabelas {sorted(pending)}. Transferindo sem ordem.")
+                    ready = list(pending)
+                for table in ready:
+                    pending.pop(table)
+                    running[executor.submit(bind(run), table)] = table
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    table = running.pop(future)
+                    results.append(future.result())
+                    done.add(table)
+    finally:
+        pool_src.closeall()
+        pool_dest.closeall()
+
+    print_transfer_summary(results, time.perf_counter() - start)
+    return results
+
+# Imprime o tempo de cada tabela (da mais lenta para a mais rápida) e o total
+def print_transfer_summary(results, wall_seconds=None):
+    if not results:
+        return
+    print("\nResumo da transferência (tabela: tempo, linhas, status):")
+    for result in sorted(results, key=lambda r: r["seconds"], reverse=True):
+        print(f" - {result['table']}: {result['seconds']:.2f}s, {result['copied']} linhas, {result['status']}")
+    print(f"Soma dos tempos das tabelas: {sum(r['seconds'] for r in results):.2f}s")
+    if wall_seconds is not None:
+        print(f"Tempo total (relógio): {wall_seconds:.2f}s")
 
 # Função principal
 if __name__ == "__main__":
     try:
+        # Argumentos da linha de comando
+        parser = argparse.ArgumentParser(description="Sincroniza o banco do primeiro ano com o schema staging.")
+        parser.add_argument(
+            "--full-resync", nargs="*", default=None, metavar="TABELA",
+            help="Ignora as marcas d'água e transfere por completo as tabelas informadas (ou todas, se nenhuma for informada)"
+        )
+        parser.add_argument(
+            "--concurrency", type=int, default=TRANSFER_CONCURRENCY,
+            help="Quantidade máxima de tabelas transferidas ao mesmo tempo (1 = uma por vez)"
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true",
+            help="Só imprime o plano de alterações da estrutura do staging, sem aplicar nem transferir dados"
+        )
+        args = parser.parse_args()
+
         # Carrega as envs
         load_dotenv()
 
         # Declarando as variáveis do banco do primeiro ano
-        conn1 = psycopg2.connect(os.getenv("POSTGRES_URL_1"))
+        conn1 = psycopg2.connect(os.getenv("POSTGRES_URL_1"), cursor_factory=MetricsCursor)
         cur1 = conn1.cursor()
 
         # Declarando as variáveis do banco do primeiro ano
-        conn2 = psycopg2.connect(os.getenv("POSTGRES_URL_2"))
+        conn2 = psycopg2.connect(os.getenv("POSTGRES_URL_2"), cursor_factory=MetricsCursor)
         cur2 = conn2.cursor()
 
-        # Criando o schema de staging (caso ele não exista)
-        print("Criando o schema 'staging':")
-        create_staging_schema(conn2, cur2)
-
-        # Montando a estrutura das tabelas
-        structure = get_tables_columns(cur1)
-
-        # Criando as tabelas no postgres
-        print("\nCriando as tabelas no schema 'staging':")
-        create_tables(cur2, conn2, structure, 'staging')
-
-        # Criando as FKs no banco do segundo ano (não funciona essas funções)
+        # Criando o schema de staging (caso ele não exista). O dry-run não altera o banco: sem o schema,
+        # o plano mostra todas as tabelas como novas
+        if args.dry_run:
+            print("Dry-run: o schema 'staging' não é criado.")
+        else:
+            print("Criando o schema 'staging':")
+            create_staging_schema(conn2, cur2)
+
+        # Sincronizando a estrutura do staging (tabelas, colunas e FKs) em uma única transação
+        print("\nSincronizando a estrutura das tabelas no schema 'staging':")
+        sync_schema(cur1, cur2, conn2, 'staging', dry_run=args.dry_run)
+        if args.dry_run:
+            raise SystemExit(0)
         foreign_keys = get_foreign_keys(cur1, 'public')
 
-        # print("\nCriando as Foreign Keys no schema 'staging':")
-        create_foreign_keys(cur2, conn2, foreign_keys, 'staging')
-
-        # Sincronizando a estrutura das tabelas (caso tenha adicionado alguma coluna nas tabelas)
-        print("\nSincronizando a estrutura das tabelas no schema 'staging'")
-        sync_table_structure(cur1, cur2, conn2, 'staging')
-
         # Transferindo os dados 
         print("\nTransferindo os dados para o schema 'staging':")
-        transfer_data(cur1, cur2, conn2, 'staging')
+        incremental = args.full_resync != []
+        if args.concurrency > 1:
+            transfer_data_parallel(
+                os.getenv("POSTGRES_URL_1"), os.getenv("POSTGRES_URL_2"), foreign_keys, 'staging',
+                incremental=incremental, full_tables=args.full_resync, concurrency=args.concurrency
+            )
+        else:
+            transfer_data(cur1, cur2, conn2, 'staging', incremental=incremental, full_tables=args.full_resync)
     except Exception as e:
         print(f"Erro ao sincronizar as tabelas: {e}")
     finally:
@@ -324,4 +675,7 @@ if __name__ == "__main__":
         cur1.close()
         conn1.close()
         cur2.close()
-        conn2.close()
\ No newline at end of file
+        conn2.close()
+
+        # Métricas das etapas desta execução (se METRICS_PROMETHEUS_FILE estiver configurado)
+        write_prometheus()
\ No newline at end of file